@@ -0,0 +1,122 @@
+# Benchmarks the eager and fused (sdpa) attention backends on CPU
+
+import logging
+import multiprocessing as mp
+import resource
+import time
+from typing import Dict, List, Optional
+
+import torch
+
+from model import IndieGOConfig, IndieGOForCausalLM
+
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _run_case(
+    attn_implementation: str,
+    seq_length: int,
+    n_layer: Optional[int],
+    num_iters: int,
+    queue: mp.Queue,
+) -> None:
+    """Run one backend/length case in a fresh process so peak RSS is not shared."""
+    torch.manual_seed(0)
+    config = IndieGOConfig(attn_implementation=attn_implementation)
+    if n_layer is not None:
+        config.n_layer = n_layer
+    model = IndieGOForCausalLM(config).eval()
+    input_ids = torch.randint(0, config.vocab_size, (1, seq_length))
+
+    baseline_rss = peak_rss_mb()
+    timings = []
+    with torch.no_grad():
+        for _ in range(num_iters):
+            start = time.perf_counter()
+            model(input_ids, use_cache=False)
+            timings.append(time.perf_counter() - start)
+
+    elapsed = min(timings)
+    queue.put({
+        "backend": attn_implementation,
+        "seq_length": seq_length,
+        "tokens_per_s": seq_length / elapsed,
+        "latency_s": elapsed,
+        "peak_activation_mb": peak_rss_mb() - baseline_rss,
+    })
+
+def benchmark(
+    seq_lengths: List[int],
+    backends: List[str],
+    n_layer: Optional[int] = None,
+    num_iters: int = 3,
+) -> List[Dict[str, float]]:
+    ctx = mp.get_context("spawn")
+    results = []
+    for seq_length in seq_lengths:
+        for backend in backends:
+            queue = ctx.Queue()
+            process = ctx.Process(
+                target=_run_case,
+                args=(backend, seq_length, n_layer, num_iters, queue),
+            )
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                logger.error(f"{backend} at {seq_length} tokens failed (exit code {process.exitcode})")
+                continue
+            result = queue.get()
+            logger.info(
+                f"{backend:>5} | {seq_length:>5} tokens | "
+                f"{result['tokens_per_s']:>9.1f} tok/s | "
+                f"{result['peak_activation_mb']:>9.1f} MB peak"
+            )
+            results.append(result)
+    return results
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--seq_lengths",
+        type=int,
+        nargs="+",
+        default=[1024, 2048, 4096],
+        help="Prompt lengths to benchmark",
+    )
+    parser.add_argument(
+        "--backends",
+        type=str,
+        nargs="+",
+        default=["eager", "sdpa"],
+        help="Attention implementations to compare",
+    )
+    parser.add_argument(
+        "--n_layer",
+        type=int,
+        help="Override the number of layers of the default config to fit in RAM",
+    )
+    parser.add_argument(
+        "--num_iters",
+        type=int,
+        default=3,
+        help="Forward passes per case; the fastest one is reported",
+    )
+
+    args = parser.parse_args()
+
+    benchmark(
+        seq_lengths=args.seq_lengths,
+        backends=args.backends,
+        n_layer=args.n_layer,
+        num_iters=args.num_iters,
+    )
@@ -0,0 +1,130 @@
+# Benchmarks training-step memory with gradient checkpointing and bf16 autocast on CPU
+
+import contextlib
+import itertools
+import logging
+import multiprocessing as mp
+import time
+from typing import Dict, List, Optional
+
+import torch
+
+from benchmark_attention import peak_rss_mb
+from model import IndieGOConfig, IndieGOForCausalLM
+
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
+
+def _run_case(
+    gradient_checkpointing: bool,
+    bf16: bool,
+    seq_length: int,
+    batch_size: int,
+    n_layer: Optional[int],
+    n_embd: Optional[int],
+    num_steps: int,
+    queue: mp.Queue,
+) -> None:
+    """Run a few optimizer steps in a fresh process so peak RSS is not shared."""
+    torch.manual_seed(0)
+    config = IndieGOConfig()
+    if n_layer is not None:
+        config.n_layer = n_layer
+    if n_embd is not None:
+        config.n_embd = n_embd
+    model = IndieGOForCausalLM(config).train()
+    if gradient_checkpointing:
+        model.gradient_checkpointing_enable()
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-5)
+    input_ids = torch.randint(0, config.vocab_size, (batch_size, seq_length))
+
+    baseline_rss = peak_rss_mb()
+    step_peaks = []
+    timings = []
+    for _ in range(num_steps):
+        start = time.perf_counter()
+        autocast = torch.autocast("cpu", dtype=torch.bfloat16) if bf16 else contextlib.nullcontext()
+        with autocast:
+            loss = model(input_ids, labels=input_ids, use_cache=False).loss
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+        timings.append(time.perf_counter() - start)
+        # ru_maxrss only grows, so this is the peak up to and including this step
+        step_peaks.append(peak_rss_mb() - baseline_rss)
+
+    queue.put({
+        "gradient_checkpointing": gradient_checkpointing,
+        "bf16": bf16,
+        "seq_length": seq_length,
+        "step_peak_mb": step_peaks,
+        "peak_mb": step_peaks[-1],
+        "step_time_s": min(timings),
+    })
+
+def benchmark(
+    seq_length: int = 1024,
+    batch_size: int = 1,
+    n_layer: Optional[int] = None,
+    n_embd: Optional[int] = None,
+    num_steps: int = 3,
+) -> List[Dict[str, float]]:
+    ctx = mp.get_context("spawn")
+    results = []
+    for gradient_checkpointing, bf16 in itertools.product((False, True), (False, True)):
+        name = f"checkpointing={'on' if gradient_checkpointing else 'off'} bf16={'on' if bf16 else 'off'}"
+        queue = ctx.Queue()
+        process = ctx.Process(
+            target=_run_case,
+            args=(gradient_checkpointing, bf16, seq_length, batch_size, n_layer, n_embd, num_steps, queue),
+        )
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            logger.error(f"{name} failed (exit code {process.exitcode})")
+            continue
+        result = queue.get()
+        logger.info(
+            f"{name} | "
+            f"per-step peak {' / '.join(f'{mb:.1f}' for mb in result['step_peak_mb'])} MB | "
+            f"{result['step_time_s']:.2f} s/step"
+        )
+        results.append(result)
+    return results
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seq_length", type=int, default=1024)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument(
+        "--n_layer",
+        type=int,
+        help="Override the number of layers of the default config to fit in RAM",
+    )
+    parser.add_argument(
+        "--n_embd",
+        type=int,
+        help="Override the embedding dimension of the default config to fit in RAM",
+    )
+    parser.add_argument(
+        "--num_steps",
+        type=int,
+        default=3,
+        help="Optimizer steps per case; peak RSS is reported after each",
+    )
+
+    args = parser.parse_args()
+
+    benchmark(
+        seq_length=args.seq_length,
+        batch_size=args.batch_size,
+        n_layer=args.n_layer,
+        n_embd=args.n_embd,
+        num_steps=args.num_steps,
+    )
@@ -0,0 +1,103 @@
+# Compares prefill latency and cached greedy decode throughput of PyTorch against onnxruntime
+
+import logging
+import time
+from typing import Dict, List
+
+import torch
+
+from model import IndieGOForCausalLM
+from onnx_backend import OnnxCausalLM
+
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
+
+@torch.no_grad()
+def greedy_decode(model, input_ids: torch.Tensor, new_tokens: int) -> Dict[str, float]:
+    """
+    Prefill the prompt, then decode one token per step through the KV cache.
+
+    Works with IndieGOForCausalLM and OnnxCausalLM alike, since both take
+    the same cached forward arguments the batch scheduler uses.
+    """
+    batch_size, prompt_length = input_ids.shape
+    attention_mask = torch.ones((batch_size, prompt_length), dtype=torch.long)
+
+    start = time.perf_counter()
+    outputs = model(input_ids, attention_mask=attention_mask, use_cache=True, return_dict=True)
+    prefill_time = time.perf_counter() - start
+
+    next_tokens = outputs.logits[:, -1, :].argmax(dim=-1, keepdim=True)
+    past_key_values = outputs.past_key_values
+    start = time.perf_counter()
+    for step in range(new_tokens - 1):
+        attention_mask = torch.cat((attention_mask, attention_mask.new_ones((batch_size, 1))), dim=1)
+        position_ids = torch.full((batch_size, 1), prompt_length + step, dtype=torch.long)
+        outputs = model(
+            next_tokens,
+            past_key_values=past_key_values,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            use_cache=True,
+            return_dict=True,
+        )
+        next_tokens = outputs.logits[:, -1, :].argmax(dim=-1, keepdim=True)
+        past_key_values = outputs.past_key_values
+    decode_time = time.perf_counter() - start
+
+    return {
+        "prefill_ms": prefill_time * 1000,
+        "decode_tokens_per_s": batch_size * (new_tokens - 1) / decode_time,
+    }
+
+def benchmark(
+    model_path: str,
+    onnx_path: str,
+    prompt_length: int = 128,
+    new_tokens: int = 64,
+    batch_sizes: List[int] = (1, 8),
+    num_threads: int = 0,
+) -> Dict[str, Dict[int, Dict[str, float]]]:
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    models = {
+        "torch": IndieGOForCausalLM.from_pretrained(model_path).eval(),
+        "onnxruntime": OnnxCausalLM(onnx_path, num_threads=num_threads or None),
+    }
+    vocab_size = models["torch"].config.vocab_size
+
+    results = {name: {} for name in models}
+    for batch_size in batch_sizes:
+        input_ids = torch.randint(0, vocab_size, (batch_size, prompt_length))
+        for name, model in models.items():
+            # The first call pays for allocator and (onnxruntime) kernel warm-up
+            greedy_decode(model, input_ids, 2)
+            results[name][batch_size] = greedy_decode(model, input_ids, new_tokens)
+            logger.info(
+                f"{name:>11} batch {batch_size}: prefill {results[name][batch_size]['prefill_ms']:.1f} ms, "
+                f"decode {results[name][batch_size]['decode_tokens_per_s']:.1f} tok/s"
+            )
+        speedup = (
+            results["onnxruntime"][batch_size]["decode_tokens_per_s"]
+            / results["torch"][batch_size]["decode_tokens_per_s"]
+        )
+        logger.info(f"batch {batch_size}: onnxruntime decode speedup {speedup:.2f}x")
+    return results
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_path", type=str, required=True)
+    parser.add_argument("--onnx_path", type=str, required=True, help="Directory written by export_onnx.py")
+    parser.add_argument("--prompt_length", type=int, default=128)
+    parser.add_argument("--new_tokens", type=int, default=64)
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--num_threads", type=int, default=0, help="0 keeps each runtime's default")
+
+    args = parser.parse_args()
+    benchmark(**vars(args))
@@ -0,0 +1,91 @@
+# Benchmarks speculative decoding with a small draft model against plain greedy decoding
+
+import logging
+from typing import Dict, List, Optional
+
+import torch
+from transformers import PreTrainedTokenizerBase
+
+from model import IndieGOForCausalLM
+from quantize import decode_speed
+
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
+
+@torch.no_grad()
+def benchmark(
+    model_path: str,
+    draft_model_path: str,
+    prompt_file: str,
+    tokenizer_path: Optional[str] = None,
+    num_speculative_tokens: List[int] = (2, 4, 6, 8),
+    prompt_length: int = 128,
+    new_tokens: int = 128,
+) -> List[Dict[str, float]]:
+    tokenizer = PreTrainedTokenizerBase.from_pretrained(tokenizer_path or model_path)
+    with open(prompt_file) as f:
+        input_ids = tokenizer(f.read(), return_tensors="pt")["input_ids"][:, :prompt_length]
+
+    model = IndieGOForCausalLM.from_pretrained(model_path).eval()
+    draft_model = IndieGOForCausalLM.from_pretrained(draft_model_path).eval()
+    draft_model.generation_config.num_assistant_tokens_schedule = "constant"
+
+    # Warm up both models so the first case does not pay for allocation
+    decode_speed(model, input_ids, 4, assistant_model=draft_model)
+
+    baseline = decode_speed(model, input_ids, new_tokens)
+    logger.info(f"greedy            | {baseline:>8.2f} tok/s")
+    expected = model.generate(
+        input_ids,
+        attention_mask=torch.ones_like(input_ids),
+        max_new_tokens=new_tokens,
+        do_sample=False,
+        pad_token_id=model.config.eos_token_id,
+    )
+
+    results = [{"num_speculative_tokens": 0, "tokens_per_s": baseline, "speedup": 1.0}]
+    for k in num_speculative_tokens:
+        draft_model.generation_config.num_assistant_tokens = k
+        tokens_per_s = decode_speed(model, input_ids, new_tokens, assistant_model=draft_model)
+        outputs = model.generate(
+            input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            max_new_tokens=new_tokens,
+            do_sample=False,
+            pad_token_id=model.config.eos_token_id,
+            assistant_model=draft_model,
+        )
+        if not torch.equal(outputs, expected):
+            logger.error(f"k={k}: speculative output differs from greedy decoding")
+        logger.info(f"speculative k={k:<3} | {tokens_per_s:>8.2f} tok/s | {tokens_per_s / baseline:.2f}x")
+        results.append({
+            "num_speculative_tokens": k,
+            "tokens_per_s": tokens_per_s,
+            "speedup": tokens_per_s / baseline,
+        })
+    return results
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_path", type=str, required=True)
+    parser.add_argument("--draft_model_path", type=str, required=True)
+    parser.add_argument("--prompt_file", type=str, required=True, help="Text whose first tokens are the prompt")
+    parser.add_argument("--tokenizer_path", type=str)
+    parser.add_argument(
+        "--num_speculative_tokens",
+        type=int,
+        nargs="+",
+        default=[2, 4, 6, 8],
+        help="Draft lengths to compare",
+    )
+    parser.add_argument("--prompt_length", type=int, default=128)
+    parser.add_argument("--new_tokens", type=int, default=128)
+
+    args = parser.parse_args()
+    benchmark(**vars(args))
@@ -0,0 +1,165 @@
+# Near-duplicate detection for the training corpus with MinHash signatures and LSH banding
+
+import math
+import re
+from dataclasses import asdict, dataclass
+from typing import Dict, Iterable, Iterator
+
+import numpy as np
+import xxhash
+
+# Universal hashing modulo a Mersenne prime keeps a * h + b inside uint64 for 32-bit h
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+@dataclass
+class DedupStats:
+    """Counts reported by a deduplication pass"""
+    seen: int = 0
+    exact_duplicates: int = 0
+    near_duplicates: int = 0
+
+    @property
+    def kept(self) -> int:
+        return self.seen - self.exact_duplicates - self.near_duplicates
+
+    def merge(self, other: "DedupStats") -> "DedupStats":
+        return DedupStats(
+            seen=self.seen + other.seen,
+            exact_duplicates=self.exact_duplicates + other.exact_duplicates,
+            near_duplicates=self.near_duplicates + other.near_duplicates,
+        )
+
+    def to_dict(self) -> Dict[str, int]:
+        return {**asdict(self), "kept": self.kept}
+
+class BloomFilter:
+    """
+    Fixed-size membership test for 64-bit keys.
+
+    Added keys are always found. A key that was never added is reported as
+    present with probability about error_rate while at most capacity keys
+    have been added, and more often beyond that; memory never grows.
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.num_bits = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self._bits = np.zeros((self.num_bits + 7) // 8, dtype=np.uint8)
+        self._steps = np.arange(self.num_hashes, dtype=np.uint64)
+
+    @property
+    def nbytes(self) -> int:
+        return self._bits.nbytes
+
+    def _positions(self, keys: np.ndarray) -> np.ndarray:
+        # Double hashing: the two 32-bit halves of each key generate all its bit positions
+        low = keys & np.uint64(0xFFFFFFFF)
+        high = (keys >> np.uint64(32)) | np.uint64(1)
+        return (low[:, None] + self._steps[None, :] * high[:, None]) % np.uint64(self.num_bits)
+
+    def contains(self, keys: np.ndarray) -> np.ndarray:
+        """Per key, whether it may have been added"""
+        positions = self._positions(keys)
+        bits = (self._bits[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1
+        return bits.all(axis=1)
+
+    def add(self, keys: np.ndarray) -> None:
+        positions = self._positions(keys).ravel()
+        masks = np.left_shift(1, (positions & np.uint64(7)).astype(np.uint8)).astype(np.uint8)
+        np.bitwise_or.at(self._bits, positions >> np.uint64(3), masks)
+
+class MinHashDeduplicator:
+    """
+    Streaming exact + near-duplicate filter.
+
+    Exact duplicates are caught by an xxhash of the whitespace-normalized
+    text. Near duplicates are documents whose MinHash signature collides with
+    an earlier one in at least one LSH band; with the defaults (128
+    permutations, 16 bands of 8 rows) pairs above ~0.7 Jaccard similarity of
+    their token 5-gram sets are flagged.
+
+    The hashes of kept documents go into Bloom filters sized for capacity
+    unique documents, so memory is fixed up front (about 42 MB for a million
+    at the default error_rate) instead of growing with the stream. The price
+    is that about error_rate of the unique documents are wrongly dropped, a
+    share that rises once more than capacity documents have been kept.
+    """
+
+    def __init__(
+        self,
+        num_perm: int = 128,
+        num_bands: int = 16,
+        ngram_size: int = 5,
+        seed: int = 42,
+        capacity: int = 1_000_000,
+        error_rate: float = 1e-3,
+    ):
+        if num_perm % num_bands != 0:
+            raise ValueError("num_perm must be divisible by num_bands")
+        self.num_perm = num_perm
+        self.num_bands = num_bands
+        self.rows_per_band = num_perm // num_bands
+        self.ngram_size = ngram_size
+
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, 1 << 32, size=num_perm, dtype=np.uint64)
+        self._b = rng.randint(0, 1 << 32, size=num_perm, dtype=np.uint64)
+
+        self._exact = BloomFilter(capacity, error_rate)
+        # A document is near-duplicate if any of its bands hits, so each lookup gets a share of the error
+        self._bands = BloomFilter(capacity * num_bands, error_rate / num_bands)
+        self.stats = DedupStats()
+
+    def signature(self, text: str) -> np.ndarray:
+        tokens = _TOKEN_RE.findall(text)
+        if len(tokens) < self.ngram_size:
+            shingles = {" ".join(tokens)}
+        else:
+            shingles = {
+                " ".join(tokens[i:i + self.ngram_size])
+                for i in range(len(tokens) - self.ngram_size + 1)
+            }
+        hashes = np.fromiter(
+            (xxhash.xxh32_intdigest(shingle.encode("utf-8")) for shingle in shingles),
+            dtype=np.uint64,
+            count=len(shingles),
+        )
+        permuted = (hashes[None, :] * self._a[:, None] + self._b[:, None]) % _MERSENNE_PRIME
+        return (permuted & _MAX_HASH).min(axis=1)
+
+    def _band_keys(self, signature: np.ndarray) -> np.ndarray:
+        # All bands share one filter, so the band index seeds the hash
+        return np.fromiter(
+            (
+                xxhash.xxh64_intdigest(band.tobytes(), seed=i)
+                for i, band in enumerate(signature.reshape(self.num_bands, self.rows_per_band))
+            ),
+            dtype=np.uint64,
+            count=self.num_bands,
+        )
+
+    def is_duplicate(self, text: str) -> bool:
+        """Check a document against everything kept so far, remembering it if it is new"""
+        self.stats.seen += 1
+
+        exact_key = np.array([xxhash.xxh64_intdigest(" ".join(text.split()).encode("utf-8"))], dtype=np.uint64)
+        if self._exact.contains(exact_key)[0]:
+            self.stats.exact_duplicates += 1
+            return True
+
+        band_keys = self._band_keys(self.signature(text))
+        if self._bands.contains(band_keys).any():
+            self.stats.near_duplicates += 1
+            return True
+
+        self._exact.add(exact_key)
+        self._bands.add(band_keys)
+        return False
+
+    def filter(self, examples: Iterable[Dict[str, str]]) -> Iterator[Dict[str, str]]:
+        """Yield only the examples whose "text" is not a duplicate"""
+        for example in examples:
+            if not self.is_duplicate(example["text"]):
+                yield example
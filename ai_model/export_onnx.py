@@ -0,0 +1,172 @@
+# Exports IndieGOForCausalLM with explicit KV-cache inputs/outputs to ONNX for onnxruntime serving
+#
+# Output directory layout:
+#   model.onnx    inputs input_ids, attention_mask, position_ids, past_key_values.{i}.{key,value}
+#                 outputs logits, present.{i}.{key,value}; batch, sequence and cache lengths are dynamic
+#   config.json   the model config, read back by onnx_backend.OnnxCausalLM
+#   tokenizer files, so the directory can be served directly as MODEL_PATH
+
+import logging
+import os
+import warnings
+from typing import Optional
+
+import numpy as np
+import onnx
+import torch
+import torch.nn as nn
+from transformers import PreTrainedTokenizerBase
+
+from model import IndieGOForCausalLM
+from onnx_backend import ONNX_MODEL_NAME, OnnxCausalLM, past_input_names, present_output_names
+
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
+
+class _FlatCacheWrapper(nn.Module):
+    """Maps flat past tensors to the model's tuple cache and back, since ONNX graphs take flat inputs"""
+
+    def __init__(self, model: IndieGOForCausalLM):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask, position_ids, *past):
+        past_key_values = tuple(zip(past[::2], past[1::2]))
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=past_key_values,
+            use_cache=True,
+            return_dict=True,
+        )
+        return (outputs.logits,) + tuple(state for layer_past in outputs.past_key_values for state in layer_past)
+
+def _dummy_inputs(model: IndieGOForCausalLM, batch_size: int = 2, seq_length: int = 4, past_length: int = 3):
+    config = model.config
+    head_dim = config.n_embd // config.n_head
+    input_ids = torch.randint(0, config.vocab_size, (batch_size, seq_length))
+    attention_mask = torch.ones((batch_size, past_length + seq_length), dtype=torch.long)
+    position_ids = torch.arange(past_length, past_length + seq_length).expand(batch_size, -1)
+    past = [
+        torch.randn(batch_size, config.n_kv_head, past_length, head_dim)
+        for _ in range(2 * config.n_layer)
+    ]
+    return (input_ids, attention_mask, position_ids, *past)
+
+@torch.no_grad()
+def export_model(
+    model: IndieGOForCausalLM,
+    output_dir: str,
+    opset_version: int = 17,
+    atol: float = 1e-4,
+) -> str:
+    """
+    Export the model and check onnxruntime against PyTorch on fresh inputs.
+
+    The eager attention path is traced, because the exporter cannot convert
+    scaled_dot_product_attention with grouped-query heads. Tracing records
+    the 0/1 padding-mask branch, so packed-document masks from training are
+    not supported by the exported graph.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    model.eval()
+    attn_implementation = model.config._attn_implementation
+    model.config._attn_implementation = "eager"
+    try:
+        onnx_path = _export(model, output_dir, opset_version)
+        _check_export(model, output_dir, atol)
+    finally:
+        model.config._attn_implementation = attn_implementation
+    return onnx_path
+
+def _export(model: IndieGOForCausalLM, output_dir: str, opset_version: int) -> str:
+    past_names = past_input_names(model.config.n_layer)
+    present_names = present_output_names(model.config.n_layer)
+    dynamic_axes = {
+        "input_ids": {0: "batch_size", 1: "sequence_length"},
+        "attention_mask": {0: "batch_size", 1: "total_length"},
+        "position_ids": {0: "batch_size", 1: "sequence_length"},
+        "logits": {0: "batch_size", 1: "sequence_length"},
+        **{name: {0: "batch_size", 2: "past_length"} for name in past_names},
+        **{name: {0: "batch_size", 2: "total_length"} for name in present_names},
+    }
+
+    onnx_path = os.path.join(output_dir, ONNX_MODEL_NAME)
+    logger.info(f"Exporting to {onnx_path}")
+    with warnings.catch_warnings():
+        # Shape-dependent Python branches are expected to be traced as constants
+        warnings.simplefilter("ignore", category=torch.jit.TracerWarning)
+        torch.onnx.export(
+            _FlatCacheWrapper(model).eval(),
+            _dummy_inputs(model),
+            onnx_path,
+            input_names=["input_ids", "attention_mask", "position_ids"] + past_names,
+            output_names=["logits"] + present_names,
+            dynamic_axes=dynamic_axes,
+            opset_version=opset_version,
+            dynamo=False,
+        )
+    onnx.checker.check_model(onnx_path)
+    model.config.save_pretrained(output_dir)
+    return onnx_path
+
+def _check_export(model: IndieGOForCausalLM, output_dir: str, atol: float) -> None:
+    """A prefill without cache and a single cached decode step, at shapes other than the traced ones"""
+    onnx_model = OnnxCausalLM(output_dir)
+    for batch_size, seq_length, past_length in ((1, 7, 0), (3, 1, 5)):
+        input_ids, attention_mask, position_ids, *past = _dummy_inputs(
+            model, batch_size, seq_length, past_length
+        )
+        past_key_values = tuple(zip(past[::2], past[1::2])) if past_length else None
+        expected = model(
+            input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=past_key_values,
+            use_cache=True,
+        ).logits
+        actual = onnx_model(
+            input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=past_key_values,
+        ).logits
+        max_diff = (expected - actual).abs().max().item()
+        if not np.isfinite(max_diff) or max_diff > atol:
+            raise RuntimeError(f"ONNX logits differ from PyTorch by {max_diff} (atol {atol})")
+        logger.info(
+            f"batch {batch_size}, {seq_length} new tokens, {past_length} cached: max logit diff {max_diff:.2e}"
+        )
+
+def export_onnx(
+    model_path: str,
+    output_dir: str,
+    tokenizer_path: Optional[str] = None,
+    opset_version: int = 17,
+    atol: float = 1e-4,
+) -> str:
+    logger.info(f"Loading model from {model_path}")
+    model = IndieGOForCausalLM.from_pretrained(model_path)
+    onnx_path = export_model(model, output_dir, opset_version=opset_version, atol=atol)
+
+    tokenizer = PreTrainedTokenizerBase.from_pretrained(tokenizer_path or model_path)
+    tokenizer.save_pretrained(output_dir)
+    return onnx_path
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_path", type=str, required=True)
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument("--tokenizer_path", type=str)
+    parser.add_argument("--opset_version", type=int, default=17)
+    parser.add_argument("--atol", type=float, default=1e-4, help="Tolerated max logit difference to PyTorch")
+
+    args = parser.parse_args()
+    export_onnx(**vars(args))
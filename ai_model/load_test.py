@@ -0,0 +1,175 @@
+# Load-tests the model server with concurrent clients while checking that /healthz stays responsive
+
+import asyncio
+import itertools
+import logging
+import sys
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import aiohttp
+
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+def _payloads(route: str, prompt: str, max_length: int, repeat_prompt: bool) -> Callable[[], Dict[str, Any]]:
+    """
+    Request bodies for route; unless repeat_prompt, each one's prompt is unique.
+
+    The server caches /analyze and greedy /generate responses, so repeating
+    one prompt would measure cache lookups rather than the model.
+    """
+    indices: Iterator[int] = itertools.count()
+
+    def payload() -> Dict[str, Any]:
+        text = prompt if repeat_prompt else f"{prompt}  # request {next(indices)}"
+        if route == "/analyze":
+            return {"code": text, "max_length": max_length}
+        return {"prompt": text, "max_length": max_length, "do_sample": True}
+    return payload
+
+async def _cache_hits(session: aiohttp.ClientSession, base_url: str) -> Optional[int]:
+    async with session.get(f"{base_url}/metrics") as response:
+        if response.status != 200:
+            return None
+        return (await response.json())["response_cache"]["hits"]
+
+async def _client(
+    session: aiohttp.ClientSession,
+    url: str,
+    payload: Callable[[], Dict[str, Any]],
+    deadline: float,
+    latencies: List[float],
+    statuses: Counter,
+) -> None:
+    while time.monotonic() < deadline:
+        start = time.monotonic()
+        try:
+            async with session.post(url, json=payload()) as response:
+                await response.read()
+                statuses[response.status] += 1
+                if response.status == 200:
+                    latencies.append(time.monotonic() - start)
+                elif response.status == 429:
+                    # Respect the server's backpressure
+                    await asyncio.sleep(float(response.headers.get("Retry-After", "1")))
+        except aiohttp.ClientError as e:
+            statuses[type(e).__name__] += 1
+
+async def _health_probe(
+    session: aiohttp.ClientSession,
+    url: str,
+    interval: float,
+    deadline: float,
+    latencies: List[float],
+) -> None:
+    while time.monotonic() < deadline:
+        start = time.monotonic()
+        try:
+            async with session.get(url) as response:
+                await response.read()
+            latencies.append(time.monotonic() - start)
+        except aiohttp.ClientError:
+            latencies.append(float("inf"))
+        await asyncio.sleep(interval)
+
+async def load_test(
+    base_url: str = "http://localhost:8000",
+    route: str = "/generate",
+    concurrency: int = 16,
+    duration: float = 30.0,
+    prompt: str = "def fibonacci(n):",
+    max_length: int = 128,
+    health_interval: float = 0.25,
+    repeat_prompt: bool = False,
+) -> Dict[str, Any]:
+    payload = _payloads(route, prompt, max_length, repeat_prompt)
+    latencies: List[float] = []
+    health_latencies: List[float] = []
+    statuses: Counter = Counter()
+
+    deadline = time.monotonic() + duration
+    timeout = aiohttp.ClientTimeout(total=None)
+    connector = aiohttp.TCPConnector(limit=concurrency + 1)
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        hits_before = await _cache_hits(session, base_url)
+        await asyncio.gather(
+            _health_probe(session, f"{base_url}/healthz", health_interval, deadline, health_latencies),
+            *[
+                _client(session, f"{base_url}{route}", payload, deadline, latencies, statuses)
+                for _ in range(concurrency)
+            ],
+        )
+        async with session.get(f"{base_url}/metrics") as response:
+            server_metrics = await response.json() if response.status == 200 else None
+
+    # Counted by the worker that answered /metrics; with several workers this is a sample
+    cache_hits = None
+    if hits_before is not None and server_metrics is not None:
+        cache_hits = server_metrics["response_cache"]["hits"] - hits_before
+
+    results = {
+        "statuses": dict(statuses),
+        "response_cache_hits": cache_hits,
+        "requests_per_s": len(latencies) / duration,
+        "latency_p50_s": _percentile(latencies, 0.5),
+        "latency_p95_s": _percentile(latencies, 0.95),
+        "healthz_p50_s": _percentile(health_latencies, 0.5),
+        "healthz_max_s": max(health_latencies, default=float("nan")),
+        "server_metrics": server_metrics,
+    }
+    logger.info(f"Responses by status: {results['statuses']}")
+    logger.info(
+        f"{route}: {results['requests_per_s']:.2f} req/s, "
+        f"p50 {results['latency_p50_s']:.2f} s, p95 {results['latency_p95_s']:.2f} s"
+    )
+    if cache_hits is not None:
+        logger.info(f"Response cache hits: {cache_hits} of {len(latencies)} successful requests")
+    logger.info(
+        f"/healthz: p50 {results['healthz_p50_s'] * 1000:.1f} ms, "
+        f"max {results['healthz_max_s'] * 1000:.1f} ms over {len(health_latencies)} probes"
+    )
+    return results
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base_url", type=str, default="http://localhost:8000")
+    parser.add_argument("--route", type=str, default="/generate", choices=["/generate", "/analyze"])
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds to keep the clients busy")
+    parser.add_argument("--prompt", type=str, default="def fibonacci(n):")
+    parser.add_argument("--max_length", type=int, default=128)
+    parser.add_argument("--health_interval", type=float, default=0.25)
+    parser.add_argument(
+        "--repeat_prompt",
+        action="store_true",
+        help="Send the same prompt every time, i.e. measure the response cache instead of the model",
+    )
+    parser.add_argument(
+        "--max_healthz_latency",
+        type=float,
+        default=0.5,
+        help="Fail (exit code 1) if any /healthz probe took longer than this many seconds",
+    )
+
+    args = parser.parse_args()
+    max_healthz_latency = args.max_healthz_latency
+    del args.max_healthz_latency
+
+    results = asyncio.run(load_test(**vars(args)))
+    if not results["healthz_max_s"] <= max_healthz_latency:
+        logger.error(f"/healthz exceeded {max_healthz_latency} s under load")
+        sys.exit(1)
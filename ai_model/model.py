@@ -1,75 +1,169 @@
 # Defines model architecture, likely based on Deepseek coder v3 or claude 3.5 sonnet and different layers for different tasks
 
 import math
-from dataclasses import dataclass
 from typing import Optional, Tuple
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn import CrossEntropyLoss
-from transformers import PreTrainedModel, PretrainedConfig
+from transformers import GenerationMixin, PreTrainedModel, PretrainedConfig
+from transformers.modeling_outputs import BaseModelOutputWithPast, CausalLMOutputWithPast
+from transformers.utils import logging
+
+logger = logging.get_logger(__name__)
 
-@dataclass
 class IndieGOConfig(PretrainedConfig):
     """Configuration class for IndieGO model."""
-    vocab_size: int = 50257  # GPT-2 vocabulary size
-    n_positions: int = 4096  # Maximum sequence length
-    n_embd: int = 4096  # Embedding dimension
-    n_layer: int = 32  # Number of transformer layers
-    n_head: int = 32  # Number of attention heads
-    n_inner: Optional[int] = None  # Dimension of inner feedforward layer
-    activation_function: str = "gelu_new"
-    resid_pdrop: float = 0.1  # Dropout probability for residual connections
-    embd_pdrop: float = 0.1  # Dropout probability for embeddings
-    attn_pdrop: float = 0.1  # Dropout probability for attention
-    layer_norm_epsilon: float = 1e-5
-    initializer_range: float = 0.02
-    scale_attn_weights: bool = True
-    use_cache: bool = True
-    bos_token_id: int = 50256
-    eos_token_id: int = 50256
-    output_attentions: bool = False
-    output_hidden_states: bool = False
+
+    model_type = "indiego"
+
+    def __init__(
+        self,
+        vocab_size: int = 50257,  # GPT-2 vocabulary size
+        n_positions: int = 4096,  # Maximum sequence length
+        n_embd: int = 4096,  # Embedding dimension
+        n_layer: int = 32,  # Number of transformer layers
+        n_head: int = 32,  # Number of attention heads
+        n_kv_head: Optional[int] = None,  # Key/value heads; None = n_head, 1 = multi-query attention
+        n_inner: Optional[int] = None,  # Dimension of inner feedforward layer
+        position_embedding_type: str = "learned",  # "learned" (wpe table) or "rotary"
+        rope_theta: float = 10000.0,  # Base of the rotary frequencies
+        rope_scaling_factor: float = 1.0,  # Linear position interpolation for longer contexts
+        activation_function: str = "gelu_new",
+        resid_pdrop: float = 0.1,  # Dropout probability for residual connections
+        embd_pdrop: float = 0.1,  # Dropout probability for embeddings
+        attn_pdrop: float = 0.1,  # Dropout probability for attention
+        layer_norm_epsilon: float = 1e-5,
+        initializer_range: float = 0.02,
+        scale_attn_weights: bool = True,
+        use_cache: bool = True,  # Return past key/values for incremental decoding
+        bos_token_id: int = 50256,
+        eos_token_id: int = 50256,
+        tie_word_embeddings: bool = False,  # Share the wte matrix with lm_head instead of a separate one
+        **kwargs,
+    ):
+        self.vocab_size = vocab_size
+        self.n_positions = n_positions
+        self.n_embd = n_embd
+        self.n_layer = n_layer
+        self.n_head = n_head
+        n_kv_head = n_kv_head if n_kv_head is not None else n_head
+        if n_head % n_kv_head != 0:
+            raise ValueError(f"n_head ({n_head}) must be divisible by n_kv_head ({n_kv_head})")
+        self.n_kv_head = n_kv_head
+        self.n_inner = n_inner
+        if position_embedding_type not in ("learned", "rotary"):
+            raise ValueError(f"Unsupported position_embedding_type: {position_embedding_type}")
+        self.position_embedding_type = position_embedding_type
+        self.rope_theta = rope_theta
+        self.rope_scaling_factor = rope_scaling_factor
+        self.activation_function = activation_function
+        self.resid_pdrop = resid_pdrop
+        self.embd_pdrop = embd_pdrop
+        self.attn_pdrop = attn_pdrop
+        self.layer_norm_epsilon = layer_norm_epsilon
+        self.initializer_range = initializer_range
+        self.scale_attn_weights = scale_attn_weights
+        self.use_cache = use_cache
+        super().__init__(
+            bos_token_id=bos_token_id,
+            eos_token_id=eos_token_id,
+            tie_word_embeddings=tie_word_embeddings,
+            **kwargs,
+        )
+
+    @property
+    def max_context_length(self) -> int:
+        """Longest sequence the model serves: n_positions, stretched by rope_scaling_factor for rotary embeddings"""
+        if self.position_embedding_type == "rotary":
+            return int(self.n_positions * self.rope_scaling_factor)
+        return self.n_positions
+
+class IndieGORotaryEmbedding(nn.Module):
+    """
+    Rotary position embeddings (RoPE).
+
+    Rotating queries and keys by their position makes attention scores depend
+    only on relative offsets, so there is no position table to outgrow. With
+    rope_scaling_factor > 1 positions are interpolated, letting a model serve
+    prompts that many times longer than it was trained on.
+    """
+
+    def __init__(self, config):
+        super().__init__()
+        head_dim = config.n_embd // config.n_head
+        if head_dim % 2 != 0:
+            raise ValueError("Rotary embeddings need an even head dimension")
+        self.scaling_factor = config.rope_scaling_factor
+        inv_freq = 1.0 / (
+            config.rope_theta ** (torch.arange(0, head_dim, 2, dtype=torch.float32) / head_dim)
+        )
+        self.register_buffer("inv_freq", inv_freq, persistent=False)
+
+    def forward(self, position_ids: torch.Tensor, dtype: torch.dtype) -> Tuple[torch.Tensor, torch.Tensor]:
+        positions = position_ids.float() / self.scaling_factor
+        freqs = positions[..., None] * self.inv_freq
+        emb = torch.cat((freqs, freqs), dim=-1)
+        # (batch, 1, seq, head_dim), broadcast over heads
+        return emb.cos()[:, None].to(dtype), emb.sin()[:, None].to(dtype)
+
+def _rotate_half(x: torch.Tensor) -> torch.Tensor:
+    x1, x2 = x.chunk(2, dim=-1)
+    return torch.cat((-x2, x1), dim=-1)
+
+def apply_rotary_pos_emb(
+    query: torch.Tensor,
+    key: torch.Tensor,
+    cos: torch.Tensor,
+    sin: torch.Tensor,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    return query * cos + _rotate_half(query) * sin, key * cos + _rotate_half(key) * sin
 
 class IndieGOAttention(nn.Module):
     def __init__(self, config):
         super().__init__()
+        self.config = config
         self.n_head = config.n_head
+        self.n_kv_head = config.n_kv_head
+        # Query heads sharing each key/value head
+        self.n_kv_groups = self.n_head // self.n_kv_head
         self.n_embd = config.n_embd
         self.dropout = config.attn_pdrop
         self.head_dim = self.n_embd // self.n_head
         self.scale = self.head_dim ** -0.5
 
         self.q_proj = nn.Linear(self.n_embd, self.n_embd)
-        self.k_proj = nn.Linear(self.n_embd, self.n_embd)
-        self.v_proj = nn.Linear(self.n_embd, self.n_embd)
+        self.k_proj = nn.Linear(self.n_embd, self.n_kv_head * self.head_dim)
+        self.v_proj = nn.Linear(self.n_embd, self.n_kv_head * self.head_dim)
         self.out_proj = nn.Linear(self.n_embd, self.n_embd)
         
         self.resid_dropout = nn.Dropout(config.resid_pdrop)
 
-    def forward(
+    def _causal_mask(self, query_length: int, key_length: int, device: torch.device) -> torch.Tensor:
+        # Query i (offset by the cached length) only sees keys <= i; built from
+        # aranges rather than tril(diagonal=...) so the offset stays symbolic in ONNX export
+        query_positions = torch.arange(query_length, device=device) + (key_length - query_length)
+        return torch.arange(key_length, device=device)[None, :] <= query_positions[:, None]
+
+    def _attn(
         self,
-        hidden_states: torch.Tensor,
+        query: torch.Tensor,
+        key: torch.Tensor,
+        value: torch.Tensor,
         attention_mask: Optional[torch.Tensor] = None,
         head_mask: Optional[torch.Tensor] = None,
-        output_attentions: bool = False,
-    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
-        batch_size, seq_length = hidden_states.shape[:2]
-
-        # Project queries, keys, and values
-        query = self.q_proj(hidden_states)
-        key = self.k_proj(hidden_states)
-        value = self.v_proj(hidden_states)
-
-        # Reshape for multi-head attention
-        query = query.view(batch_size, seq_length, self.n_head, self.head_dim).transpose(1, 2)
-        key = key.view(batch_size, seq_length, self.n_head, self.head_dim).transpose(1, 2)
-        value = value.view(batch_size, seq_length, self.n_head, self.head_dim).transpose(1, 2)
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Eager attention: materializes the score matrix and returns the weights."""
+        if self.n_kv_groups > 1:
+            key = key.repeat_interleave(self.n_kv_groups, dim=1)
+            value = value.repeat_interleave(self.n_kv_groups, dim=1)
 
-        # Compute attention scores
         attn_weights = torch.matmul(query, key.transpose(-2, -1)) * self.scale
 
+        causal_mask = self._causal_mask(query.size(-2), key.size(-2), attn_weights.device)
+        attn_weights = attn_weights.masked_fill(~causal_mask, torch.finfo(attn_weights.dtype).min)
+
         if attention_mask is not None:
             attn_weights = attn_weights + attention_mask
 
@@ -79,8 +173,84 @@ class IndieGOAttention(nn.Module):
         if head_mask is not None:
             attn_weights = attn_weights * head_mask
 
-        # Compute attention output
         attn_output = torch.matmul(attn_weights, value)
+        return attn_output, attn_weights
+
+    def _sdpa_attn(
+        self,
+        query: torch.Tensor,
+        key: torch.Tensor,
+        value: torch.Tensor,
+        attention_mask: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """Fused attention through torch's scaled_dot_product_attention kernel."""
+        query_length, key_length = query.size(-2), key.size(-2)
+
+        # is_causal aligns the mask to the top-left corner, which is only right
+        # without a cache offset; a single decode step needs no causal mask at all.
+        is_causal = attention_mask is None and query_length == key_length and query_length > 1
+        attn_mask = attention_mask
+        if not is_causal and query_length > 1:
+            causal_mask = self._causal_mask(query_length, key_length, query.device)
+            attn_mask = torch.zeros(
+                query_length, key_length, dtype=query.dtype, device=query.device
+            ).masked_fill(~causal_mask, torch.finfo(query.dtype).min)
+            if attention_mask is not None:
+                attn_mask = attn_mask + attention_mask
+
+        return F.scaled_dot_product_attention(
+            query,
+            key,
+            value,
+            attn_mask=attn_mask,
+            dropout_p=self.dropout if self.training else 0.0,
+            is_causal=is_causal,
+            scale=self.scale,
+            enable_gqa=self.n_kv_groups > 1,
+        )
+
+    def forward(
+        self,
+        hidden_states: torch.Tensor,
+        layer_past: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+        attention_mask: Optional[torch.Tensor] = None,
+        head_mask: Optional[torch.Tensor] = None,
+        use_cache: bool = False,
+        output_attentions: bool = False,
+        rotary_embeddings: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+    ) -> Tuple[torch.Tensor, ...]:
+        batch_size, seq_length = hidden_states.shape[:2]
+
+        # Project queries, keys, and values
+        query = self.q_proj(hidden_states)
+        key = self.k_proj(hidden_states)
+        value = self.v_proj(hidden_states)
+
+        # Reshape for multi-head attention
+        query = query.view(batch_size, seq_length, self.n_head, self.head_dim).transpose(1, 2)
+        key = key.view(batch_size, seq_length, self.n_kv_head, self.head_dim).transpose(1, 2)
+        value = value.view(batch_size, seq_length, self.n_kv_head, self.head_dim).transpose(1, 2)
+
+        # Keys are cached already rotated, so only the new positions are rotated
+        if rotary_embeddings is not None:
+            query, key = apply_rotary_pos_emb(query, key, *rotary_embeddings)
+
+        # Append the new keys/values to the ones cached from previous steps; the cache
+        # holds n_kv_head heads, so grouped-query attention shrinks it n_kv_groups times
+        if layer_past is not None:
+            past_key, past_value = layer_past
+            key = torch.cat((past_key, key), dim=-2)
+            value = torch.cat((past_value, value), dim=-2)
+
+        present = (key, value) if use_cache else None
+
+        # Compute attention output; the fused kernel cannot return weights or apply a head mask
+        attn_weights = None
+        if self.config._attn_implementation == "sdpa" and not output_attentions and head_mask is None:
+            attn_output = self._sdpa_attn(query, key, value, attention_mask)
+        else:
+            attn_output, attn_weights = self._attn(query, key, value, attention_mask, head_mask)
+
         attn_output = attn_output.transpose(1, 2).contiguous()
         attn_output = attn_output.view(batch_size, seq_length, self.n_embd)
 
@@ -88,7 +258,7 @@ class IndieGOAttention(nn.Module):
         attn_output = self.out_proj(attn_output)
         attn_output = self.resid_dropout(attn_output)
 
-        outputs = (attn_output,)
+        outputs = (attn_output, present)
         if output_attentions:
             outputs += (attn_weights,)
 
@@ -121,18 +291,24 @@ class IndieGOBlock(nn.Module):
     def forward(
         self,
         hidden_states: torch.Tensor,
+        layer_past: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
         attention_mask: Optional[torch.Tensor] = None,
         head_mask: Optional[torch.Tensor] = None,
+        use_cache: bool = False,
         output_attentions: bool = False,
+        rotary_embeddings: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
     ) -> Tuple[torch.Tensor, ...]:
         attn_outputs = self.attn(
             self.ln_1(hidden_states),
+            layer_past=layer_past,
             attention_mask=attention_mask,
             head_mask=head_mask,
+            use_cache=use_cache,
             output_attentions=output_attentions,
+            rotary_embeddings=rotary_embeddings,
         )
         attn_output = attn_outputs[0]
-        outputs = attn_outputs[1:]
+        outputs = attn_outputs[1:]  # present, (attentions)
 
         # Residual connection
         hidden_states = hidden_states + attn_output
@@ -141,23 +317,26 @@ class IndieGOBlock(nn.Module):
         feed_forward_hidden_states = self.mlp(self.ln_2(hidden_states))
         hidden_states = hidden_states + feed_forward_hidden_states
 
-        if output_attentions:
-            outputs = (hidden_states,) + outputs
-        else:
-            outputs = (hidden_states,) + outputs[1:]
-
-        return outputs
+        return (hidden_states,) + outputs
 
 class IndieGOModel(PreTrainedModel):
     config_class = IndieGOConfig
     base_model_prefix = "indiego"
+    supports_gradient_checkpointing = True
+    _supports_sdpa = True
 
     def __init__(self, config):
         super().__init__(config)
         self.config = config
+        self.gradient_checkpointing = False
 
         self.wte = nn.Embedding(config.vocab_size, config.n_embd)
-        self.wpe = nn.Embedding(config.n_positions, config.n_embd)
+        if config.position_embedding_type == "rotary":
+            self.wpe = None
+            self.rotary_emb = IndieGORotaryEmbedding(config)
+        else:
+            self.wpe = nn.Embedding(config.n_positions, config.n_embd)
+            self.rotary_emb = None
         self.drop = nn.Dropout(config.embd_pdrop)
         self.h = nn.ModuleList([IndieGOBlock(config) for _ in range(config.n_layer)])
         self.ln_f = nn.LayerNorm(config.n_embd, eps=config.layer_norm_epsilon)
@@ -174,11 +353,13 @@ class IndieGOModel(PreTrainedModel):
     def forward(
         self,
         input_ids: Optional[torch.Tensor] = None,
+        past_key_values: Optional[Tuple[Tuple[torch.Tensor, torch.Tensor], ...]] = None,
         attention_mask: Optional[torch.Tensor] = None,
         token_type_ids: Optional[torch.Tensor] = None,
         position_ids: Optional[torch.Tensor] = None,
         head_mask: Optional[torch.Tensor] = None,
         inputs_embeds: Optional[torch.Tensor] = None,
+        use_cache: Optional[bool] = None,
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
@@ -187,6 +368,7 @@ class IndieGOModel(PreTrainedModel):
         output_hidden_states = (
             output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
         )
+        use_cache = use_cache if use_cache is not None else self.config.use_cache
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
 
         if input_ids is not None and inputs_embeds is not None:
@@ -201,14 +383,35 @@ class IndieGOModel(PreTrainedModel):
         else:
             raise ValueError("You have to specify either input_ids or inputs_embeds")
 
+        if self.gradient_checkpointing and self.training and use_cache:
+            logger.warning_once(
+                "`use_cache=True` is incompatible with gradient checkpointing. Setting `use_cache=False`."
+            )
+            use_cache = False
+
+        if past_key_values is None:
+            past_length = 0
+            past_key_values = tuple([None] * len(self.h))
+        else:
+            past_length = past_key_values[0][0].size(-2)
+
         if position_ids is None:
             device = input_ids.device if input_ids is not None else inputs_embeds.device
-            position_ids = torch.arange(0, input_shape[-1], dtype=torch.long, device=device)
+            position_ids = torch.arange(
+                past_length, input_shape[-1] + past_length, dtype=torch.long, device=device
+            )
             position_ids = position_ids.unsqueeze(0).view(-1, input_shape[-1])
 
         if attention_mask is not None:
             attention_mask = attention_mask.view(batch_size, -1)
-            attention_mask = attention_mask[:, None, None, :]
+            if attention_mask.max() > 1:
+                # Packed sequences number their documents 1, 2, ... (0 is padding);
+                # tokens only attend within their own document
+                segments = attention_mask[:, -input_shape[-1]:]
+                attention_mask = (segments[:, :, None] == attention_mask[:, None, :]) & (attention_mask[:, None, :] > 0)
+                attention_mask = attention_mask[:, None, :, :]
+            else:
+                attention_mask = attention_mask[:, None, None, :]
             attention_mask = attention_mask.to(dtype=self.dtype)
             attention_mask = (1.0 - attention_mask) * -10000.0
 
@@ -217,8 +420,12 @@ class IndieGOModel(PreTrainedModel):
         if inputs_embeds is None:
             inputs_embeds = self.wte(input_ids)
 
-        position_embeds = self.wpe(position_ids)
-        hidden_states = inputs_embeds + position_embeds
+        hidden_states = inputs_embeds
+        rotary_embeddings = None
+        if self.rotary_emb is not None:
+            rotary_embeddings = self.rotary_emb(position_ids, hidden_states.dtype)
+        else:
+            hidden_states = hidden_states + self.wpe(position_ids)
 
         if token_type_ids is not None:
             token_type_embeds = self.wte(token_type_ids)
@@ -226,34 +433,68 @@ class IndieGOModel(PreTrainedModel):
 
         hidden_states = self.drop(hidden_states)
 
+        presents = () if use_cache else None
         all_hidden_states = () if output_hidden_states else None
         all_attentions = () if output_attentions else None
 
-        for i, block in enumerate(self.h):
+        for i, (block, layer_past) in enumerate(zip(self.h, past_key_values)):
             if output_hidden_states:
                 all_hidden_states = all_hidden_states + (hidden_states,)
 
-            outputs = block(
-                hidden_states,
-                attention_mask=attention_mask,
-                head_mask=head_mask[i],
-                output_attentions=output_attentions,
-            )
+            if self.gradient_checkpointing and self.training:
+                # Recompute the block's activations during backward instead of storing them
+                outputs = self._gradient_checkpointing_func(
+                    block.__call__,
+                    hidden_states,
+                    None,
+                    attention_mask,
+                    head_mask[i],
+                    use_cache,
+                    output_attentions,
+                    rotary_embeddings,
+                )
+            else:
+                outputs = block(
+                    hidden_states,
+                    layer_past=layer_past,
+                    attention_mask=attention_mask,
+                    head_mask=head_mask[i],
+                    use_cache=use_cache,
+                    output_attentions=output_attentions,
+                    rotary_embeddings=rotary_embeddings,
+                )
             hidden_states = outputs[0]
 
+            if use_cache:
+                presents = presents + (outputs[1],)
+
             if output_attentions:
-                all_attentions = all_attentions + (outputs[1],)
+                all_attentions = all_attentions + (outputs[2],)
 
         hidden_states = self.ln_f(hidden_states)
 
         if output_hidden_states:
             all_hidden_states = all_hidden_states + (hidden_states,)
 
-        return tuple(v for v in [hidden_states, all_hidden_states, all_attentions] if v is not None)
+        if not return_dict:
+            return tuple(
+                v for v in [hidden_states, presents, all_hidden_states, all_attentions] if v is not None
+            )
 
-class IndieGOForCausalLM(PreTrainedModel):
+        return BaseModelOutputWithPast(
+            last_hidden_state=hidden_states,
+            past_key_values=presents,
+            hidden_states=all_hidden_states,
+            attentions=all_attentions,
+        )
+
+class IndieGOForCausalLM(PreTrainedModel, GenerationMixin):
     config_class = IndieGOConfig
     base_model_prefix = "indiego"
+    supports_gradient_checkpointing = True
+    _supports_sdpa = True
+    # With config.tie_word_embeddings, lm_head shares wte's weight and is not saved separately
+    _tied_weights_keys = ["lm_head.weight"]
 
     def __init__(self, config):
         super().__init__(config)
@@ -263,21 +504,71 @@ class IndieGOForCausalLM(PreTrainedModel):
         # Initialize weights
         self.init_weights()
 
+    def get_input_embeddings(self):
+        return self.transformer.wte
+
+    def set_input_embeddings(self, new_embeddings):
+        self.transformer.wte = new_embeddings
+
     def get_output_embeddings(self):
         return self.lm_head
 
     def set_output_embeddings(self, new_embeddings):
         self.lm_head = new_embeddings
 
+    def prepare_inputs_for_generation(
+        self,
+        input_ids: torch.Tensor,
+        past_key_values: Optional[Tuple[Tuple[torch.Tensor, torch.Tensor], ...]] = None,
+        attention_mask: Optional[torch.Tensor] = None,
+        **kwargs,
+    ):
+        token_type_ids = kwargs.get("token_type_ids", None)
+
+        # Only feed the tokens that are not covered by the cache yet
+        if past_key_values is not None:
+            past_length = past_key_values[0][0].size(-2)
+            input_ids = input_ids[:, past_length:]
+            if token_type_ids is not None:
+                token_type_ids = token_type_ids[:, past_length:]
+
+        # Left padding shifts positions, so derive them from the attention mask
+        position_ids = kwargs.get("position_ids", None)
+        if attention_mask is not None and position_ids is None:
+            position_ids = attention_mask.long().cumsum(-1) - 1
+            position_ids.masked_fill_(attention_mask == 0, 1)
+            position_ids = position_ids[:, -input_ids.shape[1]:]
+
+        return {
+            "input_ids": input_ids,
+            "past_key_values": past_key_values,
+            "use_cache": kwargs.get("use_cache"),
+            "position_ids": position_ids,
+            "attention_mask": attention_mask,
+            "token_type_ids": token_type_ids,
+        }
+
+    @staticmethod
+    def _reorder_cache(
+        past_key_values: Tuple[Tuple[torch.Tensor, torch.Tensor], ...], beam_idx: torch.Tensor
+    ) -> Tuple[Tuple[torch.Tensor, torch.Tensor], ...]:
+        """Reorder the cache to match the selected beams during beam search."""
+        return tuple(
+            tuple(past_state.index_select(0, beam_idx.to(past_state.device)) for past_state in layer_past)
+            for layer_past in past_key_values
+        )
+
     def forward(
         self,
         input_ids: Optional[torch.Tensor] = None,
+        past_key_values: Optional[Tuple[Tuple[torch.Tensor, torch.Tensor], ...]] = None,
         attention_mask: Optional[torch.Tensor] = None,
         token_type_ids: Optional[torch.Tensor] = None,
         position_ids: Optional[torch.Tensor] = None,
         head_mask: Optional[torch.Tensor] = None,
         inputs_embeds: Optional[torch.Tensor] = None,
         labels: Optional[torch.Tensor] = None,
+        use_cache: Optional[bool] = None,
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
@@ -286,11 +577,13 @@ class IndieGOForCausalLM(PreTrainedModel):
 
         transformer_outputs = self.transformer(
             input_ids,
+            past_key_values=past_key_values,
             attention_mask=attention_mask,
             token_type_ids=token_type_ids,
             position_ids=position_ids,
             head_mask=head_mask,
             inputs_embeds=inputs_embeds,
+            use_cache=use_cache,
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
@@ -306,5 +599,14 @@ class IndieGOForCausalLM(PreTrainedModel):
             loss_fct = CrossEntropyLoss()
             loss = loss_fct(shift_logits.view(-1, shift_logits.size(-1)), shift_labels.view(-1))
 
-        output = (lm_logits,) + transformer_outputs[1:]
-        return ((loss,) + output) if loss is not None else output
+        if not return_dict:
+            output = (lm_logits,) + transformer_outputs[1:]
+            return ((loss,) + output) if loss is not None else output
+
+        return CausalLMOutputWithPast(
+            loss=loss,
+            logits=lm_logits,
+            past_key_values=transformer_outputs.past_key_values,
+            hidden_states=transformer_outputs.hidden_states,
+            attentions=transformer_outputs.attentions,
+        )
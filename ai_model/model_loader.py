@@ -0,0 +1,124 @@
+# Fast model startup: builds the model without initializing weights and fills it from memory-mapped safetensors
+
+import json
+import logging
+import mmap
+import os
+from typing import Iterator, List, Optional, Tuple, Union
+
+import torch
+from accelerate import init_empty_weights
+from accelerate.utils import set_module_tensor_to_device
+from safetensors import safe_open
+from transformers import GenerationConfig
+from transformers.modeling_utils import no_init_weights
+from transformers.utils import GENERATION_CONFIG_NAME, SAFE_WEIGHTS_INDEX_NAME, SAFE_WEIGHTS_NAME
+
+from model import IndieGOConfig, IndieGOForCausalLM
+
+logger = logging.getLogger(__name__)
+
+_SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+def safetensors_shards(model_path: str) -> List[str]:
+    """The safetensors files of a local checkpoint, single-file or sharded; empty if there are none"""
+    single = os.path.join(model_path, SAFE_WEIGHTS_NAME)
+    if os.path.isfile(single):
+        return [single]
+    index = os.path.join(model_path, SAFE_WEIGHTS_INDEX_NAME)
+    if os.path.isfile(index):
+        with open(index) as f:
+            weight_map = json.load(f)["weight_map"]
+        return [os.path.join(model_path, shard) for shard in sorted(set(weight_map.values()))]
+    return []
+
+def mapped_tensors(path: str) -> Iterator[Tuple[str, torch.Tensor]]:
+    """
+    The tensors of a safetensors file as CPU views of a private memory map.
+
+    Nothing is read up front: pages are faulted in from the file the first
+    time a tensor is used. The mapping is copy-on-write, so writing a tensor
+    never touches the file, and forked processes share the unmodified pages.
+    """
+    with open(path, "rb") as f:
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    header_size = int.from_bytes(mapping[:8], "little")
+    header = json.loads(mapping[8:8 + header_size])
+    header.pop("__metadata__", None)
+    data_start = 8 + header_size
+    for name, info in header.items():
+        dtype = _SAFETENSORS_DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        itemsize = torch.empty((), dtype=dtype).element_size()
+        if end == begin:
+            tensor = torch.empty(0, dtype=dtype)
+        elif (data_start + begin) % itemsize:
+            # A misaligned view is not safe for every kernel, so copy this one
+            tensor = torch.frombuffer(bytearray(mapping[data_start + begin:data_start + end]), dtype=dtype)
+        else:
+            tensor = torch.frombuffer(mapping, dtype=dtype, count=(end - begin) // itemsize, offset=data_start + begin)
+        yield name, tensor.view(info["shape"])
+
+def load_model(
+    model_path: str,
+    device: Union[str, torch.device] = "cpu",
+    torch_dtype: Optional[torch.dtype] = None,
+) -> IndieGOForCausalLM:
+    """
+    Load a checkpoint written by save_pretrained() straight onto device.
+
+    The model is built with its parameters on the meta device, so the
+    random initialization from_pretrained() runs (and then overwrites) is
+    skipped. On the CPU, without a dtype cast, the parameters are views of
+    the memory-mapped shards and load lazily: startup reads only the
+    headers, and weights are paged in from disk on first use. On other
+    devices each tensor is copied from its shard's mapping when it is
+    assigned, so host memory never holds more than one tensor at a time.
+    Falls back to from_pretrained() for hub ids and non-safetensors checkpoints.
+    """
+    shards = safetensors_shards(model_path) if os.path.isdir(model_path) else []
+    if not shards:
+        logger.info(f"No safetensors weights in {model_path}, using from_pretrained")
+        model = IndieGOForCausalLM.from_pretrained(model_path, torch_dtype=torch_dtype)
+        return model.to(device)
+
+    config = IndieGOConfig.from_pretrained(model_path)
+    # Buffers (e.g. the rotary inv_freq) are not saved, so they are still computed for real
+    with no_init_weights(), init_empty_weights(include_buffers=False):
+        model = IndieGOForCausalLM(config)
+
+    loaded = set()
+    lazy = torch.device(device).type == "cpu"
+    for shard in shards:
+        if lazy:
+            # A view of the right dtype is kept as is; a cast copies only that tensor
+            for name, tensor in mapped_tensors(shard):
+                set_module_tensor_to_device(model, name, device, value=tensor, dtype=torch_dtype)
+                loaded.add(name)
+            continue
+        with safe_open(shard, framework="pt", device=str(device)) as f:
+            for name in f.keys():
+                set_module_tensor_to_device(model, name, device, value=f.get_tensor(name), dtype=torch_dtype)
+                loaded.add(name)
+
+    # Re-point a tied lm_head at the freshly loaded wte weight
+    model.tie_weights()
+    missing = [name for name, param in model.named_parameters() if param.device.type == "meta"]
+    if missing:
+        raise ValueError(f"Checkpoint {model_path} is missing weights: {missing}")
+
+    if os.path.isfile(os.path.join(model_path, GENERATION_CONFIG_NAME)):
+        model.generation_config = GenerationConfig.from_pretrained(model_path)
+    logger.info(f"Loaded {len(loaded)} tensors from {len(shards)} safetensors file(s) in {model_path}")
+    return model.to(device)
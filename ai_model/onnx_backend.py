@@ -0,0 +1,96 @@
+# Runs an IndieGOForCausalLM exported by export_onnx.py through onnxruntime on the CPU
+
+import logging
+import os
+from typing import List, Optional, Tuple
+
+import numpy as np
+import onnxruntime as ort
+import torch
+from transformers.modeling_outputs import CausalLMOutputWithPast
+
+from model import IndieGOConfig
+
+logger = logging.getLogger(__name__)
+
+ONNX_MODEL_NAME = "model.onnx"
+
+PastKeyValues = Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+
+def past_input_names(n_layer: int) -> List[str]:
+    return [f"past_key_values.{i}.{kind}" for i in range(n_layer) for kind in ("key", "value")]
+
+def present_output_names(n_layer: int) -> List[str]:
+    return [f"present.{i}.{kind}" for i in range(n_layer) for kind in ("key", "value")]
+
+class OnnxCausalLM:
+    """
+    Drop-in for the cached forward pass of IndieGOForCausalLM, as used by
+    the batch scheduler: model(input_ids, past_key_values=..., attention_mask=...,
+    position_ids=..., use_cache=True, return_dict=True).
+
+    The session runs on onnxruntime's CPU execution provider with all graph
+    optimizations (constant folding, LayerNorm/GELU/attention fusions) enabled.
+    HF generate() is not available, so beam search and speculative decoding
+    still need the PyTorch model.
+    """
+
+    def __init__(self, model_dir: str, num_threads: Optional[int] = None):
+        self.config = IndieGOConfig.from_pretrained(model_dir)
+        self.head_dim = self.config.n_embd // self.config.n_head
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(
+            os.path.join(model_dir, ONNX_MODEL_NAME),
+            sess_options=options,
+            providers=["CPUExecutionProvider"],
+        )
+        self._past_names = past_input_names(self.config.n_layer)
+        self._output_names = ["logits"] + present_output_names(self.config.n_layer)
+        logger.info(
+            f"Loaded {ONNX_MODEL_NAME} from {model_dir} with providers {self.session.get_providers()}"
+        )
+
+    def _empty_past(self, batch_size: int) -> List[np.ndarray]:
+        shape = (batch_size, self.config.n_kv_head, 0, self.head_dim)
+        return [np.zeros(shape, dtype=np.float32) for _ in self._past_names]
+
+    def __call__(
+        self,
+        input_ids: torch.Tensor,
+        past_key_values: Optional[PastKeyValues] = None,
+        attention_mask: Optional[torch.Tensor] = None,
+        position_ids: Optional[torch.Tensor] = None,
+        use_cache: bool = True,
+        return_dict: bool = True,
+    ) -> CausalLMOutputWithPast:
+        batch_size, seq_length = input_ids.shape
+        if past_key_values is None:
+            past_length = 0
+            past = self._empty_past(batch_size)
+        else:
+            past_length = past_key_values[0][0].size(-2)
+            past = [state.numpy() for layer_past in past_key_values for state in layer_past]
+
+        if attention_mask is None:
+            attention_mask = torch.ones((batch_size, past_length + seq_length), dtype=torch.long)
+        if position_ids is None:
+            position_ids = torch.arange(past_length, past_length + seq_length).expand(batch_size, -1)
+
+        outputs = self.session.run(
+            self._output_names,
+            {
+                "input_ids": input_ids.numpy(),
+                "attention_mask": attention_mask.long().numpy(),
+                "position_ids": position_ids.long().numpy(),
+                **dict(zip(self._past_names, past)),
+            },
+        )
+        presents = [torch.from_numpy(state) for state in outputs[1:]]
+        return CausalLMOutputWithPast(
+            logits=torch.from_numpy(outputs[0]),
+            past_key_values=tuple(zip(presents[::2], presents[1::2])),
+        )
@@ -1,15 +1,17 @@
 import os
 import logging
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterable, Iterator, Optional, Tuple
 import json
 from pathlib import Path
 import random
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
 import requests
 import gzip
+import shutil
 import tarfile
 from tqdm import tqdm
-import pandas as pd
+
+from dedup import DedupStats, MinHashDeduplicator
 
 logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
@@ -18,6 +20,123 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+def reservoir_sample(
+    examples: Iterable[Dict[str, str]],
+    sizes: Dict[str, int],
+    rng: random.Random,
+) -> Tuple[Dict[str, List[Dict[str, str]]], int]:
+    """
+    Draw one independent uniform sample per name from a stream in a single pass.
+    
+    Memory is bounded by the sample sizes, not by the stream length.
+    """
+    reservoirs = {name: [] for name in sizes}
+    count = 0
+    for example in examples:
+        count += 1
+        for name, size in sizes.items():
+            reservoir = reservoirs[name]
+            if len(reservoir) < size:
+                reservoir.append(example)
+            else:
+                j = rng.randrange(count)
+                if j < size:
+                    reservoir[j] = example
+    return reservoirs, count
+
+def merge_reservoirs(
+    shards: List[Tuple[List[Dict[str, str]], int]],
+    size: int,
+    rng: random.Random,
+    deduplicator: Optional[MinHashDeduplicator] = None,
+) -> List[Dict[str, str]]:
+    """
+    Combine per-shard reservoirs into a uniform sample of the union.
+    
+    Each draw picks a shard with probability proportional to the items it has
+    left, then takes a random item from that shard's reservoir. Draws that the
+    deduplicator flags (duplicates across shards) are discarded.
+    """
+    pools = [list(reservoir) for reservoir, _ in shards]
+    remaining = [count for _, count in shards]
+    sample = []
+    while len(sample) < size and any(pools):
+        weights = [count if pool else 0 for pool, count in zip(pools, remaining)]
+        shard = rng.choices(range(len(pools)), weights=weights)[0]
+        pool = pools[shard]
+        example = pool.pop(rng.randrange(len(pool)))
+        remaining[shard] -= 1
+        if deduplicator is None or not deduplicator.is_duplicate(example["text"]):
+            sample.append(example)
+    return sample
+
+def decompress(file_path: Path) -> Path:
+    """
+    Decompress a .gz file next to itself, once, and return the plain file.
+    
+    A gzip stream can only be read from its start, so shards of the
+    compressed file would each have to decompress all of it; shards of the
+    plain file read only their own byte range. This costs the disk space of
+    the uncompressed data.
+    """
+    if file_path.suffix != ".gz":
+        return file_path
+    output_path = file_path.with_suffix("")
+    if output_path.exists() and output_path.stat().st_mtime >= file_path.stat().st_mtime:
+        return output_path
+    
+    logger.info(f"Decompressing {file_path.name}...")
+    tmp_path = output_path.with_name(f"{output_path.name}.tmp")
+    with gzip.open(file_path, "rb") as src, open(tmp_path, "wb") as dst:
+        shutil.copyfileobj(src, dst, length=1 << 20)
+    os.replace(tmp_path, output_path)
+    return output_path
+
+def iter_jsonl_shard(file_path: Path, shard: int = 0, num_shards: int = 1) -> Iterator[Dict[str, Any]]:
+    """
+    Stream the records of one of num_shards contiguous byte ranges of a JSONL file.
+    
+    A record belongs to the shard its line starts in. Gzipped files can only
+    be read whole (num_shards=1); decompress() them first to shard them.
+    """
+    if file_path.suffix == ".gz":
+        if num_shards != 1:
+            raise ValueError(f"Decompress {file_path} before splitting it into shards")
+        with gzip.open(file_path, "rt") as f:
+            for line in f:
+                yield json.loads(line)
+        return
+    
+    size = file_path.stat().st_size
+    start = size * shard // num_shards
+    end = size * (shard + 1) // num_shards
+    with open(file_path, "rb") as f:
+        if start > 0:
+            # Skip the rest of the line that started in the previous shard
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            yield json.loads(line)
+
+def _sample_shard(
+    data_prep: "DataPreparation",
+    processor: str,
+    file_path: Path,
+    shard: int,
+    sizes: Dict[str, int],
+) -> Tuple[Dict[str, List[Dict[str, str]]], int, DedupStats]:
+    """Process-pool entry point: filter, deduplicate and reservoir-sample one shard"""
+    examples = getattr(data_prep, processor)(file_path, shard=shard, num_shards=data_prep.num_workers)
+    deduplicator = data_prep.make_deduplicator()
+    if deduplicator is not None:
+        examples = deduplicator.filter(examples)
+    rng = random.Random(f"{data_prep.random_seed}-{processor}-{shard}")
+    reservoirs, count = reservoir_sample(examples, sizes, rng)
+    return reservoirs, count, deduplicator.stats if deduplicator is not None else DedupStats()
+
 class DataPreparation:
     """Prepare training data for IndieGO model"""
     
@@ -26,17 +145,33 @@ class DataPreparation:
         output_dir: str = "datasets",
         num_workers: int = 4,
         random_seed: int = 42,
+        samples_per_task: int = 1000,
+        validation_ratio: float = 0.1,
+        dedup: bool = True,
+        dedup_capacity: int = 1_000_000,
     ):
         self.output_dir = Path(output_dir)
         self.output_dir.mkdir(parents=True, exist_ok=True)
         self.num_workers = num_workers
-        random.seed(random_seed)
+        self.random_seed = random_seed
+        self.samples_per_task = samples_per_task
+        self.validation_ratio = validation_ratio
+        self.dedup = dedup
+        self.dedup_capacity = dedup_capacity
+        self.dedup_stats: Dict[str, Dict[str, Dict[str, int]]] = {}
+        self.rng = random.Random(random_seed)
         
         # Create subdirectories
         (self.output_dir / "raw").mkdir(exist_ok=True)
         (self.output_dir / "processed").mkdir(exist_ok=True)
         (self.output_dir / "final").mkdir(exist_ok=True)
     
+    def make_deduplicator(self, capacity: Optional[int] = None) -> Optional[MinHashDeduplicator]:
+        """Every shard and merge pass uses the same hash functions so signatures agree"""
+        if not self.dedup:
+            return None
+        return MinHashDeduplicator(seed=self.random_seed, capacity=capacity or self.dedup_capacity)
+    
     def download_dataset(self, url: str, output_path: Path) -> None:
         """Download dataset from URL with progress bar"""
         response = requests.get(url, stream=True)
@@ -73,97 +208,166 @@ class DataPreparation:
             else:
                 logger.info(f"Dataset {name} already exists, skipping download")
     
-    def process_python_code(self, file_path: Path) -> List[Dict[str, str]]:
+    def process_python_code(
+        self,
+        file_path: Path,
+        shard: int = 0,
+        num_shards: int = 1,
+    ) -> Iterator[Dict[str, str]]:
         """Process Python code dataset"""
-        examples = []
-        
-        with gzip.open(file_path, "rt") as f:
-            for line in tqdm(f, desc=f"Processing {file_path.name}"):
-                example = json.loads(line)
-                
-                # Clean and filter code
-                code = example["code"]
-                if len(code.split("\n")) > 5:  # Skip very short snippets
-                    examples.append({
-                        "text": code,
-                        "type": "code",
-                    })
-        
-        return examples
+        for example in tqdm(
+            iter_jsonl_shard(file_path, shard, num_shards),
+            desc=f"Processing {file_path.name} [{shard}]",
+            position=shard,
+        ):
+            # Clean and filter code
+            code = example["code"]
+            if len(code.split("\n")) > 5:  # Skip very short snippets
+                yield {
+                    "text": code,
+                    "type": "code",
+                }
     
-    def process_documentation(self, file_path: Path) -> List[Dict[str, str]]:
+    def process_documentation(
+        self,
+        file_path: Path,
+        shard: int = 0,
+        num_shards: int = 1,
+    ) -> Iterator[Dict[str, str]]:
         """Process documentation dataset"""
-        examples = []
-        
-        with gzip.open(file_path, "rt") as f:
-            for line in tqdm(f, desc=f"Processing {file_path.name}"):
-                example = json.loads(line)
-                
-                # Clean and format documentation
-                doc = example["documentation"]
-                if len(doc) > 100:  # Skip very short docs
-                    examples.append({
-                        "text": doc,
-                        "type": "documentation",
-                    })
-        
-        return examples
+        for example in tqdm(
+            iter_jsonl_shard(file_path, shard, num_shards),
+            desc=f"Processing {file_path.name} [{shard}]",
+            position=shard,
+        ):
+            # Clean and format documentation
+            doc = example["documentation"]
+            if len(doc) > 100:  # Skip very short docs
+                yield {
+                    "text": doc,
+                    "type": "documentation",
+                }
     
-    def process_stackoverflow(self, file_path: Path) -> List[Dict[str, str]]:
+    def process_stackoverflow(
+        self,
+        file_path: Path,
+        shard: int = 0,
+        num_shards: int = 1,
+    ) -> Iterator[Dict[str, str]]:
         """Process Stack Overflow dataset"""
-        examples = []
+        for example in tqdm(
+            iter_jsonl_shard(file_path, shard, num_shards),
+            desc=f"Processing {file_path.name} [{shard}]",
+            position=shard,
+        ):
+            # Format Q&A pairs
+            question = example["question"]
+            answer = example["answer"]
+            
+            if len(question) > 50 and len(answer) > 50:
+                yield {
+                    "text": f"Question: {question}\n\nAnswer: {answer}",
+                    "type": "qa",
+                }
+    
+    def sample_datasets(
+        self,
+        sources: Dict[str, Tuple[str, Path]],
+        sizes: Dict[str, Dict[str, int]],
+    ) -> Dict[str, List[Dict[str, str]]]:
+        """
+        Stream every source through its processor on a process pool.
         
-        with gzip.open(file_path, "rt") as f:
-            for line in tqdm(f, desc=f"Processing {file_path.name}"):
-                example = json.loads(line)
+        Each source is decompressed once and split into num_workers byte
+        ranges; every shard keeps only fixed-size reservoirs, which are merged
+        per task afterwards.
+        """
+        with ProcessPoolExecutor(max_workers=self.num_workers) as pool:
+            decompressed = {
+                name: pool.submit(decompress, file_path) for name, (_, file_path) in sources.items()
+            }
+            sources = {
+                name: (processor, decompressed[name].result()) for name, (processor, _) in sources.items()
+            }
+            futures = {
+                name: [
+                    pool.submit(_sample_shard, self, processor, file_path, shard, sizes[name])
+                    for shard in range(self.num_workers)
+                ]
+                for name, (processor, file_path) in sources.items()
+            }
+            
+            samples = {}
+            for name, shard_futures in futures.items():
+                results = [future.result() for future in shard_futures]
+                total = sum(count for _, count, _ in results)
+                logger.info(f"Kept {total} {name} examples after filtering")
                 
-                # Format Q&A pairs
-                question = example["question"]
-                answer = example["answer"]
+                shard_stats = DedupStats()
+                for _, _, stats in results:
+                    shard_stats = shard_stats.merge(stats)
                 
-                if len(question) > 50 and len(answer) > 50:
-                    examples.append({
-                        "text": f"Question: {question}\n\nAnswer: {answer}",
-                        "type": "qa",
-                    })
-        
-        return examples
+                # Shards only see their own documents, so dedup again across shards while merging
+                merge_stats = DedupStats()
+                for task, size in sizes[name].items():
+                    # The merge pass only sees the reservoirs, so size its filters for them
+                    deduplicator = self.make_deduplicator(
+                        capacity=sum(len(reservoirs[task]) for reservoirs, _, _ in results) or 1
+                    )
+                    samples[task] = merge_reservoirs(
+                        [(reservoirs[task], count) for reservoirs, count, _ in results],
+                        size,
+                        self.rng,
+                        deduplicator=deduplicator,
+                    )
+                    if deduplicator is not None:
+                        merge_stats = merge_stats.merge(deduplicator.stats)
+                
+                if self.dedup:
+                    self.dedup_stats[name] = {
+                        "shards": shard_stats.to_dict(),
+                        "merge": merge_stats.to_dict(),
+                    }
+                    logger.info(
+                        f"Dedup {name}: {shard_stats.exact_duplicates} exact and "
+                        f"{shard_stats.near_duplicates} near duplicates of {shard_stats.seen} "
+                        f"within shards, {merge_stats.exact_duplicates + merge_stats.near_duplicates} "
+                        f"more across shards"
+                    )
+        return samples
     
     def create_training_examples(
         self,
-        code_examples: List[Dict[str, str]],
-        doc_examples: List[Dict[str, str]],
-        qa_examples: List[Dict[str, str]],
-    ) -> List[Dict[str, str]]:
+        explanation_code: Iterable[Dict[str, str]],
+        generation_docs: Iterable[Dict[str, str]],
+        improvement_code: Iterable[Dict[str, str]],
+        qa_examples: Iterable[Dict[str, str]],
+    ) -> Iterator[Dict[str, str]]:
         """Create training examples with different tasks"""
         
-        examples = []
-        
         # Code explanation tasks
-        for code in random.sample(code_examples, min(1000, len(code_examples))):
-            examples.append({
+        for code in explanation_code:
+            yield {
                 "text": f"Explain this code:\n\n{code['text']}\n\nExplanation:",
                 "type": "explanation",
-            })
+            }
         
         # Code generation tasks
-        for doc in random.sample(doc_examples, min(1000, len(doc_examples))):
-            examples.append({
+        for doc in generation_docs:
+            yield {
                 "text": f"Generate code based on this documentation:\n\n{doc['text']}\n\nCode:",
                 "type": "generation",
-            })
+            }
         
         # Code improvement tasks
-        for code in random.sample(code_examples, min(1000, len(code_examples))):
-            examples.append({
+        for code in improvement_code:
+            yield {
                 "text": f"Suggest improvements for this code:\n\n{code['text']}\n\nImprovements:",
                 "type": "improvement",
-            })
+            }
         
         # Q&A tasks
-        examples.extend(random.sample(qa_examples, min(1000, len(qa_examples))))
-        
-        return examples
+        yield from qa_examples
     
     def prepare_data(self):
         """Prepare all training data"""
@@ -172,51 +376,52 @@ class DataPreparation:
         # Download datasets
         self.download_code_datasets()
         
-        # Process datasets
+        # Process and sample datasets
         logger.info("Processing datasets...")
-        code_examples = self.process_python_code(
-            self.output_dir / "raw" / "python-code.jsonl.gz"
-        )
-        doc_examples = self.process_documentation(
-            self.output_dir / "raw" / "python-docs.jsonl.gz"
-        )
-        qa_examples = self.process_stackoverflow(
-            self.output_dir / "raw" / "stackoverflow.jsonl.gz"
+        raw_dir = self.output_dir / "raw"
+        samples = self.sample_datasets(
+            sources={
+                "code": ("process_python_code", raw_dir / "python-code.jsonl.gz"),
+                "documentation": ("process_documentation", raw_dir / "python-docs.jsonl.gz"),
+                "qa": ("process_stackoverflow", raw_dir / "stackoverflow.jsonl.gz"),
+            },
+            sizes={
+                "code": {"explanation": self.samples_per_task, "improvement": self.samples_per_task},
+                "documentation": {"generation": self.samples_per_task},
+                "qa": {"qa": self.samples_per_task},
+            },
         )
         
-        # Create training examples
+        # Create training examples and write the train/val split as we go
         logger.info("Creating training examples...")
         training_examples = self.create_training_examples(
-            code_examples, doc_examples, qa_examples
+            samples["explanation"],
+            samples["generation"],
+            samples["improvement"],
+            samples["qa"],
         )
         
-        # Save processed data
-        logger.info("Saving processed data...")
-        output_path = self.output_dir / "final" / "train.jsonl"
-        with open(output_path, "w") as f:
+        num_train = 0
+        num_val = 0
+        final_dir = self.output_dir / "final"
+        with open(final_dir / "train.jsonl", "w") as train_f, \
+                open(final_dir / "validation.jsonl", "w") as val_f:
             for example in training_examples:
-                f.write(json.dumps(example) + "\n")
+                if self.rng.random() < self.validation_ratio:
+                    val_f.write(json.dumps(example) + "\n")
+                    num_val += 1
+                else:
+                    train_f.write(json.dumps(example) + "\n")
+                    num_train += 1
         
-        # Create train/val split
-        df = pd.DataFrame(training_examples)
-        train_df = df.sample(frac=0.9, random_state=42)
-        val_df = df.drop(train_df.index)
-        
-        train_df.to_json(
-            self.output_dir / "final" / "train.jsonl",
-            orient="records",
-            lines=True,
-        )
-        val_df.to_json(
-            self.output_dir / "final" / "validation.jsonl",
-            orient="records",
-            lines=True,
-        )
+        if self.dedup:
+            with open(final_dir / "dedup_stats.json", "w") as f:
+                json.dump(self.dedup_stats, f, indent=2)
         
         logger.info(
             f"Data preparation complete. "
-            f"Created {len(train_df)} training examples "
-            f"and {len(val_df)} validation examples."
+            f"Created {num_train} training examples "
+            f"and {num_val} validation examples."
         )
 
 if __name__ == "__main__":
@@ -232,8 +437,8 @@ if __name__ == "__main__":
     parser.add_argument(
         "--num_workers",
         type=int,
-        default=4,
-        help="Number of worker threads",
+        default=os.cpu_count() or 4,
+        help="Number of worker processes (input shards per dataset)",
     )
     parser.add_argument(
         "--random_seed",
@@ -241,6 +446,30 @@ if __name__ == "__main__":
         default=42,
         help="Random seed",
     )
+    parser.add_argument(
+        "--samples_per_task",
+        type=int,
+        default=1000,
+        help="Examples sampled for each training task",
+    )
+    parser.add_argument(
+        "--validation_ratio",
+        type=float,
+        default=0.1,
+        help="Fraction of examples written to validation.jsonl",
+    )
+    
+    parser.add_argument(
+        "--no_dedup",
+        action="store_true",
+        help="Skip MinHash near-duplicate removal",
+    )
+    parser.add_argument(
+        "--dedup_capacity",
+        type=int,
+        default=1_000_000,
+        help="Unique documents per shard the dedup filters are sized for (~42 MB per million)",
+    )
     
     args = parser.parse_args()
     
@@ -248,5 +477,9 @@ if __name__ == "__main__":
         output_dir=args.output_dir,
         num_workers=args.num_workers,
         random_seed=args.random_seed,
+        samples_per_task=args.samples_per_task,
+        validation_ratio=args.validation_ratio,
+        dedup=not args.no_dedup,
+        dedup_capacity=args.dedup_capacity,
     )
     data_prep.prepare_data() 
\ No newline at end of file
@@ -0,0 +1,142 @@
+# Tokenizes a training corpus once into a flat binary token file for memory-mapped training
+#
+# Output for --output_prefix data/train:
+#   data/train.bin      token ids of every document back to back (uint16, or uint32 for big vocabularies)
+#   data/train.idx.npy  int64 offsets; document i is tokens[offsets[i]:offsets[i + 1]]
+#   data/train.json     dtype, vocabulary size, counts and the size/mtime of the input file
+
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Tuple
+
+import numpy as np
+from transformers import PreTrainedTokenizerBase
+from tqdm.auto import tqdm
+
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
+
+def _paths(path: str) -> Tuple[Path, Path, Path]:
+    prefix = path[:-len(".bin")] if path.endswith(".bin") else path
+    return (
+        Path(f"{prefix}.bin"),
+        Path(f"{prefix}.idx.npy"),
+        Path(f"{prefix}.json"),
+    )
+
+def is_token_file(path: str) -> bool:
+    """Whether path points at the output of pretokenize()"""
+    bin_path, idx_path, meta_path = _paths(path)
+    return bin_path.exists() and idx_path.exists() and meta_path.exists()
+
+def _source_stat(file_path: str) -> Dict[str, Any]:
+    stat = os.stat(file_path)
+    return {"path": os.path.abspath(file_path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def source_changed(path: str) -> bool:
+    """
+    Whether the file a token file was made from has changed since.
+
+    Token files from before the source was recorded count as changed; ones
+    whose source is gone (e.g. shipped without the corpus) as current.
+    """
+    _, _, meta_path = _paths(path)
+    with open(meta_path) as f:
+        source = json.load(f).get("source")
+    if source is None:
+        return True
+    if not os.path.exists(source["path"]):
+        return False
+    return _source_stat(source["path"]) != source
+
+def token_dtype(vocab_size: int) -> np.dtype:
+    return np.dtype(np.uint16) if vocab_size <= np.iinfo(np.uint16).max + 1 else np.dtype(np.uint32)
+
+def iter_documents(file_path: str) -> Iterator[str]:
+    """One document per line; JSONL files (as written by prepare_data.py) use the "text" field"""
+    is_jsonl = file_path.endswith(".jsonl")
+    with open(file_path) as f:
+        for line in f:
+            text = json.loads(line)["text"] if is_jsonl else line.rstrip("\n")
+            if text:
+                yield text
+
+def pretokenize(
+    tokenizer: PreTrainedTokenizerBase,
+    input_file: str,
+    output_prefix: str,
+    batch_size: int = 1000,
+) -> Dict[str, Any]:
+    bin_path, idx_path, meta_path = _paths(output_prefix)
+    bin_path.parent.mkdir(parents=True, exist_ok=True)
+    dtype = token_dtype(len(tokenizer))
+    # Taken before reading, so edits made while tokenizing also mark the output stale
+    source = _source_stat(input_file)
+
+    offsets = [0]
+
+    def flush(batch: List[str], f) -> None:
+        for input_ids in tokenizer(batch)["input_ids"]:
+            np.asarray(input_ids, dtype=dtype).tofile(f)
+            offsets.append(offsets[-1] + len(input_ids))
+
+    with open(bin_path, "wb") as f:
+        batch = []
+        for text in tqdm(iter_documents(input_file), desc=f"Tokenizing {input_file}"):
+            batch.append(text)
+            if len(batch) == batch_size:
+                flush(batch, f)
+                batch = []
+        if batch:
+            flush(batch, f)
+
+    np.save(idx_path, np.asarray(offsets, dtype=np.int64))
+    meta = {
+        "dtype": dtype.name,
+        "vocab_size": len(tokenizer),
+        "num_documents": len(offsets) - 1,
+        "num_tokens": offsets[-1],
+        "source": source,
+    }
+    with open(meta_path, "w") as f:
+        json.dump(meta, f, indent=2)
+
+    logger.info(
+        f"Wrote {meta['num_tokens']} tokens from {meta['num_documents']} documents to {bin_path}"
+    )
+    return meta
+
+def load_token_file(path: str) -> Tuple[np.memmap, np.ndarray]:
+    """Memory-map the tokens and offsets written by pretokenize()"""
+    bin_path, idx_path, meta_path = _paths(path)
+    with open(meta_path) as f:
+        meta = json.load(f)
+    # Copy-on-write, so torch.from_numpy can wrap slices; the file itself is never written
+    tokens = np.memmap(bin_path, dtype=np.dtype(meta["dtype"]), mode="c")
+    offsets = np.load(idx_path, mmap_mode="r")
+    return tokens, offsets
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokenizer_name_or_path", type=str, default="gpt2")
+    parser.add_argument("--input_file", type=str, required=True, help="Text (one document per line) or JSONL file")
+    parser.add_argument("--output_prefix", type=str, required=True)
+    parser.add_argument("--batch_size", type=int, default=1000)
+
+    args = parser.parse_args()
+
+    tokenizer = PreTrainedTokenizerBase.from_pretrained(args.tokenizer_name_or_path)
+    pretokenize(
+        tokenizer=tokenizer,
+        input_file=args.input_file,
+        output_prefix=args.output_prefix,
+        batch_size=args.batch_size,
+    )
@@ -0,0 +1,221 @@
+# Opt-in inference instrumentation: per-layer timing, prefill/decode split, KV-cache size and torch.profiler traces
+
+import logging
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import torch
+from torch.profiler import ProfilerActivity, profile
+
+from model import IndieGOBlock, IndieGOForCausalLM
+
+logger = logging.getLogger(__name__)
+
+def _past_bytes(past_key_values) -> int:
+    if not past_key_values:
+        return 0
+    return sum(state.numel() * state.element_size() for layer_past in past_key_values for state in layer_past)
+
+class InferenceProfiler:
+    """
+    Times IndieGOModel.forward and every IndieGOBlock (split into attention,
+    MLP and the rest) through forward hooks.
+
+    Nothing is attached until enable(), so a disabled profiler costs nothing.
+    Forwards that feed a single new token on top of a cache count as decode
+    steps, everything else (prompts, cached-prefix suffixes, draft
+    verification) as prefill. On CUDA every hook synchronizes, which slows
+    inference down but keeps the wall times honest.
+    """
+
+    def __init__(self, model: IndieGOForCausalLM):
+        self.model = model
+        self.transformer = model.transformer
+        self.blocks: List[IndieGOBlock] = list(self.transformer.h)
+        self._handles = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+        self._trace: Optional[profile] = None
+        self._trace_thread: Optional[int] = None
+        self._trace_path: Optional[str] = None
+        self._trace_remaining = 0
+        # Set when trace() had to attach the hooks itself; they go again once the trace is written
+        self._disable_after_trace = False
+        self.last_trace_path: Optional[str] = None
+        self.reset()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self._handles)
+
+    @property
+    def trace_pending(self) -> bool:
+        return self._trace_path is not None
+
+    def reset(self) -> None:
+        with self._lock:
+            self._phases = {
+                phase: {"forwards": 0, "seconds": 0.0, "tokens": 0}
+                for phase in ("prefill", "decode")
+            }
+            self._layers = [
+                {"calls": 0, "seconds": 0.0, "attention_seconds": 0.0, "mlp_seconds": 0.0}
+                for _ in self.blocks
+            ]
+            self._kv_cache = {"last_bytes": 0, "peak_bytes": 0}
+
+    def enable(self) -> None:
+        # An explicit enable keeps the hooks after a pending trace finishes
+        self._disable_after_trace = False
+        if self.enabled:
+            return
+        self._handles.append(
+            self.transformer.register_forward_pre_hook(self._model_pre_hook, with_kwargs=True)
+        )
+        self._handles.append(
+            self.transformer.register_forward_hook(self._model_hook, with_kwargs=True)
+        )
+        for i, block in enumerate(self.blocks):
+            for module, key in ((block, "seconds"), (block.attn, "attention_seconds"), (block.mlp, "mlp_seconds")):
+                self._handles.append(module.register_forward_pre_hook(self._start))
+                self._handles.append(module.register_forward_hook(self._layer_hook(i, key)))
+        logger.info("Inference profiling enabled")
+
+    def disable(self) -> None:
+        if self.trace_pending:
+            raise RuntimeError("A torch.profiler trace is still being recorded")
+        self._remove_hooks()
+
+    def _remove_hooks(self) -> None:
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+        logger.info("Inference profiling disabled")
+
+    def trace(self, path: str, num_forwards: int = 8) -> None:
+        """
+        Record the next num_forwards forward passes with torch.profiler and write a Chrome trace to path.
+
+        If profiling was off, the hooks are removed again once the trace is written.
+        """
+        if self.trace_pending:
+            raise RuntimeError("A torch.profiler trace is already being recorded")
+        disable_after_trace = not self.enabled
+        self._trace_remaining = num_forwards
+        self._trace_path = path
+        self.enable()
+        self._disable_after_trace = disable_after_trace
+
+    def _now(self) -> float:
+        if torch.cuda.is_available() and self.model.device.type == "cuda":
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _starts(self) -> Dict[int, float]:
+        # Forwards run on the scheduler thread and the solo pool at the same time
+        if not hasattr(self._local, "starts"):
+            self._local.starts = {}
+        return self._local.starts
+
+    def _start(self, module, args) -> None:
+        self._starts()[id(module)] = self._now()
+
+    def _elapsed(self, module) -> Optional[float]:
+        # None when the hooks were attached while this module was already running
+        start = self._starts().pop(id(module), None)
+        return None if start is None else self._now() - start
+
+    def _layer_hook(self, layer: int, key: str):
+        def hook(module, args, output) -> None:
+            elapsed = self._elapsed(module)
+            if elapsed is None:
+                return
+            with self._lock:
+                self._layers[layer][key] += elapsed
+                if key == "seconds":
+                    self._layers[layer]["calls"] += 1
+        return hook
+
+    def _model_pre_hook(self, module, args, kwargs) -> None:
+        # torch.profiler only sees the thread it was started on, so the trace
+        # starts and stops on whichever thread runs the next forward
+        if self._trace_path is not None and self._trace is None:
+            self._trace = profile(
+                activities=[ProfilerActivity.CPU]
+                + ([ProfilerActivity.CUDA] if torch.cuda.is_available() else []),
+                record_shapes=True,
+            )
+            self._trace.__enter__()
+            self._trace_thread = threading.get_ident()
+        self._start(module, args)
+
+    def _model_hook(self, module, args, kwargs, output) -> None:
+        elapsed = self._elapsed(module)
+        if elapsed is None:
+            return
+
+        input_ids = args[0] if args else kwargs.get("input_ids")
+        past_key_values = kwargs.get("past_key_values")
+        if input_ids is not None:
+            batch_size, seq_length = input_ids.shape[:2]
+        else:
+            batch_size, seq_length = kwargs["inputs_embeds"].shape[:2]
+        phase = "decode" if seq_length == 1 and _past_bytes(past_key_values) else "prefill"
+
+        # Tuple outputs (return_dict=False) are not inspected for the cache
+        kv_bytes = _past_bytes(getattr(output, "past_key_values", None))
+        with self._lock:
+            stats = self._phases[phase]
+            stats["forwards"] += 1
+            stats["seconds"] += elapsed
+            stats["tokens"] += batch_size * seq_length
+            self._kv_cache["last_bytes"] = kv_bytes
+            self._kv_cache["peak_bytes"] = max(self._kv_cache["peak_bytes"], kv_bytes)
+
+        if self._trace is not None and self._trace_thread == threading.get_ident():
+            self._trace_remaining -= 1
+            if self._trace_remaining <= 0:
+                self._trace.__exit__(None, None, None)
+                self._trace.export_chrome_trace(self._trace_path)
+                logger.info(f"Wrote torch.profiler trace to {self._trace_path}")
+                self.last_trace_path = self._trace_path
+                self._trace = None
+                self._trace_path = None
+                # Hooks run from a snapshot of the module's hook dicts, so removing them here is safe
+                if self._disable_after_trace:
+                    self._disable_after_trace = False
+                    self._remove_hooks()
+
+    def report(self) -> Dict[str, Any]:
+        with self._lock:
+            phases = {
+                phase: {
+                    **stats,
+                    "tokens_per_s": stats["tokens"] / stats["seconds"] if stats["seconds"] else 0.0,
+                }
+                for phase, stats in self._phases.items()
+            }
+            layers = [
+                {
+                    "layer": i,
+                    **stats,
+                    "other_seconds": stats["seconds"] - stats["attention_seconds"] - stats["mlp_seconds"],
+                }
+                for i, stats in enumerate(self._layers)
+            ]
+            kv_cache = dict(self._kv_cache)
+
+        layer_seconds = sum(layer["seconds"] for layer in layers)
+        return {
+            "enabled": self.enabled,
+            **phases,
+            "kv_cache": kv_cache,
+            "attention_fraction": (
+                sum(layer["attention_seconds"] for layer in layers) / layer_seconds if layer_seconds else 0.0
+            ),
+            "mlp_fraction": sum(layer["mlp_seconds"] for layer in layers) / layer_seconds if layer_seconds else 0.0,
+            "layers": layers,
+            "trace": {"pending": self.trace_pending, "last_path": self.last_trace_path},
+        }
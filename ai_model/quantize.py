@@ -0,0 +1,127 @@
+# Applies dynamic int8 quantization for CPU inference and reports its accuracy/speed trade-off
+
+import copy
+import logging
+import math
+import time
+from typing import Dict, Optional
+
+import torch
+import torch.nn as nn
+from transformers import PreTrainedTokenizerBase
+
+from model import IndieGOForCausalLM
+
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
+
+QUANTIZATION_MODES = ("int8",)
+
+def quantize_model(model: IndieGOForCausalLM, mode: str = "int8") -> IndieGOForCausalLM:
+    """
+    Quantize every nn.Linear (q/k/v/out_proj, fc1/fc2, lm_head) in place.
+
+    Weights are stored as int8 and activations are quantized on the fly, so
+    this only applies to CPU inference on a model in eval mode.
+    """
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError(f"Unsupported quantization mode: {mode}")
+
+    return torch.ao.quantization.quantize_dynamic(
+        model,
+        {nn.Linear},
+        dtype=torch.qint8,
+        inplace=True,
+    )
+
+@torch.no_grad()
+def perplexity(model: IndieGOForCausalLM, input_ids: torch.Tensor, block_size: int) -> float:
+    """Perplexity over non-overlapping blocks of a single token stream"""
+    total_loss = 0.0
+    total_tokens = 0
+    for start in range(0, input_ids.size(1) - 1, block_size):
+        block = input_ids[:, start:start + block_size]
+        if block.size(1) < 2:
+            break
+        outputs = model(block, labels=block, use_cache=False)
+        # The loss is a mean over the block_len - 1 shifted targets
+        total_loss += outputs.loss.item() * (block.size(1) - 1)
+        total_tokens += block.size(1) - 1
+    return math.exp(total_loss / total_tokens)
+
+@torch.no_grad()
+def decode_speed(
+    model: IndieGOForCausalLM,
+    input_ids: torch.Tensor,
+    new_tokens: int,
+    assistant_model: Optional[IndieGOForCausalLM] = None,
+) -> float:
+    """Greedy decode tokens/s from a fixed prompt, optionally with a speculative draft model"""
+    start = time.perf_counter()
+    outputs = model.generate(
+        input_ids,
+        attention_mask=torch.ones_like(input_ids),
+        max_new_tokens=new_tokens,
+        min_new_tokens=new_tokens,
+        do_sample=False,
+        use_cache=True,
+        pad_token_id=model.config.eos_token_id,
+        assistant_model=assistant_model,
+    )
+    elapsed = time.perf_counter() - start
+    return (outputs.size(1) - input_ids.size(1)) / elapsed
+
+def report(
+    model_path: str,
+    eval_file: str,
+    tokenizer_path: Optional[str] = None,
+    block_size: int = 512,
+    max_eval_tokens: int = 16384,
+    prompt_length: int = 128,
+    new_tokens: int = 64,
+) -> Dict[str, Dict[str, float]]:
+    tokenizer = PreTrainedTokenizerBase.from_pretrained(tokenizer_path or model_path)
+    with open(eval_file) as f:
+        text = f.read()
+    input_ids = tokenizer(text, return_tensors="pt")["input_ids"][:, :max_eval_tokens]
+    logger.info(f"Evaluating on {input_ids.size(1)} held-out tokens from {eval_file}")
+
+    fp32_model = IndieGOForCausalLM.from_pretrained(model_path).eval()
+    int8_model = quantize_model(copy.deepcopy(fp32_model))
+
+    results = {}
+    for name, model in (("fp32", fp32_model), ("int8", int8_model)):
+        results[name] = {
+            "perplexity": perplexity(model, input_ids, block_size),
+            "tokens_per_s": decode_speed(model, input_ids[:, :prompt_length], new_tokens),
+        }
+        logger.info(
+            f"{name}: perplexity {results[name]['perplexity']:.3f}, "
+            f"{results[name]['tokens_per_s']:.2f} tok/s"
+        )
+
+    logger.info(
+        f"int8 vs fp32: perplexity "
+        f"{results['int8']['perplexity'] / results['fp32']['perplexity'] - 1:+.2%}, "
+        f"speed {results['int8']['tokens_per_s'] / results['fp32']['tokens_per_s']:.2f}x"
+    )
+    return results
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_path", type=str, required=True)
+    parser.add_argument("--eval_file", type=str, required=True, help="Held-out text file")
+    parser.add_argument("--tokenizer_path", type=str)
+    parser.add_argument("--block_size", type=int, default=512)
+    parser.add_argument("--max_eval_tokens", type=int, default=16384)
+    parser.add_argument("--prompt_length", type=int, default=128)
+    parser.add_argument("--new_tokens", type=int, default=64)
+
+    args = parser.parse_args()
+    report(**vars(args))
@@ -0,0 +1,148 @@
+# Content-addressed cache of model server responses with TTL, LRU bound and optional SQLite backing
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+def cache_key(namespace: str, payload: Dict[str, Any]) -> str:
+    """sha256 over the namespace and every request field, independent of field order"""
+    blob = json.dumps({"namespace": namespace, "payload": payload}, sort_keys=True, default=str)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """
+    LRU map from cache_key() to a serialized response.
+
+    Entries expire ttl seconds after they were stored (never if ttl is None
+    or 0). With db_path set, entries are also written to a SQLite table, so
+    the cache survives restarts and can be shared by several server
+    processes on one host; the in-memory LRU stays in front of it for hot keys.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl: Optional[float] = 3600.0,
+        db_path: Optional[str] = None,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+
+        # Opened on first use in each process: a SQLite connection must not cross a fork
+        self.db_path = db_path
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_pid: Optional[int] = None
+        if db_path:
+            logger.info(f"Response cache backed by {db_path}")
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def _connection(self) -> Optional[sqlite3.Connection]:
+        if not self.db_path:
+            return None
+        if self._db is None or self._db_pid != os.getpid():
+            self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._db_pid = os.getpid()
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._db.commit()
+        return self._db
+
+    def _expires_at(self, now: float) -> float:
+        return now + self.ttl if self.ttl else float("inf")
+
+    def get(self, key: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+                self.expirations += 1
+
+            db = self._connection()
+            if db is not None:
+                row = db.execute(
+                    "SELECT value, expires_at FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and row[1] > now:
+                    db.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+                    db.commit()
+                    self._remember(key, row[0], row[1])
+                    self.hits += 1
+                    return row[0]
+
+            self.misses += 1
+            return None
+
+    def put(self, key: str, value: str) -> None:
+        if not self.enabled:
+            return
+        now = time.time()
+        expires_at = self._expires_at(now)
+        with self._lock:
+            self._remember(key, value, expires_at)
+
+            db = self._connection()
+            if db is not None:
+                db.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                    (key, value, expires_at, now),
+                )
+                # Drop expired rows, then the least recently used beyond the size bound
+                db.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+                db.execute(
+                    "DELETE FROM responses WHERE key NOT IN "
+                    "(SELECT key FROM responses ORDER BY accessed_at DESC LIMIT ?)",
+                    (self.max_entries,),
+                )
+                db.commit()
+
+    def _remember(self, key: str, value: str, expires_at: float) -> None:
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "expirations": self.expirations,
+            "evictions": self.evictions,
+        }
+
+    def close(self) -> None:
+        if self._db is not None and self._db_pid == os.getpid():
+            self._db.close()
+        self._db = None
@@ -0,0 +1,218 @@
+# Batched sampling engine: per-row decoding settings applied as tensor ops over a whole decode step
+
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Union
+
+import torch
+import torch.nn.functional as F
+
+@dataclass
+class SamplingParams:
+    """Per-sequence decoding settings supported by the batched decode loop"""
+    max_length: int = 1024
+    min_length: int = 0
+    do_sample: bool = True
+    temperature: float = 1.0
+    top_k: int = 50
+    top_p: float = 1.0
+    repetition_penalty: float = 1.0
+    no_repeat_ngram_size: int = 0
+
+    def validate(self) -> None:
+        """Raise ValueError for settings that would leave no token to pick"""
+        if self.temperature <= 0:
+            raise ValueError(f"temperature must be positive, got {self.temperature}")
+        if not 0 < self.top_p <= 1:
+            raise ValueError(f"top_p must be in (0, 1], got {self.top_p}")
+        if self.top_k < 0:
+            raise ValueError(f"top_k must be non-negative, got {self.top_k}")
+        if self.repetition_penalty <= 0:
+            raise ValueError(f"repetition_penalty must be positive, got {self.repetition_penalty}")
+        if self.no_repeat_ngram_size < 0:
+            raise ValueError(f"no_repeat_ngram_size must be non-negative, got {self.no_repeat_ngram_size}")
+
+# Fills the unused tail of each row of a token history tensor
+HISTORY_PAD = -1
+
+def token_history(token_ids: List[List[int]], device: torch.device, capacity: int = 0) -> torch.Tensor:
+    """(batch, max(length, capacity)) tensor of each row's tokens, left-aligned and padded with HISTORY_PAD"""
+    width = max([capacity] + [len(ids) for ids in token_ids])
+    history = torch.full((len(token_ids), width), HISTORY_PAD, dtype=torch.long)
+    for row, ids in enumerate(token_ids):
+        history[row, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+    return history.to(device)
+
+def seen_tokens(history: torch.Tensor, vocab_size: int) -> torch.Tensor:
+    """(batch, vocab) mask of the tokens each row of a token history contains"""
+    # Padding is scattered into an extra column that is then dropped
+    seen = torch.zeros((history.size(0), vocab_size + 1), dtype=torch.bool, device=history.device)
+    seen.scatter_(1, history.masked_fill(history == HISTORY_PAD, vocab_size), True)
+    return seen[:, :vocab_size]
+
+class SamplingBatch:
+    """
+    The settings and token histories of every row in a decode step, as device tensors.
+
+    Callers that decode step after step should keep the history tensor (see
+    token_history) and the seen-token mask themselves, appending each new
+    token, instead of having both rebuilt from the full histories at every step.
+    """
+
+    def __init__(
+        self,
+        params: List[SamplingParams],
+        history: Union[torch.Tensor, List[List[int]]],
+        device: torch.device,
+        seen: Optional[torch.Tensor] = None,
+    ):
+        self.params = params
+        self.history = history if isinstance(history, torch.Tensor) else token_history(history, device)
+        self.device = device
+        self.seen = seen
+        self.lengths = (self.history != HISTORY_PAD).sum(-1)
+        self.min_length = torch.tensor([p.min_length for p in params], device=device)
+        self.do_sample = torch.tensor([p.do_sample for p in params], device=device)
+        self.temperature = torch.tensor([p.temperature for p in params], dtype=torch.float, device=device)
+        self.top_k = torch.tensor([p.top_k for p in params], device=device)
+        self.top_p = torch.tensor([p.top_p for p in params], dtype=torch.float, device=device)
+        self.repetition_penalty = torch.tensor(
+            [p.repetition_penalty for p in params], dtype=torch.float, device=device
+        )
+
+    def __len__(self) -> int:
+        return len(self.params)
+
+    def seen_mask(self, vocab_size: int) -> torch.Tensor:
+        """(batch, vocab) mask of the tokens each row has already seen"""
+        if self.seen is None:
+            self.seen = seen_tokens(self.history, vocab_size)
+        return self.seen
+
+# Processors take and return (batch, vocab) float logits; they run before greedy/sampled selection
+LogitsProcessor = Callable[[torch.Tensor, SamplingBatch], torch.Tensor]
+
+def repetition_penalty(logits: torch.Tensor, batch: SamplingBatch) -> torch.Tensor:
+    """CTRL-style penalty on every token already in the row: positive scores are divided, negative multiplied"""
+    penalty = batch.repetition_penalty[:, None]
+    if bool((penalty == 1.0).all()):
+        return logits
+    penalized = torch.where(logits < 0, logits * penalty, logits / penalty)
+    return torch.where(batch.seen_mask(logits.size(-1)), penalized, logits)
+
+def no_repeat_ngram(logits: torch.Tensor, batch: SamplingBatch) -> torch.Tensor:
+    """Ban tokens that would complete an n-gram the row already contains"""
+    sizes = torch.tensor([p.no_repeat_ngram_size for p in batch.params], device=logits.device)
+    vocab_size = logits.size(-1)
+    # One pass per distinct n-gram size in the batch, usually a single one
+    for n in sorted({p.no_repeat_ngram_size for p in batch.params} - {0}):
+        if n > batch.history.size(1):
+            continue
+        rows = (sizes == n).nonzero().squeeze(-1)
+        history = batch.history[rows]
+        lengths = batch.lengths[rows, None]
+        # (rows, windows, n): every n-gram, valid while it lies inside the row's tokens
+        ngrams = history.unfold(1, n, 1)
+        starts = torch.arange(ngrams.size(1), device=logits.device)
+        valid = starts + n <= lengths
+        # Banned: the last token of every n-gram whose first n-1 tokens equal the row's last n-1
+        tail = (lengths - n + 1 + torch.arange(n - 1, device=logits.device)).clamp(min=0)
+        matches = valid & (ngrams[:, :, :-1] == history.gather(1, tail)[:, None, :]).all(dim=-1)
+        banned = torch.zeros((len(rows), vocab_size + 1), dtype=torch.bool, device=logits.device)
+        banned.scatter_(1, ngrams[:, :, -1].masked_fill(~matches, vocab_size), True)
+        logits[rows] = logits[rows].masked_fill(banned[:, :vocab_size], -float("inf"))
+    return logits
+
+class Sampler:
+    """
+    Picks the next token for every row of a batch in one pass.
+
+    Each row carries its own SamplingParams, so greedy and sampled requests
+    with different temperatures, top-k/top-p cut-offs and penalties share a
+    decode step. The processors run in order on the raw logits (penalties,
+    bans); then greedy rows take the argmax while sampled rows go through
+    temperature, top-k and top-p and draw from what is left. Extra processors
+    can be plugged in and run after the built-in ones.
+    """
+
+    def __init__(
+        self,
+        eos_token_id: Optional[int] = None,
+        processors: Optional[List[LogitsProcessor]] = None,
+        generator: Optional[torch.Generator] = None,
+    ):
+        self.eos_token_id = eos_token_id
+        self.processors: List[LogitsProcessor] = [repetition_penalty, no_repeat_ngram, self._min_length]
+        self.processors.extend(processors or [])
+        self.generator = generator
+
+    def __call__(
+        self,
+        logits: torch.Tensor,
+        params: List[SamplingParams],
+        history: Union[torch.Tensor, List[List[int]]],
+        seen: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """
+        Return one token id per row given (batch, vocab) logits and each row's tokens so far.
+
+        history holds those tokens as lists or as a token_history tensor;
+        seen optionally is the (batch, vocab) mask of them, see SamplingBatch.
+        """
+        batch = SamplingBatch(params, history, logits.device, seen)
+        logits = self.process(logits, batch)
+        next_ids = torch.argmax(logits, dim=-1)
+        rows = batch.do_sample.nonzero().squeeze(-1)
+        if len(rows) == 0:
+            return next_ids
+
+        candidate_logits, candidate_ids = self._candidates(
+            logits[rows], batch.temperature[rows], batch.top_k[rows], batch.top_p[rows]
+        )
+        probs = F.softmax(candidate_logits, dim=-1)
+        draws = torch.multinomial(probs, num_samples=1, generator=self.generator)
+        next_ids[rows] = candidate_ids.gather(-1, draws).squeeze(-1)
+        return next_ids
+
+    def process(self, logits: torch.Tensor, batch: SamplingBatch) -> torch.Tensor:
+        # Processors may write in place, so never hand them the model's output
+        logits = logits.to(torch.float, copy=True)
+        for processor in self.processors:
+            logits = processor(logits, batch)
+        return logits
+
+    @staticmethod
+    def _candidates(
+        logits: torch.Tensor,
+        temperature: torch.Tensor,
+        top_k: torch.Tensor,
+        top_p: torch.Tensor,
+    ):
+        """
+        The rows' warped logits and token ids, best first, over the largest top_k of the batch.
+
+        Sorting the whole vocabulary dominates the cost of sampling, so unless
+        a row disables top-k only the candidates some row can keep are ranked;
+        smaller cut-offs are masked within them.
+        """
+        vocab_size = logits.size(-1)
+        top_k = torch.where(top_k > 0, top_k.clamp(max=vocab_size), vocab_size)
+        candidate_logits, candidate_ids = torch.topk(logits, int(top_k.max()), dim=-1)
+        candidate_logits = candidate_logits / temperature[:, None]
+
+        ranks = torch.arange(candidate_logits.size(-1), device=logits.device)
+        candidate_logits = candidate_logits.masked_fill(ranks >= top_k[:, None], -float("inf"))
+        if bool((top_p < 1.0).any()):
+            probs = F.softmax(candidate_logits, dim=-1)
+            # Keep the smallest prefix whose mass reaches top_p, and always the best token
+            remove = probs.cumsum(dim=-1) - probs >= top_p[:, None]
+            remove[:, 0] = False
+            candidate_logits = candidate_logits.masked_fill(remove, -float("inf"))
+        return candidate_logits, candidate_ids
+
+    def _min_length(self, logits: torch.Tensor, batch: SamplingBatch) -> torch.Tensor:
+        if self.eos_token_id is None:
+            return logits
+        too_short = batch.lengths < batch.min_length
+        logits[too_short, self.eos_token_id] = -float("inf")
+        return logits
+
@@ -0,0 +1,627 @@
+# Continuous batching scheduler that merges concurrent requests into one decode loop
+
+import asyncio
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple, Union
+
+import torch
+
+from sampling import HISTORY_PAD, Sampler, SamplingParams, seen_tokens, token_history
+
+logger = logging.getLogger(__name__)
+
+PastKeyValues = Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+
+@dataclass
+class _Sequence:
+    prompt_ids: List[int]
+    params: SamplingParams
+    future: asyncio.Future
+    loop: asyncio.AbstractEventLoop
+    generated_ids: List[int] = field(default_factory=list)
+    # Set for streaming requests: receives every new token id, then None
+    token_queue: Optional[asyncio.Queue] = None
+    cancelled: bool = False
+    # Leading prompt tokens that are a shared, cacheable prefix
+    prefix_length: int = 0
+
+    @property
+    def length(self) -> int:
+        return len(self.prompt_ids) + len(self.generated_ids)
+
+class QueueFullError(RuntimeError):
+    """Raised when a request arrives while max_queue_depth requests are already pending"""
+
+def _resolve(loop: asyncio.AbstractEventLoop, future: asyncio.Future, result=None, error=None) -> None:
+    def _set():
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+    loop.call_soon_threadsafe(_set)
+
+def _finish(seq: _Sequence, result=None, error=None) -> None:
+    _resolve(seq.loop, seq.future, result=result, error=error)
+    if seq.token_queue is not None:
+        seq.loop.call_soon_threadsafe(seq.token_queue.put_nowait, None)
+
+def _left_pad(tensor: torch.Tensor, length: int, dim: int) -> torch.Tensor:
+    if length == 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = length
+    return torch.cat((tensor.new_zeros(shape), tensor), dim=dim)
+
+def _right_pad(tensor: torch.Tensor, width: int, value: int) -> torch.Tensor:
+    if tensor.size(1) >= width:
+        return tensor
+    return torch.cat((tensor, tensor.new_full((tensor.size(0), width - tensor.size(1)), value)), dim=1)
+
+class PrefixCache:
+    """
+    LRU cache of prefilled KV states keyed on the token ids of a shared prefix.
+
+    Entries are batch-size-1 past_key_values; the model never modifies cache
+    tensors in place, so an entry can be expanded into many sequences at once.
+    """
+
+    def __init__(self, max_entries: int = 16):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[int, ...], PastKeyValues]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, prefix_ids: Tuple[int, ...]) -> Optional[PastKeyValues]:
+        past_key_values = self._entries.get(prefix_ids)
+        if past_key_values is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(prefix_ids)
+        return past_key_values
+
+    def put(self, prefix_ids: Tuple[int, ...], past_key_values: PastKeyValues) -> None:
+        if self.max_entries <= 0:
+            return
+        self._entries[prefix_ids] = past_key_values
+        self._entries.move_to_end(prefix_ids)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+class BatchScheduler:
+    """
+    Continuous batching over IndieGOForCausalLM.
+
+    Requests are queued from the event loop and picked up by a background
+    thread that keeps one left-padded KV cache for all running sequences.
+    Between decode steps newly queued prompts are prefilled and merged into
+    the batch, and finished sequences are evicted and resolved right away,
+    so short replies never wait for long ones.
+
+    Requests the batched loop cannot serve run on a small dedicated thread
+    pool instead. At most max_queue_depth requests may be pending (queued,
+    decoding or running solo) at once; beyond that new requests are
+    rejected with QueueFullError so callers can shed load.
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        device: str,
+        max_batch_size: int = 8,
+        prefix_cache_size: int = 16,
+        max_queue_depth: int = 64,
+        solo_workers: int = 1,
+        sampler: Optional[Sampler] = None,
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.sampler = sampler or Sampler(tokenizer.eos_token_id)
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_positions = model.config.max_context_length
+        self.vocab_size = model.config.vocab_size
+        self.prefix_cache = PrefixCache(prefix_cache_size)
+        self.max_queue_depth = max_queue_depth
+
+        self._queue: "queue.Queue" = queue.Queue()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._solo_executor = ThreadPoolExecutor(
+            max_workers=solo_workers, thread_name_prefix="solo-inference"
+        )
+
+        # Only touched from the event loop, so no lock is needed
+        self._pending = 0
+        self._solo_running = 0
+        self.requests_total = 0
+        self.rejected_total = 0
+        # Only touched from the scheduler thread
+        self.tokens_generated_total = 0
+        self.decode_steps_total = 0
+        self.last_step_at = time.monotonic()
+
+        # Batched decode state
+        self._active: List[_Sequence] = []
+        self._past: Optional[PastKeyValues] = None
+        self._attention_mask: Optional[torch.Tensor] = None
+        # (batch, tokens) history of every row, left-aligned and padded with HISTORY_PAD,
+        # and the (batch, vocab) mask of the tokens it contains; both grow with each token
+        self._history: Optional[torch.Tensor] = None
+        self._seen: Optional[torch.Tensor] = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="batch-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._solo_executor.shutdown(wait=True)
+
+    @property
+    def is_alive(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def is_full(self) -> bool:
+        return self._pending >= self.max_queue_depth
+
+    def _acquire(self, count: int = 1) -> None:
+        """Admission control, called on the event loop before requests are queued; all or nothing"""
+        if self._pending + count > self.max_queue_depth:
+            self.rejected_total += count
+            raise QueueFullError(f"{self._pending} requests already pending")
+        self._pending += count
+        self.requests_total += count
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending": self._pending,
+            "max_queue_depth": self.max_queue_depth,
+            "queued": self._queue.qsize(),
+            "active_sequences": len(self._active),
+            "solo_running": self._solo_running,
+            "requests_total": self.requests_total,
+            "rejected_total": self.rejected_total,
+            "tokens_generated_total": self.tokens_generated_total,
+            "decode_steps_total": self.decode_steps_total,
+            "seconds_since_last_step": time.monotonic() - self.last_step_at,
+        }
+
+    def _enqueue(
+        self,
+        prompt: str,
+        params: SamplingParams,
+        stream: bool = False,
+        prefix: Optional[str] = None,
+    ) -> _Sequence:
+        seq = self._sequence(prompt, params, stream=stream, prefix=prefix)
+        self._queue.put(seq)
+        return seq
+
+    def _sequence(
+        self,
+        prompt: str,
+        params: SamplingParams,
+        stream: bool = False,
+        prefix: Optional[str] = None,
+    ) -> _Sequence:
+        # Bad settings fail this request here rather than a decode step shared with others
+        params.validate()
+        loop = asyncio.get_running_loop()
+        prompt_ids, prefix_length = self.tokenize(prompt, params.max_length, prefix)
+        seq = _Sequence(
+            prompt_ids=prompt_ids,
+            params=params,
+            future=loop.create_future(),
+            loop=loop,
+            token_queue=asyncio.Queue() if stream else None,
+            prefix_length=prefix_length,
+        )
+
+        def abandon(future: asyncio.Future) -> None:
+            # The caller stopped waiting (client disconnect, timeout): free the slot at the next step
+            if future.cancelled():
+                seq.cancelled = True
+
+        seq.future.add_done_callback(abandon)
+        return seq
+
+    def tokenize(self, prompt: str, max_length: int, prefix: Optional[str] = None) -> Tuple[List[int], int]:
+        """The prompt ids a request starts from, and how many of them belong to the prefix"""
+        # The prefix is tokenized on its own so its ids (and KV) are identical across requests
+        prefix_ids = self.tokenizer(prefix)["input_ids"] if prefix else []
+        prompt_ids = (prefix_ids + self.tokenizer(prompt)["input_ids"])[:min(max_length, self.max_positions)]
+        return prompt_ids, len(prefix_ids)
+
+    async def generate(self, prompt: str, params: SamplingParams, prefix: Optional[str] = None) -> List[int]:
+        """
+        Queue a prompt and wait for its full token sequence (prompt + generated).
+
+        The optional prefix is prepended to the prompt and its KV state is
+        cached, so later requests with the same prefix skip prefilling it.
+        """
+        self._acquire()
+        try:
+            seq = self._enqueue(prompt, params, prefix=prefix)
+            return await seq.future
+        finally:
+            self._pending -= 1
+
+    async def generate_many(
+        self,
+        requests: List[Tuple[str, SamplingParams, Optional[str]]],
+    ) -> List[Union[List[int], Exception]]:
+        """
+        Queue several (prompt, params, prefix) requests at once and wait for all of them.
+
+        The batch is admitted as a whole and every prompt is tokenized before
+        any is queued, so they are prefilled together. Results come back in
+        request order; a request that failed has its exception in its place.
+        """
+        self._acquire(len(requests))
+        try:
+            futures = []
+            sequences = []
+            for prompt, params, prefix in requests:
+                try:
+                    seq = self._sequence(prompt, params, prefix=prefix)
+                except ValueError as e:
+                    future = asyncio.get_running_loop().create_future()
+                    future.set_exception(e)
+                    futures.append(future)
+                    continue
+                sequences.append(seq)
+                futures.append(seq.future)
+            for seq in sequences:
+                self._queue.put(seq)
+            return await asyncio.gather(*futures, return_exceptions=True)
+        finally:
+            self._pending -= len(requests)
+
+    async def stream(
+        self,
+        prompt: str,
+        params: SamplingParams,
+        prefix: Optional[str] = None,
+    ) -> AsyncIterator[int]:
+        """Queue a prompt and yield generated token ids as they are decoded"""
+        self._acquire()
+        seq = None
+        try:
+            seq = self._enqueue(prompt, params, stream=True, prefix=prefix)
+            while True:
+                token_id = await seq.token_queue.get()
+                if token_id is None:
+                    break
+                yield token_id
+            # Surface scheduler errors to the consumer
+            await seq.future
+        finally:
+            self._pending -= 1
+            # Client went away: stop decoding for it at the next step
+            if seq is not None:
+                seq.cancelled = True
+
+    async def run_solo(self, fn: Callable[[], Any]) -> Any:
+        """Run a callable the batched loop cannot serve on the solo worker pool"""
+        self._acquire()
+        self._solo_running += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._solo_executor, self._call_no_grad, fn)
+        finally:
+            self._solo_running -= 1
+            self._pending -= 1
+
+    @staticmethod
+    def _call_no_grad(fn: Callable[[], Any]) -> Any:
+        with torch.no_grad():
+            return fn()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            new_sequences = self._admit()
+            with torch.no_grad():
+                if new_sequences:
+                    self._prefill(new_sequences)
+                if not self._active:
+                    continue
+                try:
+                    self._decode_step()
+                except Exception as e:
+                    # A failed batched forward cannot be pinned on one sequence
+                    logger.error(f"Batch scheduler error: {str(e)}")
+                    for seq in self._active:
+                        _finish(seq, error=e)
+                    self._active = []
+                    self._past = None
+                    self._attention_mask = None
+                    self._history = None
+                    self._seen = None
+
+    def _admit(self) -> List[_Sequence]:
+        """Pull queued requests while there is room in the batch"""
+        new_sequences = []
+        while len(self._active) + len(new_sequences) < self.max_batch_size:
+            try:
+                # Block only when there is nothing to decode
+                if self._active or new_sequences:
+                    item = self._queue.get_nowait()
+                else:
+                    item = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                break
+
+            # Prompt already fills max_length, or the client is gone: nothing to generate
+            if item.cancelled or item.length >= min(item.params.max_length, self.max_positions):
+                _finish(item, result=item.prompt_ids)
+                continue
+
+            new_sequences.append(item)
+        return new_sequences
+
+    def _prefill(self, sequences: List[_Sequence]) -> None:
+        """Encode new prompts and merge them into the running cache, one group per shared prefix"""
+        groups: Dict[Tuple[int, ...], List[_Sequence]] = {}
+        for seq in sequences:
+            # Leave at least one prompt token to prefill: its logits pick the first new token
+            cached_length = min(seq.prefix_length, len(seq.prompt_ids) - 1)
+            groups.setdefault(tuple(seq.prompt_ids[:cached_length]), []).append(seq)
+
+        for prefix_ids, group in groups.items():
+            self._prefill_or_isolate(group, prefix_ids)
+
+    def _prefill_or_isolate(self, sequences: List[_Sequence], prefix_ids: Tuple[int, ...]) -> None:
+        """
+        Prefill a group; when that fails, retry its sequences one at a time so
+        only the ones that fail on their own are resolved with the error.
+
+        Merging builds new cache tensors instead of writing into the running
+        ones, so a failed prefill leaves the batch exactly as it was.
+        """
+        state = (list(self._active), self._past, self._attention_mask, self._history, self._seen)
+        try:
+            past_key_values = self._prefix_past(prefix_ids) if prefix_ids else None
+            self._prefill_group(sequences, len(prefix_ids), past_key_values)
+        except Exception as e:
+            self._active, self._past, self._attention_mask, self._history, self._seen = state
+            if len(sequences) > 1:
+                for seq in sequences:
+                    self._prefill_or_isolate([seq], prefix_ids)
+                return
+            logger.error(f"Prefill error: {str(e)}")
+            _finish(sequences[0], error=e)
+
+    def _prefix_past(self, prefix_ids: Tuple[int, ...]) -> PastKeyValues:
+        past_key_values = self.prefix_cache.get(prefix_ids)
+        if past_key_values is None:
+            input_ids = torch.tensor([prefix_ids], dtype=torch.long, device=self.device)
+            past_key_values = self.model(input_ids, use_cache=True, return_dict=True).past_key_values
+            self.prefix_cache.put(prefix_ids, past_key_values)
+        return past_key_values
+
+    def _prefill_group(
+        self,
+        sequences: List[_Sequence],
+        cached_length: int,
+        past_key_values: Optional[PastKeyValues],
+    ) -> None:
+        """
+        Prefill the uncached part of each prompt as one left-padded batch.
+
+        With a cached prefix the row layout is [prefix | padding | rest of
+        prompt]; padding is masked out and positions continue from the prefix.
+        """
+        prompt_length = max(len(seq.prompt_ids) - cached_length for seq in sequences)
+        input_ids = torch.zeros((len(sequences), prompt_length), dtype=torch.long)
+        attention_mask = torch.ones((len(sequences), cached_length + prompt_length), dtype=torch.long)
+        for i, seq in enumerate(sequences):
+            suffix_ids = seq.prompt_ids[cached_length:]
+            input_ids[i, prompt_length - len(suffix_ids):] = torch.tensor(suffix_ids)
+            attention_mask[i, cached_length:cached_length + prompt_length - len(suffix_ids)] = 0
+        input_ids = input_ids.to(self.device)
+        attention_mask = attention_mask.to(self.device)
+
+        if past_key_values is not None:
+            past_key_values = tuple(
+                tuple(state.expand(len(sequences), -1, -1, -1) for state in layer_past)
+                for layer_past in past_key_values
+            )
+
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)[:, cached_length:]
+        outputs = self.model(
+            input_ids,
+            past_key_values=past_key_values,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            use_cache=True,
+            return_dict=True,
+        )
+
+        # Room for every token the group may generate, so appending never has to grow it
+        capacity = max(min(seq.params.max_length, self.max_positions) for seq in sequences)
+        history = token_history([seq.prompt_ids for seq in sequences], self.device, capacity)
+        self._merge(sequences, outputs.past_key_values, attention_mask, history)
+        self._sample_and_retire(outputs.logits[:, -1, :], first_row=len(self._active) - len(sequences))
+
+    def _merge(
+        self,
+        sequences: List[_Sequence],
+        past_key_values: PastKeyValues,
+        attention_mask: torch.Tensor,
+        history: torch.Tensor,
+    ) -> None:
+        seen = seen_tokens(history, self.vocab_size)
+        if self._past is None:
+            self._past = past_key_values
+            self._attention_mask = attention_mask
+            self._history = history
+            self._seen = seen
+        else:
+            current_length = self._attention_mask.shape[1]
+            new_length = attention_mask.shape[1]
+            target = max(current_length, new_length)
+            self._past = tuple(
+                tuple(
+                    torch.cat(
+                        (_left_pad(old, target - current_length, dim=-2), _left_pad(new, target - new_length, dim=-2)),
+                        dim=0,
+                    )
+                    for old, new in zip(old_layer, new_layer)
+                )
+                for old_layer, new_layer in zip(self._past, past_key_values)
+            )
+            self._attention_mask = torch.cat(
+                (
+                    _left_pad(self._attention_mask, target - current_length, dim=1),
+                    _left_pad(attention_mask, target - new_length, dim=1),
+                ),
+                dim=0,
+            )
+            width = max(self._history.size(1), history.size(1))
+            self._history = torch.cat(
+                (_right_pad(self._history, width, HISTORY_PAD), _right_pad(history, width, HISTORY_PAD)), dim=0
+            )
+            self._seen = torch.cat((self._seen, seen), dim=0)
+        self._active.extend(sequences)
+
+    def _decode_step(self) -> None:
+        input_ids = torch.tensor(
+            [[seq.generated_ids[-1]] for seq in self._active], dtype=torch.long, device=self.device
+        )
+        position_ids = torch.tensor(
+            [[seq.length - 1] for seq in self._active], dtype=torch.long, device=self.device
+        )
+        self._attention_mask = torch.cat(
+            (self._attention_mask, self._attention_mask.new_ones((len(self._active), 1))), dim=1
+        )
+
+        outputs = self.model(
+            input_ids,
+            past_key_values=self._past,
+            attention_mask=self._attention_mask,
+            position_ids=position_ids,
+            use_cache=True,
+            return_dict=True,
+        )
+        self._past = outputs.past_key_values
+        self._sample_and_retire(outputs.logits[:, -1, :], first_row=0)
+        self.decode_steps_total += 1
+        self.last_step_at = time.monotonic()
+
+    def _sample_and_retire(self, logits: torch.Tensor, first_row: int) -> None:
+        """Append one token to rows first_row.. and evict the sequences that finished"""
+        sequences = self._active[first_row:first_row + len(logits)]
+        # The history is allocated ahead; the sampler only needs the columns in use
+        history = self._history[first_row:first_row + len(logits), :max(seq.length for seq in sequences)]
+        seen = self._seen[first_row:first_row + len(logits)]
+        try:
+            token_ids = self.sampler(logits, [seq.params for seq in sequences], history, seen).tolist()
+        except Exception as e:
+            # Sample row by row to find the sequences that break the sampler and keep the rest
+            logger.error(f"Sampling error: {str(e)}")
+            token_ids = [
+                self._sample_row(logits[i:i + 1], seq, history[i:i + 1], seen[i:i + 1])
+                for i, seq in enumerate(sequences)
+            ]
+
+        eos_token_id = self.tokenizer.eos_token_id
+        finished = []
+        errors: Dict[int, Exception] = {}
+        appended_rows = []
+        for i, (seq, token_id) in enumerate(zip(sequences, token_ids)):
+            row = first_row + i
+            if isinstance(token_id, Exception):
+                errors[row] = token_id
+                finished.append(row)
+                continue
+            if seq.cancelled:
+                finished.append(row)
+                continue
+
+            seq.generated_ids.append(token_id)
+            appended_rows.append(row)
+            self.tokens_generated_total += 1
+            if seq.token_queue is not None:
+                seq.loop.call_soon_threadsafe(seq.token_queue.put_nowait, token_id)
+
+            max_length = min(seq.params.max_length, self.max_positions)
+            if token_id == eos_token_id or seq.length >= max_length:
+                finished.append(row)
+
+        if appended_rows:
+            rows = torch.tensor(appended_rows, dtype=torch.long, device=self.device)
+            new_ids = torch.tensor(
+                [self._active[row].generated_ids[-1] for row in appended_rows], dtype=torch.long, device=self.device
+            )
+            # Each row's new token goes right after its last one; rows were allocated up to max_length
+            positions = torch.tensor(
+                [self._active[row].length - 1 for row in appended_rows], dtype=torch.long, device=self.device
+            )
+            self._history[rows, positions] = new_ids
+            self._seen[rows, new_ids] = True
+
+        if finished:
+            self._evict(finished, errors)
+
+    def _sample_row(
+        self,
+        logits: torch.Tensor,
+        seq: _Sequence,
+        history: torch.Tensor,
+        seen: torch.Tensor,
+    ) -> Union[int, Exception]:
+        try:
+            return int(self.sampler(logits, [seq.params], history, seen)[0])
+        except Exception as e:
+            return e
+
+    def _evict(self, rows: List[int], errors: Optional[Dict[int, Exception]] = None) -> None:
+        errors = errors or {}
+        for row in rows:
+            seq = self._active[row]
+            if row in errors:
+                _finish(seq, error=errors[row])
+            else:
+                _finish(seq, result=seq.prompt_ids + seq.generated_ids)
+
+        finished = set(rows)
+        keep = [i for i in range(len(self._active)) if i not in finished]
+        self._active = [self._active[i] for i in keep]
+        if not self._active:
+            self._past = None
+            self._attention_mask = None
+            self._history = None
+            self._seen = None
+            return
+
+        index = torch.tensor(keep, dtype=torch.long, device=self.device)
+        attention_mask = self._attention_mask.index_select(0, index)
+
+        # Drop leading columns that are padding for every remaining row
+        start = int((attention_mask.sum(0) > 0).nonzero()[0])
+        self._attention_mask = attention_mask[:, start:]
+        self._history = self._history.index_select(0, index)
+        self._seen = self._seen.index_select(0, index)
+        self._past = tuple(
+            tuple(state.index_select(0, index)[:, :, start:] for state in layer_past)
+            for layer_past in self._past
+        )
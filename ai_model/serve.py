@@ -1,17 +1,24 @@
 # Exposes HTTP endpoint for model inference
 
 import os
+import time
 import logging
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, AsyncIterator, Tuple, Union
 import json
 
 import torch
 import torch.nn.functional as F
 from transformers import PreTrainedTokenizerBase
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, Field
 
-from model import IndieGOConfig, IndieGOForCausalLM
+from model_loader import load_model
+from profiling import InferenceProfiler
+from quantize import quantize_model
+from response_cache import ResponseCache, cache_key
+from sampling import SamplingParams
+from scheduler import BatchScheduler, QueueFullError
 
 logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
@@ -25,18 +32,20 @@ app = FastAPI(title="IndieGO AI Service")
 class GenerationConfig(BaseModel):
     """Configuration for text generation"""
     prompt: str
-    max_length: int = 1024
-    min_length: int = 0
+    # Shared preamble (e.g. a bot personality) put before the prompt; its KV state is cached
+    system_prompt: Optional[str] = None
+    max_length: int = Field(default=1024, ge=1)
+    min_length: int = Field(default=0, ge=0)
     do_sample: bool = True
     early_stopping: bool = False
-    num_beams: int = 1
-    temperature: float = 1.0
-    top_k: int = 50
-    top_p: float = 1.0
-    repetition_penalty: float = 1.0
+    num_beams: int = Field(default=1, ge=1)
+    temperature: float = Field(default=1.0, gt=0)
+    top_k: int = Field(default=50, ge=0)
+    top_p: float = Field(default=1.0, gt=0, le=1)
+    repetition_penalty: float = Field(default=1.0, gt=0)
     length_penalty: float = 1.0
-    no_repeat_ngram_size: int = 0
-    num_return_sequences: int = 1
+    no_repeat_ngram_size: int = Field(default=0, ge=0)
+    num_return_sequences: int = Field(default=1, ge=1)
 
 class CodeAnalysisConfig(BaseModel):
     """Configuration for code analysis"""
@@ -44,42 +53,332 @@ class CodeAnalysisConfig(BaseModel):
     max_length: int = 1024
     analysis_type: str = "all"  # One of: all, security, performance, style
 
+class BatchCodeAnalysisConfig(BaseModel):
+    """Several snippets (e.g. every code block of one message) analyzed in one call"""
+    items: List[CodeAnalysisConfig] = Field(min_length=1, max_length=32)
+
+class ProfileConfig(BaseModel):
+    """Switches for the inference profiler behind /debug/profile"""
+    enabled: Optional[bool] = None
+    reset: bool = False
+    # Record the next N forward passes with torch.profiler (0 = no trace)
+    trace_forwards: int = Field(default=0, ge=0, le=64)
+
 class ModelResponse(BaseModel):
     """Model response format"""
     generated_text: Optional[str] = None
     analysis_results: Optional[Dict[str, Any]] = None
     error: Optional[str] = None
 
+class BatchModelResponse(BaseModel):
+    """One response per item, in request order"""
+    results: List[ModelResponse]
+
 class ModelServer:
     def __init__(
         self,
         model_path: str,
         tokenizer_path: Optional[str] = None,
         device: str = "cuda" if torch.cuda.is_available() else "cpu",
+        max_batch_size: int = 8,
+        prefix_cache_size: int = 16,
+        max_queue_depth: int = 64,
+        solo_workers: int = 1,
+        quantize: Optional[str] = None,
+        draft_model_path: Optional[str] = None,
+        num_speculative_tokens: int = 5,
+        response_cache_size: int = 1024,
+        response_cache_ttl: Optional[float] = 3600.0,
+        response_cache_path: Optional[str] = None,
+        backend: str = "torch",
+        profile_trace_dir: str = "profiles",
     ):
         self.device = device
+        self.backend = backend
+        start = time.perf_counter()
         
         # Load model
-        logger.info(f"Loading model from {model_path}")
-        self.model = IndieGOForCausalLM.from_pretrained(model_path)
-        self.model.to(device)
-        self.model.eval()
+        if backend == "onnx":
+            # model_path is a directory written by export_onnx.py
+            if device != "cpu" or quantize or draft_model_path:
+                raise ValueError("The onnx backend runs on the CPU without QUANTIZE or DRAFT_MODEL_PATH")
+            logger.info(f"Loading ONNX model from {model_path}")
+            # onnxruntime is only needed, and only imported, for this backend
+            from onnx_backend import OnnxCausalLM
+            self.model = OnnxCausalLM(model_path)
+        elif backend == "torch":
+            logger.info(f"Loading model from {model_path}")
+            # No random init; on the CPU the weights stay memory-mapped and are paged in on first use
+            self.model = load_model(model_path, device)
+            self.model.eval()
+        else:
+            raise ValueError(f"Unknown backend: {backend}")
+        logger.info(f"Loaded model in {time.perf_counter() - start:.2f} s")
+        
+        # Dynamic int8 quantization only has CPU kernels
+        if quantize:
+            if device != "cpu":
+                raise ValueError(f"QUANTIZE={quantize} requires the CPU device, got {device}")
+            logger.info(f"Quantizing model to {quantize}")
+            self.model = quantize_model(self.model, quantize)
+        
+        # Optional small model that drafts tokens for speculative decoding
+        self.draft_model = None
+        if draft_model_path:
+            logger.info(f"Loading draft model from {draft_model_path}")
+            draft_start = time.perf_counter()
+            self.draft_model = load_model(draft_model_path, device)
+            if self.draft_model.config.vocab_size != self.model.config.vocab_size:
+                raise ValueError(
+                    f"Draft model vocab size {self.draft_model.config.vocab_size} does not match "
+                    f"the main model's {self.model.config.vocab_size}"
+                )
+            self.draft_model.eval()
+            logger.info(f"Loaded draft model in {time.perf_counter() - draft_start:.2f} s")
+            if quantize:
+                self.draft_model = quantize_model(self.draft_model, quantize)
+            # Draft exactly k tokens per verification pass of the main model
+            self.draft_model.generation_config.num_assistant_tokens = num_speculative_tokens
+            self.draft_model.generation_config.num_assistant_tokens_schedule = "constant"
+        
+        # Opt-in per-layer timing and torch.profiler traces (PyTorch backend only)
+        self.profiler = InferenceProfiler(self.model) if backend == "torch" else None
+        self.profile_trace_dir = profile_trace_dir
         
         # Load tokenizer
         tokenizer_path = tokenizer_path or model_path
         logger.info(f"Loading tokenizer from {tokenizer_path}")
         self.tokenizer = PreTrainedTokenizerBase.from_pretrained(tokenizer_path)
+        
+        # Concurrent requests share one continuously batched decode loop
+        self.scheduler = BatchScheduler(
+            self.model,
+            self.tokenizer,
+            device=device,
+            max_batch_size=max_batch_size,
+            prefix_cache_size=prefix_cache_size,
+            max_queue_depth=max_queue_depth,
+            solo_workers=solo_workers,
+        )
+        
+        # Deterministic responses are reused; the namespace changes whenever the
+        # weights or their quantization do, so a persistent cache never serves stale output
+        self.response_cache = ResponseCache(
+            max_entries=response_cache_size,
+            ttl=response_cache_ttl,
+            db_path=response_cache_path,
+        )
+        self.cache_namespace = self._model_fingerprint(model_path, quantize)
+        logger.info(f"Model server ready {time.perf_counter() - start:.2f} s after start of loading")
+    
+    @staticmethod
+    def _model_fingerprint(model_path: str, quantize: Optional[str]) -> str:
+        mtimes = []
+        if os.path.isdir(model_path):
+            mtimes = sorted(
+                (name, os.path.getmtime(os.path.join(model_path, name)))
+                for name in os.listdir(model_path)
+            )
+        return json.dumps({"model": os.path.abspath(model_path), "mtimes": mtimes, "quantize": quantize})
+    
+    @staticmethod
+    def _is_batchable(config: GenerationConfig) -> bool:
+        # Beam search and multiple return sequences need HF generate
+        return config.num_beams == 1 and config.num_return_sequences == 1
+    
+    def _is_speculative(self, config: GenerationConfig) -> bool:
+        # Assisted decoding verifies a single sequence at a time
+        return (
+            self.draft_model is not None
+            and config.num_beams == 1
+            and config.num_return_sequences == 1
+        )
+    
+    @staticmethod
+    def _is_cacheable(params: SamplingParams) -> bool:
+        """Only deterministic outputs are cached: replaying one sample would pass it off as the answer"""
+        return not params.do_sample
+    
+    @staticmethod
+    def _sampling_params(config: GenerationConfig) -> SamplingParams:
+        return SamplingParams(
+            max_length=config.max_length,
+            min_length=config.min_length,
+            do_sample=config.do_sample,
+            temperature=config.temperature,
+            top_k=config.top_k,
+            top_p=config.top_p,
+            repetition_penalty=config.repetition_penalty,
+            no_repeat_ngram_size=config.no_repeat_ngram_size,
+        )
+    
+    async def agenerate(self, config: GenerationConfig) -> ModelResponse:
+        """Generate through the batch scheduler, serving repeated greedy requests from the cache"""
+        if not self._is_cacheable(self._sampling_params(config)):
+            return await self._agenerate(config)
+        
+        key = cache_key(self.cache_namespace, {"route": "generate", **config.model_dump()})
+        cached = self.response_cache.get(key)
+        if cached is not None:
+            return ModelResponse.model_validate_json(cached)
+        
+        response = await self._agenerate(config)
+        if response.error is None:
+            self.response_cache.put(key, response.model_dump_json())
+        return response
+    
+    async def _agenerate(self, config: GenerationConfig) -> ModelResponse:
+        """Generate through the batch scheduler without blocking the event loop"""
+        # Speculative decoding trades batching for per-request latency
+        if not self._is_batchable(config) or self._is_speculative(config):
+            # An ONNX model only runs forward passes; HF generate needs the torch module
+            if self.backend != "torch":
+                raise HTTPException(
+                    status_code=400,
+                    detail="Beam search, num_return_sequences and speculative decoding require BACKEND=torch",
+                )
+            return await self.scheduler.run_solo(lambda: self.generate(config))
+        
+        try:
+            token_ids = await self.scheduler.generate(
+                config.prompt,
+                self._sampling_params(config),
+                prefix=config.system_prompt,
+            )
+            generated_text = self.tokenizer.decode(token_ids, skip_special_tokens=True)
+            return ModelResponse(generated_text=generated_text)
+        
+        except QueueFullError:
+            raise
+        
+        except Exception as e:
+            logger.error(f"Generation error: {str(e)}")
+            return ModelResponse(error=str(e))
+    
+    async def astream_generate(self, config: GenerationConfig) -> AsyncIterator[str]:
+        """
+        Yield server-sent events carrying the newly decoded text after every step.
+
+        Like /generate, the text starts with the (system) prompt: the events
+        concatenate to the generated_text a /generate call would return.
+        """
+        try:
+            if not self._is_batchable(config):
+                raise ValueError(
+                    "Streaming does not support num_beams or num_return_sequences"
+                )
+            
+            token_ids, _ = self.scheduler.tokenize(config.prompt, config.max_length, config.system_prompt)
+            sent_text = ""
+            async for token_id in self.scheduler.stream(
+                config.prompt,
+                self._sampling_params(config),
+                prefix=config.system_prompt,
+            ):
+                token_ids.append(token_id)
+                text = self.tokenizer.decode(token_ids, skip_special_tokens=True)
+                # Hold back incomplete multi-byte characters until the next token
+                if text.endswith("\ufffd") or len(text) <= len(sent_text):
+                    continue
+                yield f"data: {json.dumps({'text': text[len(sent_text):]})}\n\n"
+                sent_text = text
+            
+            # The prompt alone when nothing was generated, or characters held back at the end
+            text = self.tokenizer.decode(token_ids, skip_special_tokens=True)
+            if len(text) > len(sent_text):
+                yield f"data: {json.dumps({'text': text[len(sent_text):]})}\n\n"
+            yield "data: [DONE]\n\n"
+        
+        except Exception as e:
+            logger.error(f"Generation error: {str(e)}")
+            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+    
+    async def aanalyze_code(self, config: CodeAnalysisConfig) -> ModelResponse:
+        """
+        Analyze code through the batch scheduler without blocking the event loop.
+
+        The same snippet is pasted into !review over and over; analyses are
+        greedy, so like greedy /generate requests they are served from the cache.
+        """
+        prompt, params, prefix = self._analysis_request(config)
+        key = self._analysis_cache_key(config) if self._is_cacheable(params) else None
+        cached = self.response_cache.get(key) if key is not None else None
+        if cached is not None:
+            return ModelResponse.model_validate_json(cached)
+        
+        try:
+            token_ids = await self.scheduler.generate(prompt, params, prefix=prefix)
+            response = self._analysis_response(config, token_ids)
+            if key is not None:
+                self.response_cache.put(key, response.model_dump_json())
+            return response
+        
+        except QueueFullError:
+            raise
+        
+        except Exception as e:
+            logger.error(f"Analysis error: {str(e)}")
+            return ModelResponse(error=str(e))
+    
+    async def aanalyze_batch(self, configs: List[CodeAnalysisConfig]) -> List[ModelResponse]:
+        """
+        Analyze several snippets in one round trip.
+
+        Cached snippets are answered directly; the rest are queued together, so
+        the scheduler prefills them as one padded batch and decodes them side by side.
+        """
+        requests = [self._analysis_request(config) for config in configs]
+        keys = [
+            self._analysis_cache_key(config) if self._is_cacheable(params) else None
+            for config, (_, params, _) in zip(configs, requests)
+        ]
+        responses: List[Optional[ModelResponse]] = []
+        for key in keys:
+            cached = self.response_cache.get(key) if key is not None else None
+            responses.append(ModelResponse.model_validate_json(cached) if cached is not None else None)
+        
+        # Repeated cacheable snippets within the batch are analyzed once, like repeated single requests
+        uncached: Dict[Union[str, int], int] = {}
+        for i, response in enumerate(responses):
+            if response is None:
+                uncached.setdefault(keys[i] or i, i)
+        if uncached:
+            results = await self.scheduler.generate_many([requests[i] for i in uncached.values()])
+            for i, result in zip(uncached.values(), results):
+                if isinstance(result, Exception):
+                    logger.error(f"Analysis error: {str(result)}")
+                    responses[i] = ModelResponse(error=str(result))
+                    continue
+                responses[i] = self._analysis_response(configs[i], result)
+                if keys[i] is not None:
+                    self.response_cache.put(keys[i], responses[i].model_dump_json())
+        return [responses[uncached.get(key or i, i)] for i, key in enumerate(keys)]
+    
+    def _analysis_cache_key(self, config: CodeAnalysisConfig) -> str:
+        return cache_key(self.cache_namespace, {"route": "analyze", **config.model_dump()})
+    
+    def _analysis_request(self, config: CodeAnalysisConfig) -> Tuple[str, SamplingParams, str]:
+        # The fixed template head is a cached prefix shared by every request of that type
+        prefix, prompt = self._analysis_prompt(config)
+        # Greedy, so an analysis is reproducible and can be cached
+        params = SamplingParams(max_length=config.max_length, do_sample=False)
+        return prompt, params, prefix
+    
+    def _analysis_response(self, config: CodeAnalysisConfig, token_ids: List[int]) -> ModelResponse:
+        analysis_text = self.tokenizer.decode(token_ids, skip_special_tokens=True)
+        return ModelResponse(analysis_results=self._parse_analysis(config, analysis_text))
+    
+    def _prompt_inputs(self, prompt: str, max_length: int, prefix: Optional[str] = None) -> Dict[str, torch.Tensor]:
+        """HF generate inputs holding exactly the ids the batch scheduler would start from"""
+        prompt_ids, _ = self.scheduler.tokenize(prompt, max_length, prefix)
+        input_ids = torch.tensor([prompt_ids], device=self.device)
+        return {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
     
     @torch.no_grad()
     def generate(self, config: GenerationConfig) -> ModelResponse:
         try:
-            # Tokenize input
-            inputs = self.tokenizer(
-                config.prompt,
-                return_tensors="pt",
-                truncation=True,
-                max_length=config.max_length,
-            ).to(self.device)
+            # Tokenize input like the batched path, so the path serving a request can't change its output
+            inputs = self._prompt_inputs(config.prompt, config.max_length, config.system_prompt)
             
             # Generate
             outputs = self.model.generate(
@@ -96,8 +395,12 @@ class ModelServer:
                 length_penalty=config.length_penalty,
                 no_repeat_ngram_size=config.no_repeat_ngram_size,
                 num_return_sequences=config.num_return_sequences,
+                use_cache=True,
                 pad_token_id=self.tokenizer.pad_token_id,
                 eos_token_id=self.tokenizer.eos_token_id,
+                # The main model verifies all drafted tokens in one forward pass and keeps
+                # the longest prefix it agrees with, so outputs follow its own distribution
+                assistant_model=self.draft_model if self._is_speculative(config) else None,
             )
             
             # Decode output
@@ -112,35 +415,64 @@ class ModelServer:
             logger.error(f"Generation error: {str(e)}")
             return ModelResponse(error=str(e))
     
+    @staticmethod
+    def _analysis_prompt(config: CodeAnalysisConfig) -> Tuple[str, str]:
+        """The template's fixed head and the request-specific rest of the prompt"""
+        if config.analysis_type == "security":
+            return "Analyze this code for security issues:\n\n", f"{config.code}\n\nSecurity Analysis:"
+        elif config.analysis_type == "performance":
+            return "Analyze this code for performance improvements:\n\n", f"{config.code}\n\nPerformance Analysis:"
+        elif config.analysis_type == "style":
+            return "Analyze this code for style and best practices:\n\n", f"{config.code}\n\nStyle Analysis:"
+        return "Analyze this code comprehensively:\n\n", f"{config.code}\n\nAnalysis:"
+    
+    @staticmethod
+    def _parse_analysis(config: CodeAnalysisConfig, analysis_text: str) -> Dict[str, Any]:
+        # Extract insights from the generated analysis
+        analysis_results = {
+            "type": config.analysis_type,
+            "summary": analysis_text.split("\n")[0],
+            "details": analysis_text.split("\n")[1:],
+        }
+        
+        if config.analysis_type == "all":
+            # Try to categorize insights
+            security_issues = []
+            performance_tips = []
+            style_suggestions = []
+            
+            for line in analysis_text.split("\n"):
+                if "security" in line.lower():
+                    security_issues.append(line)
+                elif "performance" in line.lower():
+                    performance_tips.append(line)
+                elif "style" in line.lower():
+                    style_suggestions.append(line)
+            
+            analysis_results.update({
+                "security_issues": security_issues,
+                "performance_tips": performance_tips,
+                "style_suggestions": style_suggestions,
+            })
+        
+        return analysis_results
+    
     @torch.no_grad()
     def analyze_code(self, config: CodeAnalysisConfig) -> ModelResponse:
         try:
             # Prepare prompt for code analysis
-            if config.analysis_type == "security":
-                prompt = f"Analyze this code for security issues:\n\n{config.code}\n\nSecurity Analysis:"
-            elif config.analysis_type == "performance":
-                prompt = f"Analyze this code for performance improvements:\n\n{config.code}\n\nPerformance Analysis:"
-            elif config.analysis_type == "style":
-                prompt = f"Analyze this code for style and best practices:\n\n{config.code}\n\nStyle Analysis:"
-            else:
-                prompt = f"Analyze this code comprehensively:\n\n{config.code}\n\nAnalysis:"
+            prefix, prompt = self._analysis_prompt(config)
             
             # Generate analysis
-            inputs = self.tokenizer(
-                prompt,
-                return_tensors="pt",
-                truncation=True,
-                max_length=config.max_length,
-            ).to(self.device)
+            inputs = self._prompt_inputs(prompt, config.max_length, prefix)
             
             outputs = self.model.generate(
                 **inputs,
                 max_length=config.max_length,
                 min_length=0,
-                do_sample=True,
-                temperature=0.7,
-                top_p=0.9,
+                do_sample=False,
                 num_return_sequences=1,
+                use_cache=True,
                 pad_token_id=self.tokenizer.pad_token_id,
                 eos_token_id=self.tokenizer.eos_token_id,
             )
@@ -151,34 +483,7 @@ class ModelServer:
                 skip_special_tokens=True,
             )
             
-            # Extract insights from the generated analysis
-            analysis_results = {
-                "type": config.analysis_type,
-                "summary": analysis_text.split("\n")[0],
-                "details": analysis_text.split("\n")[1:],
-            }
-            
-            if config.analysis_type == "all":
-                # Try to categorize insights
-                security_issues = []
-                performance_tips = []
-                style_suggestions = []
-                
-                for line in analysis_text.split("\n"):
-                    if "security" in line.lower():
-                        security_issues.append(line)
-                    elif "performance" in line.lower():
-                        performance_tips.append(line)
-                    elif "style" in line.lower():
-                        style_suggestions.append(line)
-                
-                analysis_results.update({
-                    "security_issues": security_issues,
-                    "performance_tips": performance_tips,
-                    "style_suggestions": style_suggestions,
-                })
-            
-            return ModelResponse(analysis_results=analysis_results)
+            return ModelResponse(analysis_results=self._parse_analysis(config, analysis_text))
         
         except Exception as e:
             logger.error(f"Analysis error: {str(e)}")
@@ -187,33 +492,186 @@ class ModelServer:
 # Initialize model server
 model_server = None
 
+# Per-route request counters for /metrics
+route_metrics: Dict[str, Dict[str, float]] = {}
+
+@app.middleware("http")
+async def record_route_metrics(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    # Key on the route template, not the raw path, so arbitrary URLs can't grow the table
+    route = request.scope.get("route")
+    metrics = route_metrics.setdefault(
+        route.path if route is not None else "unmatched",
+        {"requests": 0, "errors": 0, "rejected": 0, "seconds_total": 0.0},
+    )
+    metrics["requests"] += 1
+    metrics["seconds_total"] += time.perf_counter() - start
+    if response.status_code == 429:
+        metrics["rejected"] += 1
+    elif response.status_code >= 500:
+        metrics["errors"] += 1
+    return response
+
+@app.exception_handler(QueueFullError)
+async def queue_full_handler(request: Request, exc: QueueFullError):
+    return JSONResponse(
+        status_code=429,
+        content={"detail": "Server busy, retry later"},
+        headers={"Retry-After": "1"},
+    )
+
+def _response_cache_ttl() -> Optional[float]:
+    """RESPONSE_CACHE_TTL in seconds; 0 or an empty value means entries never expire"""
+    ttl = os.getenv("RESPONSE_CACHE_TTL", "3600").strip()
+    return float(ttl) if ttl and float(ttl) > 0 else None
+
+def _response_cache_size() -> int:
+    """RESPONSE_CACHE_SIZE entries, or 0 (no caching) when RESPONSE_CACHE_ENABLED is false"""
+    if os.getenv("RESPONSE_CACHE_ENABLED", "true").strip().lower() in ("0", "false", "no", "off"):
+        return 0
+    return int(os.getenv("RESPONSE_CACHE_SIZE", "1024"))
+
+def create_model_server() -> ModelServer:
+    """Build the model server from the environment variables"""
+    return ModelServer(
+        model_path=os.getenv("MODEL_PATH", "checkpoints/best"),
+        tokenizer_path=os.getenv("TOKENIZER_PATH"),
+        max_batch_size=int(os.getenv("MAX_BATCH_SIZE", "8")),
+        prefix_cache_size=int(os.getenv("PREFIX_CACHE_SIZE", "16")),
+        max_queue_depth=int(os.getenv("MAX_QUEUE_DEPTH", "64")),
+        solo_workers=int(os.getenv("SOLO_WORKERS", "1")),
+        quantize=os.getenv("QUANTIZE"),
+        draft_model_path=os.getenv("DRAFT_MODEL_PATH"),
+        num_speculative_tokens=int(os.getenv("NUM_SPECULATIVE_TOKENS", "5")),
+        response_cache_size=_response_cache_size(),
+        response_cache_ttl=_response_cache_ttl(),
+        response_cache_path=os.getenv("RESPONSE_CACHE_PATH"),
+        backend=os.getenv("BACKEND", "torch"),
+        profile_trace_dir=os.getenv("PROFILE_TRACE_DIR", "profiles"),
+    )
+
 @app.on_event("startup")
 async def startup_event():
     global model_server
-    model_path = os.getenv("MODEL_PATH", "checkpoints/best")
-    tokenizer_path = os.getenv("TOKENIZER_PATH")
-    
-    model_server = ModelServer(
-        model_path=model_path,
-        tokenizer_path=tokenizer_path,
-    )
+    # serve_workers.py builds the server before forking, so workers share its weights
+    if model_server is None:
+        model_server = create_model_server()
+    model_server.scheduler.start()
     logger.info("Model server initialized")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    if model_server is not None:
+        model_server.scheduler.stop()
+        model_server.response_cache.close()
+
 @app.post("/generate", response_model=ModelResponse)
 async def generate(config: GenerationConfig):
     if model_server is None:
         raise HTTPException(status_code=503, detail="Model server not initialized")
-    return model_server.generate(config)
+    return await model_server.agenerate(config)
+
+@app.post("/generate/stream")
+async def generate_stream(config: GenerationConfig):
+    """Stream the text of /generate as server-sent events, piece by piece, ending with [DONE]"""
+    if model_server is None:
+        raise HTTPException(status_code=503, detail="Model server not initialized")
+    # Reject before the 200 status line of the stream is sent
+    if model_server.scheduler.is_full:
+        raise QueueFullError("stream rejected")
+    return StreamingResponse(
+        model_server.astream_generate(config),
+        media_type="text/event-stream",
+    )
+
+@app.get("/healthz")
+async def healthz():
+    """Liveness of the event loop and the decode thread; answers even while decoding"""
+    if model_server is None:
+        return JSONResponse(status_code=503, content={"status": "starting"})
+    if not model_server.scheduler.is_alive:
+        return JSONResponse(status_code=503, content={"status": "scheduler stopped"})
+    return {"status": "ok", "pending": model_server.scheduler.stats()["pending"]}
+
+@app.get("/metrics")
+async def metrics():
+    """Scheduler load, cache counters and per-route request counts/latency"""
+    if model_server is None:
+        raise HTTPException(status_code=503, detail="Model server not initialized")
+    return {
+        "worker": {"pid": os.getpid(), "num_threads": torch.get_num_threads()},
+        "scheduler": model_server.scheduler.stats(),
+        "response_cache": model_server.response_cache.stats(),
+        "prefix_cache": model_server.scheduler.prefix_cache.stats(),
+        "routes": route_metrics,
+    }
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """Hit/miss counters of the response cache and the scheduler's prefix cache"""
+    if model_server is None:
+        raise HTTPException(status_code=503, detail="Model server not initialized")
+    return {
+        "response_cache": model_server.response_cache.stats(),
+        "prefix_cache": model_server.scheduler.prefix_cache.stats(),
+    }
+
+def _profiler() -> InferenceProfiler:
+    if model_server is None:
+        raise HTTPException(status_code=503, detail="Model server not initialized")
+    if model_server.profiler is None:
+        raise HTTPException(status_code=400, detail="Profiling needs the torch backend")
+    return model_server.profiler
+
+@app.get("/debug/profile")
+async def get_profile():
+    """Per-layer attention/MLP wall time, prefill vs decode tokens/s and KV-cache size since the last reset"""
+    return _profiler().report()
+
+@app.post("/debug/profile")
+async def configure_profile(config: ProfileConfig):
+    """Turn profiling on or off, reset its counters and/or dump a torch.profiler trace of the next forwards"""
+    profiler = _profiler()
+    # Reject contradictory switches before touching the profiler
+    if config.enabled is False and (config.trace_forwards or profiler.trace_pending):
+        raise HTTPException(status_code=409, detail="Cannot disable profiling while a torch.profiler trace is pending")
+    if config.trace_forwards and profiler.trace_pending:
+        raise HTTPException(status_code=409, detail="A torch.profiler trace is already being recorded")
+    try:
+        if config.reset:
+            profiler.reset()
+        if config.enabled is True:
+            profiler.enable()
+        if config.trace_forwards:
+            os.makedirs(model_server.profile_trace_dir, exist_ok=True)
+            path = os.path.join(
+                model_server.profile_trace_dir, f"trace-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.json"
+            )
+            profiler.trace(path, config.trace_forwards)
+        if config.enabled is False:
+            profiler.disable()
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return profiler.report()
 
 @app.post("/analyze", response_model=ModelResponse)
 async def analyze_code(config: CodeAnalysisConfig):
     if model_server is None:
         raise HTTPException(status_code=503, detail="Model server not initialized")
-    return model_server.analyze_code(config)
+    return await model_server.aanalyze_code(config)
+
+@app.post("/analyze/batch", response_model=BatchModelResponse)
+async def analyze_code_batch(config: BatchCodeAnalysisConfig):
+    """Analyze up to 32 snippets in one call; results are returned in the order of items"""
+    if model_server is None:
+        raise HTTPException(status_code=503, detail="Model server not initialized")
+    return BatchModelResponse(results=await model_server.aanalyze_batch(config.items))
 
 if __name__ == "__main__":
     import uvicorn
     
+    # Development server; serve_workers.py runs several workers that share one copy of the weights
     uvicorn.run(
         "serve:app",
         host="0.0.0.0",
@@ -0,0 +1,156 @@
+# Production launcher: loads the model once, then forks CPU-pinned uvicorn workers that share its weights
+#
+#   MODEL_PATH=checkpoints/best python serve_workers.py --workers 4 --port 8000
+#
+# Workers inherit the weights copy-on-write; since inference never writes to
+# them, N workers cost one copy of the weights plus per-worker activations
+# and KV caches. Every worker owns its own batch scheduler, prefix cache and
+# in-memory response cache (RESPONSE_CACHE_PATH is shared through SQLite).
+
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+import torch
+import uvicorn
+
+import serve
+
+logger = logging.getLogger(__name__)
+
+def core_slices(num_workers: int, cores: Optional[List[int]] = None) -> List[List[int]]:
+    """Split the usable cores into num_workers contiguous, near-equal slices"""
+    cores = sorted(cores if cores is not None else os.sched_getaffinity(0))
+    if num_workers > len(cores):
+        logger.warning(f"{num_workers} workers on {len(cores)} cores: workers will share cores")
+        return [[cores[i % len(cores)]] for i in range(num_workers)]
+    size, extra = divmod(len(cores), num_workers)
+    slices = []
+    start = 0
+    for i in range(num_workers):
+        end = start + size + (1 if i < extra else 0)
+        slices.append(cores[start:end])
+        start = end
+    return slices
+
+def restart_delay(crashes: int, backoff: float, max_backoff: float) -> float:
+    """Seconds to wait before restarting a worker that crashed crashes times in a row"""
+    return min(max_backoff, backoff * 2 ** (crashes - 1))
+
+def _run_worker(sock: socket.socket, cores: List[int], log_level: str) -> None:
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    logger.info(f"Worker {os.getpid()} pinned to cores {cores}")
+
+    config = uvicorn.Config(serve.app, log_level=log_level)
+    uvicorn.Server(config).run(sockets=[sock])
+
+def _spawn(sock: socket.socket, cores: List[int], log_level: str) -> int:
+    pid = os.fork()
+    if pid == 0:
+        exit_code = 0
+        try:
+            _run_worker(sock, cores, log_level)
+        except BaseException:
+            logger.exception("Worker crashed")
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+    return pid
+
+def run(
+    host: str = "0.0.0.0",
+    port: int = 8000,
+    workers: int = 2,
+    log_level: str = "info",
+    max_restarts: int = 5,
+    restart_backoff: float = 1.0,
+    max_backoff: float = 60.0,
+) -> None:
+    if os.getenv("BACKEND", "torch") != "torch":
+        # onnxruntime sessions start their thread pools on creation, which do not survive a fork
+        raise ValueError("serve_workers.py only supports BACKEND=torch")
+
+    slices = core_slices(workers)
+
+    # A single thread in the parent: an OpenMP pool started before fork() can deadlock the children
+    torch.set_num_threads(1)
+    serve.model_server = serve.create_model_server()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    logger.info(f"Listening on {host}:{port} with {workers} workers")
+
+    # pid -> (cores, start time); crashes counts consecutive crashes per core slice
+    children: Dict[int, Tuple[List[int], float]] = {}
+    for cores in slices:
+        children[_spawn(sock, cores, log_level)] = (cores, time.monotonic())
+    crashes: Dict[Tuple[int, ...], int] = {}
+
+    stopping = False
+    failed_cores: Optional[List[int]] = None
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    # Restart workers that die until asked to stop, backing off exponentially so a
+    # worker that crashes on startup can't fork in a tight loop
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        child = children.pop(pid, None)
+        if child is None or stopping:
+            continue
+        cores, started = child
+        # A worker that outlived the longest backoff was healthy; start counting afresh
+        key = tuple(cores)
+        crashes[key] = 1 if time.monotonic() - started > max_backoff else crashes.get(key, 0) + 1
+        if crashes[key] > max_restarts:
+            logger.error(f"Worker {pid} on cores {cores} crashed {crashes[key]} times in a row, stopping")
+            failed_cores = cores
+            stop(signal.SIGTERM, None)
+            continue
+        delay = restart_delay(crashes[key], restart_backoff, max_backoff)
+        logger.error(f"Worker {pid} exited with status {status}, restarting it in {delay:.1f}s")
+        deadline = time.monotonic() + delay
+        while not stopping and time.monotonic() < deadline:
+            time.sleep(min(0.1, deadline - time.monotonic()))
+        if not stopping:
+            children[_spawn(sock, cores, log_level)] = (cores, time.monotonic())
+
+    sock.close()
+    if failed_cores is not None:
+        raise RuntimeError(f"Worker on cores {failed_cores} keeps crashing, giving up after {max_restarts} restarts")
+    logger.info("All workers stopped")
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=2, help="Each worker gets an equal slice of the cores")
+    parser.add_argument("--log_level", type=str, default="info")
+    parser.add_argument("--max_restarts", type=int, default=5, help="Consecutive crashes of a worker before giving up")
+    parser.add_argument("--restart_backoff", type=float, default=1.0, help="Seconds before the first restart, doubled per crash")
+    parser.add_argument("--max_backoff", type=float, default=60.0)
+
+    args = parser.parse_args()
+    if not hasattr(os, "fork") or not hasattr(os, "sched_setaffinity"):
+        sys.exit("serve_workers.py needs fork() and sched_setaffinity(), i.e. Linux")
+    run(**vars(args))
@@ -7,14 +7,19 @@
 # Optimize model
 
 import os
+import json
 import math
+import time
+import shutil
 import logging
-from typing import Optional, Dict, Any
+from contextlib import nullcontext
+from typing import Optional, Dict, Any, List
 
+import numpy as np
 import torch
 import torch.distributed as dist
 import torch.nn.functional as F
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, Subset
 from torch.nn.parallel import DistributedDataParallel
 from transformers import (
     PreTrainedTokenizerBase,
@@ -24,10 +29,11 @@ from transformers import (
 )
 import wandb
 from datasets import load_dataset
-from accelerate import Accelerator
+from accelerate import Accelerator, DataLoaderConfiguration
 from tqdm.auto import tqdm
 
 from model import IndieGOConfig, IndieGOForCausalLM
+from pretokenize import is_token_file, load_token_file, pretokenize, source_changed
 
 logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
@@ -62,9 +68,12 @@ class CodeDataset(Dataset):
                 padding="max_length",
                 return_tensors="pt",
             )
+            input_ids = tokenized["input_ids"].squeeze()
+            attention_mask = tokenized["attention_mask"].squeeze()
             self.examples.append({
-                "input_ids": tokenized["input_ids"].squeeze(),
-                "attention_mask": tokenized["attention_mask"].squeeze(),
+                "input_ids": input_ids,
+                "attention_mask": attention_mask,
+                "labels": input_ids.masked_fill(attention_mask == 0, -100),
             })
 
     def __len__(self):
@@ -72,6 +81,303 @@ class CodeDataset(Dataset):
 
     def __getitem__(self, i):
         return self.examples[i]
+    
+    def token_utilization(self) -> float:
+        """Fraction of the padded positions that hold real tokens"""
+        real_tokens = sum(int(example["attention_mask"].sum()) for example in self.examples)
+        return real_tokens / max(len(self.examples) * self.block_size, 1)
+
+def padded_token_utilization(offsets: np.ndarray, block_size: int) -> float:
+    """Token utilization of one truncated, max_length padded example per document"""
+    lengths = np.minimum(np.diff(offsets), block_size)
+    return float(lengths.sum()) / max(len(lengths) * block_size, 1)
+
+class MemmapCodeDataset(Dataset):
+    """
+    Fixed-length blocks cut from a token file written by pretokenize.py.
+
+    The documents are read as one contiguous token stream and block i is
+    tokens[i * block_size:(i + 1) * block_size], returned as a view of the
+    memory map in the file's integer type (widened on the device by the
+    training loop). Blocks may span documents and the incomplete tail is
+    dropped, so no position is padding; use PackedCodeDataset when documents
+    must not attend to each other.
+    """
+    
+    def __init__(
+        self,
+        file_path: str,
+        block_size: int,
+    ):
+        self.file_path = file_path
+        self.block_size = block_size
+        
+        logger.info(f"Memory-mapping pre-tokenized dataset from {file_path}")
+        _, offsets = load_token_file(file_path)
+        self.num_tokens = int(offsets[-1])
+        if self.num_tokens < block_size:
+            logger.warning(f"{file_path} holds {self.num_tokens} tokens, less than one block of {block_size}")
+        
+        # Opened lazily so every dataloader worker maps the file itself
+        self._tokens = None
+    
+    def __len__(self):
+        return self.num_tokens // self.block_size
+    
+    def __getitem__(self, i):
+        if self._tokens is None:
+            self._tokens, _ = load_token_file(self.file_path)
+        
+        input_ids = torch.from_numpy(self._tokens[i * self.block_size:(i + 1) * self.block_size])
+        return {
+            "input_ids": input_ids,
+            "attention_mask": torch.ones(self.block_size, dtype=torch.long),
+            "labels": input_ids,
+        }
+    
+    def token_utilization(self) -> float:
+        return 1.0
+
+class PackedCodeDataset(Dataset):
+    """
+    Packs a pre-tokenized corpus into dense block_size blocks.
+    
+    Documents are concatenated, each followed by EOS, and the stream is cut
+    into consecutive blocks, so only the last block carries padding. Within a
+    block the attention mask numbers the documents 1, 2, ... so that tokens
+    only attend to their own document, positions count from the start of each
+    document and the first token of each document is excluded from the loss.
+    
+    A document cut by a block boundary keeps counting positions in the next
+    block, unless that would run past max_positions (the model's n_positions);
+    then the continuation starts again at position 0 like a new document.
+    """
+    
+    def __init__(
+        self,
+        file_path: str,
+        block_size: int,
+        eos_token_id: int,
+        pad_token_id: int = 0,
+        max_positions: Optional[int] = None,
+    ):
+        self.file_path = file_path
+        self.block_size = block_size
+        self.eos_token_id = eos_token_id
+        self.pad_token_id = pad_token_id
+        self.max_positions = max_positions
+        
+        logger.info(f"Packing pre-tokenized dataset from {file_path}")
+        _, offsets = load_token_file(file_path)
+        self.num_documents = len(offsets) - 1
+        # Every document contributes one extra EOS token to the stream
+        self.num_tokens = int(offsets[-1]) + self.num_documents
+        
+        # Opened lazily so every dataloader worker maps the file itself
+        self._tokens = None
+        self._offsets = None
+    
+    def __len__(self):
+        return math.ceil(self.num_tokens / self.block_size)
+    
+    def __getitem__(self, i):
+        if self._tokens is None:
+            self._tokens, self._offsets = load_token_file(self.file_path)
+            # Start of each document in the EOS-separated stream
+            self._stream_starts = self._offsets[:-1] + np.arange(self.num_documents)
+        
+        input_ids = torch.full((self.block_size,), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros(self.block_size, dtype=torch.long)
+        position_ids = torch.zeros(self.block_size, dtype=torch.long)
+        labels = torch.full((self.block_size,), -100, dtype=torch.long)
+        
+        block_start = i * self.block_size
+        block_end = min(block_start + self.block_size, self.num_tokens)
+        doc = int(np.searchsorted(self._stream_starts, block_start, side="right")) - 1
+        pos = block_start
+        segment = 1
+        while pos < block_end:
+            doc_start = int(self._offsets[doc])
+            doc_length = int(self._offsets[doc + 1]) - doc_start
+            start_in_doc = pos - int(self._stream_starts[doc])
+            length = min(doc_length + 1 - start_in_doc, block_end - pos)
+            
+            # Copy the document's tokens, then its EOS if it falls inside this block
+            out = pos - block_start
+            num_doc_tokens = min(length, doc_length - start_in_doc)
+            input_ids[out:out + num_doc_tokens] = torch.from_numpy(
+                self._tokens[doc_start + start_in_doc:doc_start + start_in_doc + num_doc_tokens].astype(np.int64)
+            )
+            if num_doc_tokens < length:
+                input_ids[out + num_doc_tokens] = self.eos_token_id
+            
+            attention_mask[out:out + length] = segment
+            first_position = start_in_doc
+            if self.max_positions is not None and start_in_doc + length > self.max_positions:
+                first_position = 0
+            position_ids[out:out + length] = torch.arange(first_position, first_position + length)
+            labels[out:out + length] = input_ids[out:out + length]
+            labels[out] = -100
+            
+            pos += length
+            doc += 1
+            segment += 1
+        
+        return {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "position_ids": position_ids,
+            "labels": labels,
+        }
+    
+    def token_utilization(self) -> float:
+        return self.num_tokens / (len(self) * self.block_size)
+
+def load_code_dataset(
+    tokenizer: PreTrainedTokenizerBase,
+    file_path: str,
+    block_size: int,
+    pack_sequences: bool = False,
+    accelerator: Optional[Accelerator] = None,
+    max_positions: Optional[int] = None,
+) -> Dataset:
+    """
+    Use the memory-mapped token file when pretokenize.py has produced one.
+
+    file_path is either such a token file or a text/JSONL corpus. Packing
+    tokenizes a corpus into a token file next to it (file_path + ".bin" etc.)
+    and does it again when the corpus has changed since. Only the main
+    process writes it; the other ranks wait and then read it, so on several
+    nodes the corpus must sit on a filesystem they all share (or be
+    pretokenized on every node beforehand with pretokenize.py).
+    """
+    is_corpus = os.path.isfile(file_path) and not file_path.endswith(".bin")
+    if is_corpus and pack_sequences:
+        with accelerator.main_process_first() if accelerator is not None else nullcontext():
+            is_main_process = accelerator is None or accelerator.is_main_process
+            if is_main_process and (not is_token_file(file_path) or source_changed(file_path)):
+                pretokenize(tokenizer, file_path, file_path)
+        if not is_token_file(file_path):
+            raise FileNotFoundError(
+                f"No token file for {file_path} on this node: the main process wrote it elsewhere. "
+                "Put the corpus on a shared filesystem or run pretokenize.py on every node first."
+            )
+    elif is_token_file(file_path) and source_changed(file_path):
+        if is_corpus:
+            logger.warning(f"Ignoring the token file of {file_path}: the corpus changed since it was written")
+        else:
+            logger.warning(f"{file_path} is older than the corpus it was made from; re-run pretokenize.py")
+    
+    if pack_sequences:
+        return PackedCodeDataset(
+            file_path=file_path,
+            block_size=block_size,
+            eos_token_id=tokenizer.eos_token_id,
+            pad_token_id=tokenizer.pad_token_id or 0,
+            max_positions=max_positions,
+        )
+    if is_token_file(file_path) and not (is_corpus and source_changed(file_path)):
+        return MemmapCodeDataset(
+            file_path=file_path,
+            block_size=block_size,
+        )
+    return CodeDataset(
+        tokenizer=tokenizer,
+        file_path=file_path,
+        block_size=block_size,
+    )
+
+TRAINER_STATE_NAME = "trainer_state.json"
+
+def save_checkpoint(
+    accelerator: Accelerator,
+    output_dir: str,
+    trainer_state: Dict[str, Any],
+    save_total_limit: Optional[int] = None,
+) -> None:
+    """Save model, optimizer, scheduler, RNG and dataloader state plus loop progress"""
+    checkpoint_path = os.path.join(
+        output_dir, f"checkpoint-{trainer_state['completed_steps']}"
+    )
+    accelerator.save_state(checkpoint_path)
+    
+    if accelerator.is_main_process:
+        with open(os.path.join(checkpoint_path, TRAINER_STATE_NAME), "w") as f:
+            json.dump(trainer_state, f, indent=2)
+        
+        if save_total_limit:
+            checkpoints = list_checkpoints(output_dir)
+            
+            # Remove old checkpoints
+            for checkpoint in checkpoints[:max(len(checkpoints) - save_total_limit, 0)]:
+                checkpoint_path = os.path.join(output_dir, checkpoint)
+                logger.info(f"Deleting checkpoint {checkpoint_path}")
+                shutil.rmtree(checkpoint_path, ignore_errors=True)
+    
+    accelerator.wait_for_everyone()
+
+def list_checkpoints(output_dir: str) -> List[str]:
+    """checkpoint-<step> directories in output_dir, oldest first"""
+    if not os.path.isdir(output_dir):
+        return []
+    checkpoints = [
+        d for d in os.listdir(output_dir)
+        if d.startswith("checkpoint-") and d.split("-")[1].isdigit()
+        and os.path.isfile(os.path.join(output_dir, d, TRAINER_STATE_NAME))
+    ]
+    return sorted(checkpoints, key=lambda x: int(x.split("-")[1]))
+
+def resolve_checkpoint(output_dir: str, resume_from_checkpoint: str) -> Optional[str]:
+    """Map "latest" to the newest complete checkpoint in output_dir"""
+    if resume_from_checkpoint != "latest":
+        return resume_from_checkpoint
+    checkpoints = list_checkpoints(output_dir)
+    return os.path.join(output_dir, checkpoints[-1]) if checkpoints else None
+
+def widen_tokens(batch: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+    """int64 copies of uint16/uint32 token blocks, made on the device after the smaller transfer"""
+    return {name: tensor.long() for name, tensor in batch.items()}
+
+@torch.no_grad()
+def evaluate(
+    model: torch.nn.Module,
+    eval_dataloader: DataLoader,
+    accelerator: Accelerator,
+) -> Dict[str, float]:
+    """Token-level loss and perplexity of a prepared eval dataloader, summed over all processes"""
+    total_loss = torch.zeros((), dtype=torch.float64, device=accelerator.device)
+    total_tokens = torch.zeros((), dtype=torch.long, device=accelerator.device)
+    
+    for batch in eval_dataloader:
+        batch = widen_tokens(batch)
+        labels = batch.pop("labels")
+        logits = model(**batch).logits
+        
+        # Per-sample sums so gather_for_metrics can drop the samples duplicated
+        # to even out the last batch across processes
+        shift_labels = labels[:, 1:]
+        token_losses = F.cross_entropy(
+            logits[:, :-1].float().transpose(1, 2),
+            shift_labels,
+            ignore_index=-100,
+            reduction="none",
+        )
+        loss_sums, token_counts = accelerator.gather_for_metrics(
+            (token_losses.sum(-1), (shift_labels != -100).sum(-1))
+        )
+        total_loss += loss_sums.sum()
+        total_tokens += token_counts.sum()
+    
+    eval_loss = (total_loss / total_tokens.clamp(min=1)).item()
+    try:
+        perplexity = math.exp(eval_loss)
+    except OverflowError:
+        perplexity = float("inf")
+    return {
+        "eval_loss": eval_loss,
+        "perplexity": perplexity,
+        "eval_tokens": total_tokens.item(),
+    }
 
 def train(
     # Model/Tokenizer parameters
@@ -84,6 +390,7 @@ def train(
     validation_file: Optional[str] = None,
     max_seq_length: int = 1024,
     preprocessing_num_workers: Optional[int] = None,
+    pack_sequences: bool = False,
     
     # Training parameters
     per_device_train_batch_size: int = 8,
@@ -93,6 +400,8 @@ def train(
     num_train_epochs: float = 3.0,
     max_train_steps: Optional[int] = None,
     gradient_accumulation_steps: int = 1,
+    gradient_checkpointing: bool = False,
+    mixed_precision: str = "no",
     lr_scheduler_type: str = "linear",
     warmup_ratio: float = 0.0,
     
@@ -101,10 +410,17 @@ def train(
     output_dir: str = "checkpoints",
     logging_steps: int = 500,
     eval_steps: Optional[int] = None,
+    max_eval_batches: Optional[int] = None,
     save_steps: Optional[int] = None,
     save_total_limit: Optional[int] = None,
+    resume_from_checkpoint: Optional[str] = None,
 ):
-    accelerator = Accelerator()
+    # A seedable sampler makes each epoch's shuffle order reproducible on resume
+    accelerator = Accelerator(
+        gradient_accumulation_steps=gradient_accumulation_steps,
+        mixed_precision=mixed_precision,
+        dataloader_config=DataLoaderConfiguration(use_seedable_sampler=True),
+    )
     
     # Set random seed
     set_seed(seed)
@@ -117,22 +433,43 @@ def train(
             tokenizer_name_or_path or model_name_or_path
         )
     else:
-        config = IndieGOConfig()
+        config = (
+            IndieGOConfig.from_pretrained(config_name_or_path)
+            if config_name_or_path
+            else IndieGOConfig()
+        )
         model = IndieGOForCausalLM(config)
         tokenizer = PreTrainedTokenizerBase.from_pretrained("gpt2")
     
+    if gradient_checkpointing:
+        model.gradient_checkpointing_enable()
+    
     # Load datasets
-    train_dataset = CodeDataset(
+    train_dataset = load_code_dataset(
         tokenizer=tokenizer,
         file_path=train_file,
         block_size=max_seq_length,
+        pack_sequences=pack_sequences,
+        accelerator=accelerator,
+        max_positions=config.n_positions,
     )
     
     if validation_file:
-        eval_dataset = CodeDataset(
+        eval_dataset = load_code_dataset(
             tokenizer=tokenizer,
             file_path=validation_file,
             block_size=max_seq_length,
+            pack_sequences=pack_sequences,
+            accelerator=accelerator,
+            max_positions=config.n_positions,
+        )
+    
+    token_utilization = train_dataset.token_utilization()
+    logger.info(f"Train token utilization: {token_utilization:.1%}")
+    if pack_sequences:
+        _, offsets = load_token_file(train_file)
+        logger.info(
+            f"  Padded baseline: {padded_token_utilization(offsets, max_seq_length):.1%}"
         )
     
     # Create dataloaders
@@ -150,6 +487,22 @@ def train(
             shuffle=False,
             num_workers=preprocessing_num_workers or 0,
         )
+        
+        # Periodic evals can run on a fixed random sample of the eval set;
+        # the full set is evaluated once at the end of training
+        periodic_eval_dataloader = eval_dataloader
+        if max_eval_batches:
+            num_samples = min(
+                len(eval_dataset),
+                max_eval_batches * per_device_eval_batch_size * accelerator.num_processes,
+            )
+            indices = np.random.RandomState(seed).permutation(len(eval_dataset))[:num_samples]
+            periodic_eval_dataloader = DataLoader(
+                Subset(eval_dataset, indices.tolist()),
+                batch_size=per_device_eval_batch_size,
+                shuffle=False,
+                num_workers=preprocessing_num_workers or 0,
+            )
     
     # Initialize optimizer
     no_decay = ["bias", "LayerNorm.weight"]
@@ -172,7 +525,9 @@ def train(
         model, optimizer, train_dataloader
     )
     if validation_file:
-        eval_dataloader = accelerator.prepare(eval_dataloader)
+        eval_dataloader, periodic_eval_dataloader = accelerator.prepare(
+            eval_dataloader, periodic_eval_dataloader
+        )
     
     # Calculate number of update steps
     num_update_steps_per_epoch = math.ceil(
@@ -188,6 +543,7 @@ def train(
         num_warmup_steps=int(warmup_ratio * max_train_steps),
         num_training_steps=max_train_steps,
     )
+    accelerator.register_for_checkpointing(lr_scheduler)
     
     # Initialize wandb
     if accelerator.is_main_process:
@@ -198,6 +554,10 @@ def train(
                 "epochs": num_train_epochs,
                 "batch_size": per_device_train_batch_size,
                 "max_seq_length": max_seq_length,
+                "pack_sequences": pack_sequences,
+                "gradient_checkpointing": gradient_checkpointing,
+                "mixed_precision": mixed_precision,
+                "token_utilization": token_utilization,
             }
         )
     
@@ -220,34 +580,108 @@ def train(
         disable=not accelerator.is_local_main_process,
     )
     completed_steps = 0
+    starting_epoch = 0
+    resume_step = 0
     best_eval_loss = float("inf")
     
-    for epoch in range(int(num_train_epochs)):
+    # Restore optimizer, scheduler, RNG and dataloader state from a checkpoint
+    if resume_from_checkpoint:
+        checkpoint_path = resolve_checkpoint(output_dir, resume_from_checkpoint)
+        if checkpoint_path is None:
+            logger.warning(f"No checkpoint found in {output_dir}, training from scratch")
+        else:
+            logger.info(f"Resuming from checkpoint {checkpoint_path}")
+            accelerator.load_state(checkpoint_path)
+            with open(os.path.join(checkpoint_path, TRAINER_STATE_NAME)) as f:
+                trainer_state = json.load(f)
+            completed_steps = trainer_state["completed_steps"]
+            starting_epoch = trainer_state["epoch"]
+            resume_step = trainer_state["step"]
+            best_eval_loss = trainer_state["best_eval_loss"]
+            progress_bar.update(completed_steps)
+    
+    # Throughput accounting over the current logging window
+    window_loss = 0.0
+    window_micro_batches = 0
+    window_tokens = 0
+    window_positions = 0
+    window_samples = 0
+    window_data_time = 0.0
+    window_start = time.perf_counter()
+    window_steps = 0
+    
+    for epoch in range(starting_epoch, int(num_train_epochs)):
         model.train()
-        for step, batch in enumerate(train_dataloader):
+        # Seeds this epoch's shuffle; the skipping loader below shares the same sampler
+        train_dataloader.set_epoch(epoch)
+        # Skip the batches of a resumed epoch that were already trained on
+        if epoch == starting_epoch and resume_step:
+            active_dataloader = accelerator.skip_first_batches(train_dataloader, resume_step)
+            first_step = resume_step
+        else:
+            active_dataloader = train_dataloader
+            first_step = 0
+        
+        data_start = time.perf_counter()
+        for step, batch in enumerate(active_dataloader, start=first_step):
+            window_data_time += time.perf_counter() - data_start
+            batch = widen_tokens(batch)
+            
+            # The optimizer only really steps (and zero_grad only clears) on the
+            # last micro-batch of each accumulation window
             with accelerator.accumulate(model):
                 outputs = model(**batch)
                 loss = outputs[0]
                 accelerator.backward(loss)
-                
-                if step % gradient_accumulation_steps == 0:
-                    optimizer.step()
+                optimizer.step()
+                if accelerator.sync_gradients:
                     lr_scheduler.step()
-                    optimizer.zero_grad()
-                    progress_bar.update(1)
-                    completed_steps += 1
-                    
-                    if accelerator.is_main_process:
-                        wandb.log(
-                            {
-                                "train_loss": loss.item(),
-                                "learning_rate": optimizer.param_groups[0]["lr"],
-                            },
-                            step=completed_steps,
-                        )
+                optimizer.zero_grad()
             
-            if completed_steps >= max_train_steps:
-                break
+            window_loss += loss.detach().float().item()
+            window_micro_batches += 1
+            window_tokens += (batch["attention_mask"] > 0).sum().item()
+            window_positions += batch["attention_mask"].numel()
+            window_samples += batch["input_ids"].size(0)
+            
+            if not accelerator.sync_gradients:
+                data_start = time.perf_counter()
+                continue
+            
+            progress_bar.update(1)
+            completed_steps += 1
+            window_steps += 1
+            
+            if completed_steps % logging_steps == 0 or completed_steps >= max_train_steps:
+                elapsed = time.perf_counter() - window_start
+                totals = accelerator.reduce(
+                    torch.tensor([window_tokens, window_samples], device=accelerator.device),
+                    reduction="sum",
+                )
+                metrics = {
+                    "train_loss": window_loss / window_micro_batches,
+                    "learning_rate": lr_scheduler.get_last_lr()[0],
+                    "tokens_per_sec": totals[0].item() / elapsed,
+                    "samples_per_sec": totals[1].item() / elapsed,
+                    "step_time": elapsed / window_steps,
+                    "data_wait_time": window_data_time / window_steps,
+                    "token_utilization": window_tokens / window_positions,
+                }
+                if accelerator.is_main_process:
+                    wandb.log(metrics, step=completed_steps)
+                    logger.info(
+                        f"step {completed_steps}: loss {metrics['train_loss']:.4f}, "
+                        f"{metrics['tokens_per_sec']:.0f} tok/s, {metrics['samples_per_sec']:.1f} samples/s, "
+                        f"{metrics['step_time']:.3f} s/step ({metrics['data_wait_time']:.3f} s waiting for data)"
+                    )
+                window_loss = 0.0
+                window_micro_batches = 0
+                window_tokens = 0
+                window_positions = 0
+                window_samples = 0
+                window_data_time = 0.0
+                window_steps = 0
+                window_start = time.perf_counter()
             
             # Evaluation
             if (
@@ -256,72 +690,72 @@ def train(
                 and completed_steps % eval_steps == 0
             ):
                 model.eval()
-                eval_losses = []
-                
-                for eval_batch in eval_dataloader:
-                    with torch.no_grad():
-                        outputs = model(**eval_batch)
-                        loss = outputs[0]
-                        eval_losses.append(
-                            accelerator.gather(loss.repeat(per_device_eval_batch_size))
-                        )
-                
-                eval_losses = torch.cat(eval_losses)
-                eval_loss = torch.mean(eval_losses)
+                eval_metrics = evaluate(model, periodic_eval_dataloader, accelerator)
                 
                 if accelerator.is_main_process:
-                    wandb.log(
-                        {"eval_loss": eval_loss.item()},
-                        step=completed_steps,
+                    wandb.log(eval_metrics, step=completed_steps)
+                    logger.info(
+                        f"step {completed_steps}: eval loss {eval_metrics['eval_loss']:.4f}, "
+                        f"perplexity {eval_metrics['perplexity']:.2f} "
+                        f"over {eval_metrics['eval_tokens']} tokens"
+                    )
+                
+                # Save best model; the gathered metrics are identical on every process
+                if eval_metrics["eval_loss"] < best_eval_loss:
+                    best_eval_loss = eval_metrics["eval_loss"]
+                    accelerator.wait_for_everyone()
+                    unwrapped_model = accelerator.unwrap_model(model)
+                    unwrapped_model.save_pretrained(
+                        os.path.join(output_dir, "best"),
+                        is_main_process=accelerator.is_main_process,
+                        save_function=accelerator.save,
                     )
-                    
-                    # Save best model
-                    if eval_loss < best_eval_loss:
-                        best_eval_loss = eval_loss
-                        accelerator.wait_for_everyone()
-                        unwrapped_model = accelerator.unwrap_model(model)
-                        unwrapped_model.save_pretrained(
-                            os.path.join(output_dir, "best"),
-                            save_function=accelerator.save,
-                        )
                 
                 model.train()
+                # Evaluation time is not training throughput
+                window_start = time.perf_counter()
             
             # Save checkpoint
             if (
                 save_steps
                 and completed_steps % save_steps == 0
             ):
-                accelerator.wait_for_everyone()
-                if accelerator.is_main_process:
-                    unwrapped_model = accelerator.unwrap_model(model)
-                    unwrapped_model.save_pretrained(
-                        os.path.join(output_dir, f"checkpoint-{completed_steps}"),
-                        save_function=accelerator.save,
-                    )
-                    
-                    if save_total_limit:
-                        checkpoints = [
-                            d for d in os.listdir(output_dir)
-                            if d.startswith("checkpoint-")
-                        ]
-                        checkpoints = sorted(
-                            checkpoints,
-                            key=lambda x: int(x.split("-")[1])
-                        )
-                        
-                        # Remove old checkpoints
-                        if len(checkpoints) > save_total_limit:
-                            num_to_remove = len(checkpoints) - save_total_limit
-                            to_remove = checkpoints[:num_to_remove]
-                            for checkpoint in to_remove:
-                                checkpoint_path = os.path.join(
-                                    output_dir, checkpoint
-                                )
-                                logger.info(
-                                    f"Deleting checkpoint {checkpoint_path}"
-                                )
-                                os.system(f"rm -rf {checkpoint_path}")
+                # A checkpoint taken on an epoch's last batch resumes at the next epoch
+                epoch_finished = step + 1 == len(train_dataloader)
+                save_checkpoint(
+                    accelerator,
+                    output_dir,
+                    {
+                        "completed_steps": completed_steps,
+                        "epoch": epoch + 1 if epoch_finished else epoch,
+                        "step": 0 if epoch_finished else step + 1,
+                        "best_eval_loss": best_eval_loss,
+                    },
+                    save_total_limit=save_total_limit,
+                )
+                window_start = time.perf_counter()
+            
+            if completed_steps >= max_train_steps:
+                break
+            data_start = time.perf_counter()
+        
+        if completed_steps >= max_train_steps:
+            break
+    
+    # Final evaluation over the full eval set
+    if validation_file:
+        model.eval()
+        eval_metrics = evaluate(model, eval_dataloader, accelerator)
+        if accelerator.is_main_process:
+            wandb.log(
+                {f"final_{name}": value for name, value in eval_metrics.items()},
+                step=completed_steps,
+            )
+            logger.info(
+                f"Final eval loss {eval_metrics['eval_loss']:.4f}, "
+                f"perplexity {eval_metrics['perplexity']:.2f} "
+                f"over {eval_metrics['eval_tokens']} tokens"
+            )
     
     # Save final model
     if accelerator.is_main_process:
@@ -342,6 +776,7 @@ if __name__ == "__main__":
     parser.add_argument("--validation_file", type=str)
     parser.add_argument("--max_seq_length", type=int, default=1024)
     parser.add_argument("--preprocessing_num_workers", type=int)
+    parser.add_argument("--pack_sequences", action="store_true")
     parser.add_argument("--per_device_train_batch_size", type=int, default=8)
     parser.add_argument("--per_device_eval_batch_size", type=int, default=8)
     parser.add_argument("--learning_rate", type=float, default=5e-5)
@@ -349,14 +784,36 @@ if __name__ == "__main__":
     parser.add_argument("--num_train_epochs", type=float, default=3.0)
     parser.add_argument("--max_train_steps", type=int)
     parser.add_argument("--gradient_accumulation_steps", type=int, default=1)
+    parser.add_argument(
+        "--gradient_checkpointing",
+        action="store_true",
+        help="Recompute each block's activations in backward to save memory",
+    )
+    parser.add_argument(
+        "--mixed_precision",
+        type=str,
+        default="no",
+        choices=["no", "bf16"],
+        help="Run forward/backward under bf16 autocast (weights stay fp32)",
+    )
     parser.add_argument("--lr_scheduler_type", type=str, default="linear")
     parser.add_argument("--warmup_ratio", type=float, default=0.0)
     parser.add_argument("--seed", type=int, default=42)
     parser.add_argument("--output_dir", type=str, default="checkpoints")
     parser.add_argument("--logging_steps", type=int, default=500)
     parser.add_argument("--eval_steps", type=int)
+    parser.add_argument(
+        "--max_eval_batches",
+        type=int,
+        help="Run periodic evals on a fixed sample of this many batches per process; the full eval set is used at the end",
+    )
     parser.add_argument("--save_steps", type=int)
     parser.add_argument("--save_total_limit", type=int)
+    parser.add_argument(
+        "--resume_from_checkpoint",
+        type=str,
+        help='Checkpoint directory to resume from, or "latest" for the newest one in output_dir',
+    )
     
     args = parser.parse_args()
     train(**vars(args))
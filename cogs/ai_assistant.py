@@ -7,7 +7,7 @@ from discord import app_commands
 import anthropic
 import google.generativeai as genai
 import os
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Callable, Awaitable
 import asyncio
 import json
 
@@ -33,6 +33,8 @@ class AIAssistant(commands.Cog):
         # Rate limiting
         self.cooldowns = {}
         self.COOLDOWN_MINUTES = 1
+        # Minimum seconds between edits of a streamed reply (Discord rate limits edits)
+        self.STREAM_EDIT_INTERVAL = 1.0
         
         # Message history
         self.message_history = {}
@@ -45,10 +47,19 @@ class AIAssistant(commands.Cog):
     async def _call_model_api(
         self,
         endpoint: str,
-        payload: Dict[str, Any]
+        payload: Dict[str, Any],
+        on_text: Optional[Callable[[str], Awaitable[None]]] = None
     ) -> Dict[str, Any]:
-        """Make request to model API"""
+        """Make request to model API
+        
+        When on_text is given, the streaming variant of the endpoint is used and
+        on_text is awaited with the text received so far after every event. Both
+        variants return the same generated_text, prompt included.
+        """
         try:
+            if on_text is not None:
+                return await self._stream_model_api(endpoint, payload, on_text)
+            
             async with self.session.post(
                 f"{self.api_url}/{endpoint}",
                 json=payload
@@ -64,6 +75,45 @@ class AIAssistant(commands.Cog):
             logger.error(f"API request failed: {str(e)}")
             return {"error": f"API request failed: {str(e)}"}
     
+    async def _stream_model_api(
+        self,
+        endpoint: str,
+        payload: Dict[str, Any],
+        on_text: Callable[[str], Awaitable[None]]
+    ) -> Dict[str, Any]:
+        """Consume server-sent events from a streaming model API endpoint"""
+        generated_text = ""
+        async with self.session.post(
+            f"{self.api_url}/{endpoint}/stream",
+            json=payload
+        ) as response:
+            if response.status != 200:
+                error_text = await response.text()
+                logger.error(
+                    f"API error: {response.status} - {error_text}"
+                )
+                return {"error": f"API error: {response.status}"}
+            
+            async for line in response.content:
+                line = line.decode("utf-8").strip()
+                if not line.startswith("data: "):
+                    continue
+                data = line[len("data: "):]
+                if data == "[DONE]":
+                    break
+                
+                event = json.loads(data)
+                if "error" in event:
+                    return {"error": event["error"]}
+                generated_text += event["text"]
+                await on_text(generated_text)
+            else:
+                # The connection closed before [DONE]: the answer is truncated
+                logger.error(f"Stream from /{endpoint}/stream ended without [DONE]")
+                return {"error": "The model stream ended early; the answer is incomplete"}
+        
+        return {"generated_text": generated_text}
+    
     @commands.command()
     async def ask(self, ctx, *, question: str):
         """Ask the AI assistant a question"""
@@ -236,6 +286,26 @@ class AIAssistant(commands.Cog):
                 code = code[code.index("\n")+1:]
         
         async with ctx.typing():
+            # Show the explanation as it is generated by editing one message
+            message = await ctx.send(embed=discord.Embed(
+                title="Code Explanation",
+                description="Thinking...",
+                color=discord.Color.blue()
+            ))
+            last_edit = 0.0
+            
+            async def show_progress(text: str):
+                nonlocal last_edit
+                now = asyncio.get_running_loop().time()
+                if now - last_edit < self.STREAM_EDIT_INTERVAL:
+                    return
+                last_edit = now
+                await message.edit(embed=discord.Embed(
+                    title="Code Explanation",
+                    description=text[:1900],
+                    color=discord.Color.blue()
+                ))
+            
             response = await self._call_model_api(
                 "generate",
                 {
@@ -243,17 +313,21 @@ class AIAssistant(commands.Cog):
                     "max_length": 1024,
                     "temperature": 0.7,
                     "top_p": 0.9,
-                }
+                },
+                on_text=show_progress
             )
             
             if "error" in response:
-                await ctx.send(f"Sorry, I encountered an error: {response['error']}")
+                await message.edit(
+                    content=f"Sorry, I encountered an error: {response['error']}",
+                    embed=None
+                )
                 return
             
             explanation = response["generated_text"]
             
             # Split into chunks if needed
-            chunks = [explanation[i:i+1900] for i in range(0, len(explanation), 1900)]
+            chunks = [explanation[i:i+1900] for i in range(0, len(explanation), 1900)] or [""]
             
             for i, chunk in enumerate(chunks):
                 embed = discord.Embed(
@@ -261,7 +335,10 @@ class AIAssistant(commands.Cog):
                     description=chunk,
                     color=discord.Color.blue()
                 )
-                await ctx.send(embed=embed)
+                if i == 0:
+                    await message.edit(embed=embed)
+                else:
+                    await ctx.send(embed=embed)
     
     @commands.command()
     async def improve(self, ctx, *, code: str):
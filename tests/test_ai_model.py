@@ -0,0 +1,1201 @@
+import math
+import os
+import sys
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "ai_model"))
+
+from model import IndieGOConfig, IndieGOForCausalLM
+
+def tiny_config(**kwargs):
+    params = dict(
+        vocab_size=128,
+        n_positions=64,
+        n_embd=32,
+        n_layer=2,
+        n_head=4,
+        resid_pdrop=0.0,
+        embd_pdrop=0.0,
+        attn_pdrop=0.0,
+    )
+    params.update(kwargs)
+    return IndieGOConfig(**params)
+
+@pytest.fixture
+def model():
+    torch.manual_seed(0)
+    return IndieGOForCausalLM(tiny_config()).eval()
+
+def test_incremental_decoding_matches_full_forward(model):
+    input_ids = torch.randint(0, 128, (2, 12))
+
+    with torch.no_grad():
+        full_logits = model(input_ids).logits
+
+        outputs = model(input_ids[:, :8], use_cache=True)
+        logits = [outputs.logits]
+        past_key_values = outputs.past_key_values
+        for i in range(8, 12):
+            outputs = model(input_ids[:, i:i + 1], past_key_values=past_key_values, use_cache=True)
+            past_key_values = outputs.past_key_values
+            logits.append(outputs.logits)
+
+    assert past_key_values[0][0].shape[-2] == 12
+    assert torch.allclose(torch.cat(logits, dim=1), full_logits, atol=1e-5)
+
+def test_generate_with_cache_matches_without_cache(model):
+    input_ids = torch.randint(0, 128, (1, 6))
+    attention_mask = torch.ones_like(input_ids)
+
+    cached = model.generate(
+        input_ids, attention_mask=attention_mask, max_length=16, do_sample=False, use_cache=True, pad_token_id=0
+    )
+    uncached = model.generate(
+        input_ids, attention_mask=attention_mask, max_length=16, do_sample=False, use_cache=False, pad_token_id=0
+    )
+
+    assert torch.equal(cached, uncached)
+
+def test_speculative_decoding_matches_greedy(model):
+    torch.manual_seed(1)
+    draft_model = IndieGOForCausalLM(tiny_config(n_layer=1, n_embd=16)).eval()
+    draft_model.generation_config.num_assistant_tokens = 4
+    draft_model.generation_config.num_assistant_tokens_schedule = "constant"
+    input_ids = torch.randint(0, 128, (1, 6))
+    attention_mask = torch.ones_like(input_ids)
+
+    greedy = model.generate(
+        input_ids, attention_mask=attention_mask, max_length=40, do_sample=False, pad_token_id=0
+    )
+    speculative = model.generate(
+        input_ids,
+        attention_mask=attention_mask,
+        max_length=40,
+        do_sample=False,
+        pad_token_id=0,
+        assistant_model=draft_model,
+    )
+
+    assert torch.equal(speculative, greedy)
+
+@pytest.mark.parametrize("n_kv_head", [4, 2, 1])
+def test_sdpa_matches_eager_attention(n_kv_head):
+    torch.manual_seed(0)
+    sdpa_model = IndieGOForCausalLM(tiny_config(attn_implementation="sdpa", n_kv_head=n_kv_head)).eval()
+    eager_model = IndieGOForCausalLM(tiny_config(attn_implementation="eager", n_kv_head=n_kv_head)).eval()
+    eager_model.load_state_dict(sdpa_model.state_dict())
+
+    input_ids = torch.randint(0, 128, (2, 10))
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[0, :3] = 0
+
+    with torch.no_grad():
+        sdpa_outputs = sdpa_model(input_ids, attention_mask=attention_mask)
+        eager_outputs = eager_model(input_ids, attention_mask=attention_mask)
+
+    assert torch.allclose(sdpa_outputs.logits, eager_outputs.logits, atol=1e-5)
+
+def test_grouped_query_attention_shares_key_value_heads():
+    torch.manual_seed(0)
+    gqa_model = IndieGOForCausalLM(tiny_config(n_kv_head=2)).eval()
+    mha_model = IndieGOForCausalLM(tiny_config()).eval()
+
+    # An MHA model whose K/V heads are copies of the shared ones computes the same thing
+    state_dict = gqa_model.state_dict()
+    head_dim = 32 // 4
+    for name, tensor in list(state_dict.items()):
+        if ".k_proj." in name or ".v_proj." in name:
+            heads = tensor.view(2, head_dim, *tensor.shape[1:])
+            state_dict[name] = heads.repeat_interleave(2, dim=0).reshape(32, *tensor.shape[1:])
+    mha_model.load_state_dict(state_dict)
+
+    input_ids = torch.randint(0, 128, (2, 10))
+    with torch.no_grad():
+        gqa_outputs = gqa_model(input_ids, use_cache=True)
+        mha_outputs = mha_model(input_ids, use_cache=True)
+
+    assert gqa_outputs.past_key_values[0][0].shape == (2, 2, 10, head_dim)
+    assert mha_outputs.past_key_values[0][0].shape == (2, 4, 10, head_dim)
+    assert torch.allclose(gqa_outputs.logits, mha_outputs.logits, atol=1e-5)
+
+class CharTokenizer:
+    """Maps characters to ids below the tiny vocabulary size."""
+    eos_token_id = 127
+    pad_token_id = None
+
+    def __len__(self):
+        return 128
+
+    def __call__(self, text, truncation=False, max_length=None):
+        if isinstance(text, list):
+            return {"input_ids": [self(t, truncation, max_length)["input_ids"] for t in text]}
+        input_ids = [ord(c) % 100 for c in text]
+        if truncation and max_length is not None:
+            input_ids = input_ids[:max_length]
+        return {"input_ids": input_ids}
+
+def test_rotary_embeddings_replace_position_table():
+    torch.manual_seed(0)
+    model = IndieGOForCausalLM(tiny_config(position_embedding_type="rotary")).eval()
+    assert model.transformer.wpe is None
+    assert not any("wpe" in name for name, _ in model.named_parameters())
+
+    input_ids = torch.randint(0, 128, (2, 12))
+    with torch.no_grad():
+        full_logits = model(input_ids).logits
+
+        outputs = model(input_ids[:, :8], use_cache=True)
+        logits = [outputs.logits]
+        for i in range(8, 12):
+            outputs = model(input_ids[:, i:i + 1], past_key_values=outputs.past_key_values, use_cache=True)
+            logits.append(outputs.logits)
+        assert torch.allclose(torch.cat(logits, dim=1), full_logits, atol=1e-5)
+
+        # Only relative positions matter, including ones past n_positions
+        position_ids = torch.arange(12)[None] + 1000
+        shifted_logits = model(input_ids, position_ids=position_ids).logits
+    assert torch.allclose(shifted_logits, full_logits, atol=1e-4)
+
+def test_gradient_checkpointing_matches_regular_backward():
+    torch.manual_seed(0)
+    model = IndieGOForCausalLM(tiny_config()).train()
+    input_ids = torch.randint(0, 128, (2, 16))
+
+    loss = model(input_ids, labels=input_ids).loss
+    loss.backward()
+    expected = {n: p.grad.clone() for n, p in model.named_parameters()}
+    model.zero_grad()
+
+    model.gradient_checkpointing_enable()
+    assert model.transformer.gradient_checkpointing
+    checkpointed_loss = model(input_ids, labels=input_ids, use_cache=True).loss
+    checkpointed_loss.backward()
+
+    assert torch.allclose(checkpointed_loss, loss)
+    for name, param in model.named_parameters():
+        assert torch.allclose(param.grad, expected[name], atol=1e-6), name
+
+def test_batch_scheduler_matches_sequential_greedy_generation(model):
+    import asyncio
+
+    from scheduler import BatchScheduler, SamplingParams
+
+    tokenizer = CharTokenizer()
+    prompts = ["def f(x):", "return", "import os\nimport sys"]
+    # Long enough for the n-gram bans to change the greedy output of the last two rows
+    max_lengths = [16, 60, 60]
+    repetition_penalties = [1.3, 1.0, 1.5]
+    ngram_sizes = [0, 2, 1]
+
+    expected = []
+    for prompt, max_length, penalty, ngram_size in zip(prompts, max_lengths, repetition_penalties, ngram_sizes):
+        input_ids = torch.tensor([tokenizer(prompt)["input_ids"]])
+        output = model.generate(
+            input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            max_length=max_length,
+            do_sample=False,
+            repetition_penalty=penalty,
+            no_repeat_ngram_size=ngram_size,
+            eos_token_id=tokenizer.eos_token_id,
+            pad_token_id=0,
+        )
+        expected.append(output[0].tolist())
+
+    scheduler = BatchScheduler(model, tokenizer, device="cpu", max_batch_size=2)
+    scheduler.start()
+
+    async def run():
+        return await asyncio.gather(*[
+            scheduler.generate(
+                prompt,
+                SamplingParams(
+                    max_length=max_length,
+                    do_sample=False,
+                    repetition_penalty=penalty,
+                    no_repeat_ngram_size=ngram_size,
+                ),
+            )
+            for prompt, max_length, penalty, ngram_size in zip(
+                prompts, max_lengths, repetition_penalties, ngram_sizes
+            )
+        ])
+
+    try:
+        results = asyncio.run(run())
+    finally:
+        scheduler.stop()
+
+    assert results == expected
+
+def test_batch_scheduler_streams_generated_tokens(model):
+    import asyncio
+
+    from scheduler import BatchScheduler, SamplingParams
+
+    tokenizer = CharTokenizer()
+    params = SamplingParams(max_length=20, do_sample=False)
+    scheduler = BatchScheduler(model, tokenizer, device="cpu")
+    scheduler.start()
+
+    async def run():
+        streamed = [token_id async for token_id in scheduler.stream("class Foo:", params)]
+        full = await scheduler.generate("class Foo:", params)
+        return streamed, full
+
+    try:
+        streamed, full = asyncio.run(run())
+    finally:
+        scheduler.stop()
+
+    assert full == tokenizer("class Foo:")["input_ids"] + streamed
+
+def test_abandoned_requests_give_up_their_batch_slots(model):
+    import asyncio
+
+    from scheduler import BatchScheduler, SamplingParams
+
+    scheduler = BatchScheduler(model, CharTokenizer(), device="cpu")
+    params = SamplingParams(max_length=64, min_length=64, do_sample=False)
+    scheduler.start()
+
+    async def wait_for_active(count):
+        while scheduler.stats()["active_sequences"] != count:
+            await asyncio.sleep(0.001)
+
+    async def run():
+        task = asyncio.ensure_future(scheduler.generate("x = 1", params))
+        await wait_for_active(1)
+        task.cancel()
+        await asyncio.wait_for(wait_for_active(0), timeout=5)
+
+        many = asyncio.ensure_future(scheduler.generate_many([("a", params, None), ("b", params, None)]))
+        await wait_for_active(2)
+        many.cancel()
+        await asyncio.wait_for(wait_for_active(0), timeout=5)
+
+    try:
+        asyncio.run(run())
+    finally:
+        scheduler.stop()
+    # Together they stopped well short of a single full generation
+    assert scheduler.stats()["tokens_generated_total"] < 60
+    assert scheduler.stats()["pending"] == 0
+
+def test_scheduler_context_stretches_with_rope_scaling():
+    import asyncio
+
+    from scheduler import BatchScheduler, SamplingParams
+
+    learned = IndieGOForCausalLM(tiny_config(n_positions=16, rope_scaling_factor=2.0)).eval()
+    assert BatchScheduler(learned, CharTokenizer(), device="cpu").max_positions == 16
+
+    model = IndieGOForCausalLM(
+        tiny_config(n_positions=16, position_embedding_type="rotary", rope_scaling_factor=2.0)
+    ).eval()
+    scheduler = BatchScheduler(model, CharTokenizer(), device="cpu")
+    assert scheduler.max_positions == 32
+    scheduler.start()
+    try:
+        ids = asyncio.run(scheduler.generate("x = 1", SamplingParams(max_length=40, min_length=40, do_sample=False)))
+    finally:
+        scheduler.stop()
+    assert len(ids) == 32
+
+def test_generate_stream_route_matches_generate(tmp_path, monkeypatch, model):
+    import json
+    from types import SimpleNamespace
+
+    from fastapi.testclient import TestClient
+
+    import serve
+
+    class DecodingCharTokenizer(CharTokenizer):
+        def decode(self, token_ids, skip_special_tokens=False):
+            return "".join(chr(i) for i in token_ids if not (skip_special_tokens and i == self.eos_token_id))
+
+    model.save_pretrained(tmp_path)
+    tokenizer = DecodingCharTokenizer()
+    monkeypatch.setattr(serve, "PreTrainedTokenizerBase", SimpleNamespace(from_pretrained=lambda path: tokenizer))
+    monkeypatch.setattr(serve, "model_server", serve.ModelServer(str(tmp_path), device="cpu"))
+
+    def stream(payload):
+        events = []
+        with client.stream("POST", "/generate/stream", json=payload) as response:
+            assert response.status_code == 200
+            assert response.headers["content-type"].startswith("text/event-stream")
+            for line in response.iter_lines():
+                if line.startswith("data: "):
+                    events.append(line[len("data: "):])
+        # Errors end the stream without [DONE]
+        return [event if event == "[DONE]" else json.loads(event) for event in events]
+
+    payload = {"prompt": "A = 1 + B", "system_prompt": "# ", "max_length": 24, "do_sample": False}
+    with TestClient(serve.app) as client:
+        expected = client.post("/generate", json=payload).json()["generated_text"]
+        events = stream(payload)
+        # A prompt that already fills max_length is still echoed
+        short = stream({**payload, "max_length": 3})
+        beams = stream({**payload, "num_beams": 2})
+
+    assert len(events) > 2 and events[-1] == "[DONE]"
+    assert "".join(event["text"] for event in events[:-1]) == expected
+    assert expected.startswith("# A = 1 + B")
+    assert short == [{"text": "# A"}, "[DONE]"]
+    assert len(beams) == 1 and "error" in beams[0]
+
+def test_solo_generation_tokenizes_the_prompt_like_the_batch_scheduler(tmp_path, monkeypatch, model):
+    from types import SimpleNamespace
+
+    import serve
+
+    class MergingTokenizer(CharTokenizer):
+        """Merges " A" into one token, so tokenizing across the prefix boundary differs"""
+        def __call__(self, text, truncation=False, max_length=None):
+            return {"input_ids": super().__call__(text.replace(" A", "\x05"))["input_ids"]}
+
+        def decode(self, token_ids, skip_special_tokens=False):
+            return ""
+
+    model.save_pretrained(tmp_path)
+    tokenizer = MergingTokenizer()
+    monkeypatch.setattr(serve, "PreTrainedTokenizerBase", SimpleNamespace(from_pretrained=lambda path: tokenizer))
+    server = serve.ModelServer(str(tmp_path), device="cpu")
+    inputs = []
+    monkeypatch.setattr(server.model, "generate", lambda input_ids, **kwargs: inputs.append(input_ids) or input_ids)
+
+    config = serve.GenerationConfig(prompt="A = 1", system_prompt="# ", max_length=24, num_beams=2)
+    assert server.generate(config).error is None
+    server.analyze_code(serve.CodeAnalysisConfig(code="A = 1", max_length=64))
+
+    expected, _ = server.scheduler.tokenize("A = 1", 24, "# ")
+    assert expected != tokenizer("# A = 1")["input_ids"]
+    assert inputs[0].tolist() == [expected]
+    prefix, prompt = server._analysis_prompt(serve.CodeAnalysisConfig(code="A = 1"))
+    assert inputs[1].tolist() == [server.scheduler.tokenize(prompt, 64, prefix)[0]]
+
+def test_batch_scheduler_reuses_cached_prefixes(model):
+    import asyncio
+
+    from scheduler import BatchScheduler, SamplingParams
+
+    tokenizer = CharTokenizer()
+    prefix = "Analyze this code:\n\n"
+    # Mixed prompt lengths, one request without a prefix, and one whose prompt is empty
+    requests = [(prefix, "x = 1"), (prefix, "def f(): pass"), (prefix, "y"), (None, "import os"), (prefix, "")]
+
+    expected = []
+    for request_prefix, prompt in requests:
+        input_ids = torch.tensor([tokenizer((request_prefix or "") + prompt)["input_ids"]])
+        output = model.generate(
+            input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            max_length=40,
+            do_sample=False,
+            eos_token_id=tokenizer.eos_token_id,
+            pad_token_id=0,
+        )
+        expected.append(output[0].tolist())
+
+    scheduler = BatchScheduler(model, tokenizer, device="cpu", max_batch_size=8)
+    scheduler.start()
+    params = SamplingParams(max_length=40, do_sample=False)
+
+    async def run():
+        first = await scheduler.generate(requests[0][1], params, prefix=requests[0][0])
+        rest = await asyncio.gather(*[
+            scheduler.generate(prompt, params, prefix=request_prefix)
+            for request_prefix, prompt in requests[1:]
+        ])
+        return [first] + rest
+
+    try:
+        results = asyncio.run(run())
+    finally:
+        scheduler.stop()
+
+    assert results == expected
+    # Computed once for the first request, then reused; the empty prompt keys on
+    # the prefix minus its last token, which must still be prefilled
+    stats = scheduler.prefix_cache.stats()
+    assert stats["entries"] == 2 and stats["misses"] == 2 and stats["hits"] >= 1
+
+def test_batch_scheduler_rejects_requests_beyond_queue_depth(model):
+    import asyncio
+
+    from scheduler import BatchScheduler, QueueFullError, SamplingParams
+
+    tokenizer = CharTokenizer()
+    params = SamplingParams(max_length=30, do_sample=False)
+    scheduler = BatchScheduler(model, tokenizer, device="cpu", max_queue_depth=1)
+    scheduler.start()
+
+    async def run():
+        first = asyncio.ensure_future(scheduler.generate("def f():", params))
+        await asyncio.sleep(0)
+        with pytest.raises(QueueFullError):
+            await scheduler.generate("def g():", params)
+        with pytest.raises(QueueFullError):
+            await scheduler.run_solo(lambda: None)
+        await first
+        # Capacity is released once the first request completes
+        return await scheduler.run_solo(lambda: torch.is_grad_enabled())
+
+    try:
+        grad_enabled = asyncio.run(run())
+    finally:
+        scheduler.stop()
+
+    assert grad_enabled is False
+    stats = scheduler.stats()
+    assert stats["pending"] == 0
+    assert stats["requests_total"] == 2 and stats["rejected_total"] == 2
+
+def test_batch_scheduler_generates_many_in_order(model):
+    import asyncio
+
+    from scheduler import BatchScheduler, QueueFullError, SamplingParams
+
+    tokenizer = CharTokenizer()
+    params = SamplingParams(max_length=20, do_sample=False)
+    requests = [("x = 1", params, "Review:\n"), ("def f(): pass", params, "Review:\n"), ("import os", params, None)]
+    scheduler = BatchScheduler(model, tokenizer, device="cpu", max_batch_size=4, max_queue_depth=3)
+    scheduler.start()
+
+    async def run():
+        expected = [await scheduler.generate(prompt, p, prefix=prefix) for prompt, p, prefix in requests]
+        results = await scheduler.generate_many(requests)
+        # Admission is all or nothing
+        with pytest.raises(QueueFullError):
+            await scheduler.generate_many(requests + requests[:1])
+        return expected, results
+
+    try:
+        expected, results = asyncio.run(run())
+    finally:
+        scheduler.stop()
+
+    assert results == expected
+    assert scheduler.stats()["pending"] == 0
+
+def test_sampler_applies_per_row_settings_like_hf_processors():
+    from transformers import (
+        MinLengthLogitsProcessor,
+        NoRepeatNGramLogitsProcessor,
+        RepetitionPenaltyLogitsProcessor,
+        TemperatureLogitsWarper,
+        TopKLogitsWarper,
+        TopPLogitsWarper,
+    )
+
+    from sampling import Sampler, SamplingBatch, SamplingParams, seen_tokens, token_history
+
+    eos_token_id = 3
+    token_ids = [[5, 9, 5, 9, 5], [1, 2, 3, 1, 2], [7, 8], [4, 4, 6, 10]]
+    params = [
+        SamplingParams(do_sample=False, repetition_penalty=1.5, no_repeat_ngram_size=2),
+        SamplingParams(temperature=0.7, top_k=5, no_repeat_ngram_size=3),
+        SamplingParams(top_k=0, top_p=0.6, min_length=4, no_repeat_ngram_size=1),
+        SamplingParams(temperature=1.3, top_k=10, top_p=0.8, repetition_penalty=1.2),
+    ]
+    torch.manual_seed(0)
+    logits = torch.randn(len(params), 64) * 3
+
+    # One row at a time through the equivalent HF processors and warpers
+    expected_processed, expected_warped = [], []
+    for row, (p, ids) in enumerate(zip(params, token_ids)):
+        input_ids = torch.tensor([ids])
+        scores = logits[row:row + 1].clone()
+        if p.repetition_penalty != 1.0:
+            scores = RepetitionPenaltyLogitsProcessor(p.repetition_penalty)(input_ids, scores)
+        if p.no_repeat_ngram_size:
+            scores = NoRepeatNGramLogitsProcessor(p.no_repeat_ngram_size)(input_ids, scores)
+        if p.min_length:
+            scores = MinLengthLogitsProcessor(p.min_length, eos_token_id)(input_ids, scores)
+        expected_processed.append(scores)
+        if p.do_sample:
+            scores = TemperatureLogitsWarper(p.temperature)(input_ids, scores)
+            if p.top_k:
+                scores = TopKLogitsWarper(p.top_k)(input_ids, scores)
+            if p.top_p < 1.0:
+                scores = TopPLogitsWarper(p.top_p)(input_ids, scores)
+            expected_warped.append(scores)
+
+    sampler = Sampler(eos_token_id, generator=torch.Generator().manual_seed(0))
+    processed = sampler.process(logits, SamplingBatch(params, token_ids, logits.device))
+    torch.testing.assert_close(processed, torch.cat(expected_processed))
+
+    # Draw every row many times in one call: greedy rows take the argmax, sampled rows
+    # follow the distribution left by their warpers, and an incremental seen mask matches
+    repeats = 4000
+    history = token_history(token_ids, logits.device, capacity=8).repeat(repeats, 1)
+    seen = seen_tokens(history, logits.size(-1))
+    next_ids = sampler(logits.repeat(repeats, 1), params * repeats, history, seen).view(repeats, -1)
+    assert (next_ids[:, 0] == torch.argmax(expected_processed[0])).all()
+    for row, expected in zip((1, 2, 3), expected_warped):
+        frequencies = torch.bincount(next_ids[:, row], minlength=logits.size(-1)) / repeats
+        assert (frequencies[expected[0].isinf()] == 0).all()
+        torch.testing.assert_close(frequencies, torch.softmax(expected[0], dim=-1), atol=0.03, rtol=0)
+
+def test_batch_scheduler_fails_only_the_request_that_errors(model):
+    import asyncio
+
+    from scheduler import BatchScheduler, SamplingParams
+
+    class PoisonTokenizer(CharTokenizer):
+        # "~" maps outside the embedding table, so prefilling it raises
+        def __call__(self, text, truncation=False, max_length=None):
+            return {"input_ids": [500 if c == "~" else ord(c) % 100 for c in text]}
+
+    tokenizer = PoisonTokenizer()
+    params = SamplingParams(max_length=30, do_sample=False)
+    scheduler = BatchScheduler(model, tokenizer, device="cpu", max_batch_size=4)
+    scheduler.start()
+
+    async def run():
+        expected = [await scheduler.generate(prompt, params) for prompt in ("def f(x):", "x = 1")]
+        # One request is already decoding when the batch with the bad prompt arrives
+        running = scheduler.stream("def f(x):", params)
+        streamed = [await running.__anext__()]
+        results = await scheduler.generate_many([("x = 1", params, None), ("~", params, None)])
+        streamed += [token_id async for token_id in running]
+        assert scheduler.is_alive
+        return expected, [tokenizer("def f(x):")["input_ids"] + streamed] + results
+
+    try:
+        expected, results = asyncio.run(run())
+    finally:
+        scheduler.stop()
+
+    assert results[:2] == expected
+    assert isinstance(results[2], IndexError)
+
+def test_invalid_sampling_settings_are_rejected_per_request(model):
+    import asyncio
+
+    from fastapi.testclient import TestClient
+
+    import serve
+    from sampling import Sampler
+    from scheduler import BatchScheduler, SamplingParams
+
+    client = TestClient(serve.app)
+    for settings in ({"temperature": 0}, {"top_p": 0}, {"top_p": 1.5}, {"top_k": -1}, {"repetition_penalty": 0}):
+        assert client.post("/generate", json={"prompt": "x", **settings}).status_code == 422
+
+    # A top_p that no single token reaches still keeps the best one
+    logits = torch.randn(2, 50)
+    params = [SamplingParams(top_p=1e-9), SamplingParams(top_k=0, top_p=1e-9)]
+    assert torch.equal(Sampler()(logits, params, [[1], [2]]), logits.argmax(-1))
+
+    tokenizer = CharTokenizer()
+    good = SamplingParams(max_length=20, do_sample=False)
+    scheduler = BatchScheduler(model, tokenizer, device="cpu")
+    scheduler.start()
+
+    async def run():
+        with pytest.raises(ValueError):
+            await scheduler.generate("x = 1", SamplingParams(temperature=0))
+        return await scheduler.generate_many([("x = 1", good, None), ("x = 1", SamplingParams(top_p=0), None)])
+
+    try:
+        results = asyncio.run(run())
+    finally:
+        scheduler.stop()
+
+    assert len(results[0]) == 20
+    assert isinstance(results[1], ValueError)
+    assert scheduler.stats()["pending"] == 0
+
+def test_route_metrics_key_on_route_templates(monkeypatch):
+    from fastapi.testclient import TestClient
+
+    import serve
+
+    monkeypatch.setattr(serve, "route_metrics", {})
+    client = TestClient(serve.app)
+    for path in ("/healthz", "/healthz", "/missing", "/missing/1", "/wp-admin.php"):
+        client.get(path)
+    client.post("/generate", json={"prompt": "x", "temperature": 0})
+
+    assert set(serve.route_metrics) == {"/healthz", "/generate", "unmatched"}
+    assert serve.route_metrics["unmatched"]["requests"] == 3
+    assert serve.route_metrics["/healthz"]["requests"] == 2
+
+def test_prefix_cache_evicts_least_recently_used():
+    from scheduler import PrefixCache
+
+    cache = PrefixCache(max_entries=2)
+    cache.put((1,), "a")
+    cache.put((2,), "b")
+    assert cache.get((1,)) == "a"
+    cache.put((3,), "c")
+
+    assert cache.get((2,)) is None
+    assert cache.get((1,)) == "a" and cache.get((3,)) == "c"
+
+def test_inference_profiler_splits_prefill_decode_and_layers(tmp_path, model):
+    from profiling import InferenceProfiler
+
+    profiler = InferenceProfiler(model)
+    profiler.enable()
+    input_ids = torch.randint(0, 128, (2, 6))
+    with torch.no_grad():
+        outputs = model(input_ids, use_cache=True)
+        for _ in range(3):
+            outputs = model(input_ids[:, :1], past_key_values=outputs.past_key_values, use_cache=True)
+
+    report = profiler.report()
+    assert report["prefill"]["forwards"] == 1 and report["prefill"]["tokens"] == 12
+    assert report["decode"]["forwards"] == 3 and report["decode"]["tokens"] == 6
+    assert [layer["calls"] for layer in report["layers"]] == [4, 4]
+    assert 0 < report["attention_fraction"] + report["mlp_fraction"] < 1
+    # 2 layers x (key, value) x batch 2 x 4 heads x 9 positions x head_dim 8 in fp32
+    assert report["kv_cache"]["last_bytes"] == 2 * 2 * 2 * 4 * 9 * 8 * 4
+
+    trace_path = str(tmp_path / "trace.json")
+    profiler.trace(trace_path, num_forwards=1)
+    with pytest.raises(RuntimeError):
+        profiler.disable()
+    with torch.no_grad():
+        model(input_ids)
+    assert os.path.exists(trace_path) and not profiler.trace_pending
+
+    profiler.disable()
+    assert not model.transformer._forward_hooks and not model.transformer.h[0].attn._forward_pre_hooks
+
+def test_trace_on_a_disabled_profiler_removes_its_hooks_when_done(tmp_path, monkeypatch, model):
+    from types import SimpleNamespace
+
+    from fastapi.testclient import TestClient
+
+    import serve
+    from profiling import InferenceProfiler
+
+    profiler = InferenceProfiler(model)
+    monkeypatch.setattr(
+        serve, "model_server", SimpleNamespace(profiler=profiler, profile_trace_dir=str(tmp_path))
+    )
+    client = TestClient(serve.app)
+
+    # Contradictory switches are refused before anything starts
+    response = client.post("/debug/profile", json={"enabled": False, "trace_forwards": 2, "reset": True})
+    assert response.status_code == 409
+    assert not profiler.enabled and not profiler.trace_pending
+
+    assert client.post("/debug/profile", json={"trace_forwards": 2}).json()["trace"]["pending"]
+    assert client.post("/debug/profile", json={"trace_forwards": 1}).status_code == 409
+    input_ids = torch.randint(0, 128, (1, 4))
+    with torch.no_grad():
+        model(input_ids)
+        assert profiler.enabled
+        model(input_ids)
+    assert not profiler.trace_pending and not profiler.enabled
+    assert not model.transformer._forward_hooks and not model.transformer.h[0].mlp._forward_hooks
+    assert os.path.exists(profiler.last_trace_path)
+
+    # Profiling that was already on stays on after the trace
+    client.post("/debug/profile", json={"enabled": True, "trace_forwards": 1})
+    with torch.no_grad():
+        model(input_ids)
+    assert profiler.enabled and not profiler.trace_pending
+    profiler.disable()
+
+def test_int8_quantization_replaces_linear_layers(model):
+    from quantize import quantize_model
+
+    input_ids = torch.randint(0, 128, (1, 8))
+    with torch.no_grad():
+        expected = model(input_ids).logits
+
+    quantized = quantize_model(model, "int8")
+
+    assert not any(type(module) is torch.nn.Linear for module in quantized.modules())
+    with torch.no_grad():
+        logits = quantized(input_ids).logits
+    assert torch.allclose(logits, expected, atol=0.1)
+
+def test_quantize_model_rejects_unknown_mode(model):
+    from quantize import quantize_model
+
+    with pytest.raises(ValueError):
+        quantize_model(model, "int4")
+
+def test_lazy_loader_matches_from_pretrained_with_tied_embeddings(tmp_path):
+    from model_loader import load_model, safetensors_shards
+
+    torch.manual_seed(0)
+    model = IndieGOForCausalLM(tiny_config(tie_word_embeddings=True, position_embedding_type="rotary")).eval()
+    assert model.lm_head.weight is model.transformer.wte.weight
+    model.save_pretrained(tmp_path, max_shard_size="20KB")
+    assert len(safetensors_shards(str(tmp_path))) > 1
+
+    loaded = load_model(str(tmp_path)).eval()
+
+    assert loaded.lm_head.weight is loaded.transformer.wte.weight
+    assert not any(param.is_meta for param in loaded.parameters())
+    input_ids = torch.randint(0, 128, (2, 10))
+    with torch.no_grad():
+        assert torch.equal(loaded(input_ids).logits, model(input_ids).logits)
+
+    # On the CPU the parameters are views of the shard files, laid out as in the file
+    import json
+
+    parameters = dict(loaded.named_parameters())
+    for shard in safetensors_shards(str(tmp_path)):
+        with open(shard, "rb") as f:
+            header = json.loads(f.read(int.from_bytes(f.read(8), "little")))
+        header.pop("__metadata__", None)
+        names = sorted(header, key=lambda name: header[name]["data_offsets"][0])
+        for name in names[1:]:
+            offset = header[name]["data_offsets"][0] - header[names[0]]["data_offsets"][0]
+            assert parameters[name].data_ptr() - parameters[names[0]].data_ptr() == offset
+
+    assert load_model(str(tmp_path), torch_dtype=torch.float16).lm_head.weight.dtype == torch.float16
+
+def test_onnx_export_serves_batch_scheduler(tmp_path, monkeypatch):
+    import asyncio
+    from types import SimpleNamespace
+
+    from fastapi.testclient import TestClient
+
+    pytest.importorskip("onnx")
+    pytest.importorskip("onnxruntime")
+    from export_onnx import export_model
+    from onnx_backend import OnnxCausalLM
+    from scheduler import BatchScheduler, SamplingParams
+
+    torch.manual_seed(0)
+    model = IndieGOForCausalLM(tiny_config(n_kv_head=2, position_embedding_type="rotary")).eval()
+    export_model(model, str(tmp_path))
+    onnx_model = OnnxCausalLM(str(tmp_path))
+
+    tokenizer = CharTokenizer()
+    prompts = ["def f(x):", "import os\nimport sys"]
+    expected = []
+    for prompt in prompts:
+        input_ids = torch.tensor([tokenizer(prompt)["input_ids"]])
+        output = model.generate(
+            input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            max_length=24,
+            do_sample=False,
+            eos_token_id=tokenizer.eos_token_id,
+            pad_token_id=0,
+        )
+        expected.append(output[0].tolist())
+
+    scheduler = BatchScheduler(onnx_model, tokenizer, device="cpu", max_batch_size=2)
+    scheduler.start()
+
+    async def run():
+        return await asyncio.gather(*[
+            scheduler.generate(prompt, SamplingParams(max_length=24, do_sample=False))
+            for prompt in prompts
+        ])
+
+    try:
+        results = asyncio.run(run())
+    finally:
+        scheduler.stop()
+
+    assert results == expected
+
+    # Requests that need HF generate are turned away before reaching the model
+    import serve
+
+    monkeypatch.setattr(serve, "PreTrainedTokenizerBase", SimpleNamespace(from_pretrained=lambda path: tokenizer))
+    monkeypatch.setattr(serve, "model_server", serve.ModelServer(str(tmp_path), device="cpu", backend="onnx"))
+    with TestClient(serve.app) as client:
+        for settings in ({"num_beams": 2}, {"num_return_sequences": 2}):
+            response = client.post("/generate", json={"prompt": "x = 1", "max_length": 16, **settings})
+            assert response.status_code == 400
+            assert "BACKEND=torch" in response.json()["detail"]
+        assert client.post("/generate", json={"prompt": "x = 1", "max_length": 16}).status_code == 200
+
+def test_memmap_dataset_serves_pretokenized_documents(tmp_path):
+    pytest.importorskip("datasets")
+    pytest.importorskip("wandb")
+    from pretokenize import pretokenize
+    from train import MemmapCodeDataset
+
+    tokenizer = CharTokenizer()
+    documents = ["def f():", "", "return x + 1", "import os"]
+    corpus = tmp_path / "train.txt"
+    corpus.write_text("\n".join(documents) + "\n")
+
+    meta = pretokenize(tokenizer, str(corpus), str(tmp_path / "train"), batch_size=2)
+    assert meta["dtype"] == "uint16"
+    assert meta["num_documents"] == 3
+
+    dataset = MemmapCodeDataset(str(tmp_path / "train.bin"), block_size=10)
+    stream = [token_id for document in documents for token_id in tokenizer(document)["input_ids"]]
+    # 29 tokens: two full blocks, the tail is dropped
+    assert len(dataset) == len(stream) // 10 == 2
+    assert dataset.token_utilization() == 1.0
+
+    item = dataset[1]
+    assert item["input_ids"].tolist() == stream[10:20]
+    assert item["attention_mask"].tolist() == [1] * 10
+    # A view of the memory map, not a copy
+    assert item["input_ids"].dtype == torch.uint16
+    assert item["input_ids"].data_ptr() == dataset[1]["input_ids"].data_ptr()
+
+def test_packing_retokenizes_a_changed_corpus_on_the_main_process(tmp_path, monkeypatch):
+    pytest.importorskip("datasets")
+    pytest.importorskip("wandb")
+    from contextlib import contextmanager
+
+    import train
+    from train import load_code_dataset
+
+    class Rank:
+        """Stands in for the Accelerator of one process"""
+        def __init__(self, is_main_process):
+            self.is_main_process = is_main_process
+
+        @contextmanager
+        def main_process_first(self):
+            yield
+
+    tokenizer = CharTokenizer()
+    corpus = tmp_path / "train.txt"
+    corpus.write_text("def f():\n")
+    # A rank that never sees the main process's token file (no shared filesystem) fails loudly
+    with pytest.raises(FileNotFoundError):
+        load_code_dataset(tokenizer, str(corpus), block_size=8, pack_sequences=True, accelerator=Rank(False))
+    dataset = load_code_dataset(tokenizer, str(corpus), block_size=8, pack_sequences=True, accelerator=Rank(True))
+    assert dataset.num_tokens == 9
+
+    corpus.write_text("def f():\nreturn x + 1\n")
+    os.utime(corpus, ns=(0, os.stat(corpus).st_mtime_ns + 1))
+    # Other ranks never write the token file; they wait for the main process to do it
+    dataset = load_code_dataset(tokenizer, str(corpus), block_size=8, pack_sequences=True, accelerator=Rank(False))
+    assert dataset.num_tokens == 9
+    dataset = load_code_dataset(tokenizer, str(corpus), block_size=8, pack_sequences=True, accelerator=Rank(True))
+    assert dataset.num_tokens == 9 + 13
+
+    # Without packing a stale token file is ignored in favor of the text
+    monkeypatch.setattr(train, "CodeDataset", lambda **kwargs: "text")
+    assert type(load_code_dataset(tokenizer, str(corpus), block_size=8)).__name__ == "MemmapCodeDataset"
+    corpus.write_text("pass\n")
+    os.utime(corpus, ns=(0, os.stat(corpus).st_mtime_ns + 1))
+    assert load_code_dataset(tokenizer, str(corpus), block_size=8) == "text"
+
+def test_packed_blocks_match_separate_documents(tmp_path, model):
+    pytest.importorskip("datasets")
+    pytest.importorskip("wandb")
+    from pretokenize import pretokenize
+    from train import PackedCodeDataset
+
+    tokenizer = CharTokenizer()
+    documents = ["def f():", "return x + 1", "import os", "pass"]
+    corpus = tmp_path / "train.txt"
+    corpus.write_text("\n".join(documents) + "\n")
+    pretokenize(tokenizer, str(corpus), str(corpus))
+
+    dataset = PackedCodeDataset(str(corpus), block_size=16, eos_token_id=tokenizer.eos_token_id)
+    num_tokens = sum(len(doc) + 1 for doc in documents)
+    assert len(dataset) == 3
+    assert dataset.token_utilization() == num_tokens / 48
+
+    block = dataset[0]
+    # "def f():" + EOS, then the first 7 tokens of "return x + 1"
+    assert block["attention_mask"].tolist() == [1] * 9 + [2] * 7
+    assert block["position_ids"].tolist() == list(range(9)) + list(range(7))
+    assert block["input_ids"][8].item() == tokenizer.eos_token_id
+    assert block["labels"][0].item() == -100 and block["labels"][9].item() == -100
+
+    with torch.no_grad():
+        packed_logits = model(
+            block["input_ids"][None],
+            attention_mask=block["attention_mask"][None],
+            position_ids=block["position_ids"][None],
+        ).logits
+        second_doc = block["input_ids"][None, 9:]
+        separate_logits = model(second_doc).logits
+
+    assert torch.allclose(packed_logits[:, 9:], separate_logits, atol=1e-5)
+
+    # The rest of "return x + 1" and its EOS continue from position 7 in the next block
+    continuation = dataset[1]
+    assert continuation["attention_mask"][:6].tolist() == [1] * 6
+    assert continuation["position_ids"][:6].tolist() == list(range(7, 13))
+    # ... unless that runs past the model's positions, then it starts over
+    capped = PackedCodeDataset(str(corpus), block_size=16, eos_token_id=tokenizer.eos_token_id, max_positions=12)
+    assert capped[1]["position_ids"][:6].tolist() == list(range(6))
+
+def test_training_steps_once_per_accumulation_window(tmp_path, monkeypatch):
+    pytest.importorskip("datasets")
+    pytest.importorskip("wandb")
+    from types import SimpleNamespace
+
+    import train
+    from pretokenize import pretokenize
+    from train import PackedCodeDataset
+
+    tokenizer = CharTokenizer()
+    corpus = tmp_path / "train.txt"
+    corpus.write_text("\n".join(f"value_{i} = compute({i})" for i in range(16)) + "\n")
+    pretokenize(tokenizer, str(corpus), str(corpus))
+    accumulation_steps = 2
+    num_batches = len(PackedCodeDataset(str(corpus), block_size=16, eos_token_id=tokenizer.eos_token_id))
+    assert num_batches % accumulation_steps == 0
+
+    counts = {"forward": 0, "optimizer": 0, "scheduler": 0}
+    logged_steps = []
+
+    class CountingAdamW(torch.optim.AdamW):
+        def step(self, *args, **kwargs):
+            counts["optimizer"] += 1
+            return super().step(*args, **kwargs)
+
+    def get_scheduler(**kwargs):
+        lr_scheduler = transformers_get_scheduler(**kwargs)
+        scheduler_step = lr_scheduler.step
+        def step(*args, **kwargs):
+            counts["scheduler"] += 1
+            return scheduler_step(*args, **kwargs)
+        lr_scheduler.step = step
+        return lr_scheduler
+
+    def forward(self, *args, **kwargs):
+        counts["forward"] += 1
+        return model_forward(self, *args, **kwargs)
+
+    def log(metrics, step):
+        # Each logged step must close a full accumulation window
+        logged_steps.append(step)
+        assert counts["forward"] == step * accumulation_steps
+        assert counts["optimizer"] == counts["scheduler"] == step
+
+    transformers_get_scheduler = train.get_scheduler
+    model_forward = train.IndieGOForCausalLM.forward
+    monkeypatch.setattr(torch.optim, "AdamW", CountingAdamW)
+    monkeypatch.setattr(train, "get_scheduler", get_scheduler)
+    monkeypatch.setattr(train.IndieGOForCausalLM, "forward", forward)
+    monkeypatch.setattr(train, "IndieGOConfig", tiny_config)
+    monkeypatch.setattr(train, "PreTrainedTokenizerBase", SimpleNamespace(from_pretrained=lambda path: tokenizer))
+    monkeypatch.setattr(train, "wandb", SimpleNamespace(init=lambda **kwargs: None, log=log))
+
+    train.train(
+        train_file=str(corpus),
+        max_seq_length=16,
+        pack_sequences=True,
+        per_device_train_batch_size=1,
+        num_train_epochs=1,
+        gradient_accumulation_steps=accumulation_steps,
+        output_dir=str(tmp_path / "checkpoints"),
+        logging_steps=1,
+    )
+
+    num_updates = num_batches // accumulation_steps
+    assert counts["forward"] == num_batches
+    assert counts["optimizer"] == counts["scheduler"] == num_updates
+    assert logged_steps == list(range(1, num_updates + 1))
+
+def test_evaluate_averages_over_tokens_not_batches(model):
+    pytest.importorskip("datasets")
+    pytest.importorskip("wandb")
+    from accelerate import Accelerator
+    from train import evaluate
+
+    tokenizer = CharTokenizer()
+    documents = ["def f():", "return x + 1", "import os", "pass"]
+
+    class PaddedDocuments(torch.utils.data.Dataset):
+        """One document per item, padded to 16 tokens"""
+        def __len__(self):
+            return len(documents)
+
+        def __getitem__(self, i):
+            input_ids = torch.zeros(16, dtype=torch.long)
+            document = torch.tensor(tokenizer(documents[i])["input_ids"])
+            input_ids[:len(document)] = document
+            attention_mask = (torch.arange(16) < len(document)).long()
+            return {
+                "input_ids": input_ids,
+                "attention_mask": attention_mask,
+                "labels": input_ids.masked_fill(attention_mask == 0, -100),
+            }
+
+    accelerator = Accelerator()
+    dataset = PaddedDocuments()
+    # The last batch is partial and every batch has padding
+    dataloader = accelerator.prepare(torch.utils.data.DataLoader(dataset, batch_size=3))
+    metrics = evaluate(model, dataloader, accelerator)
+
+    total_loss = 0.0
+    total_tokens = 0
+    with torch.no_grad():
+        for document in documents:
+            input_ids = torch.tensor([tokenizer(document)["input_ids"]])
+            total_loss += model(input_ids, labels=input_ids).loss.item() * (input_ids.size(1) - 1)
+            total_tokens += input_ids.size(1) - 1
+
+    assert metrics["eval_tokens"] == total_tokens
+    assert metrics["eval_loss"] == pytest.approx(total_loss / total_tokens, rel=1e-5)
+    assert metrics["perplexity"] == pytest.approx(math.exp(total_loss / total_tokens), rel=1e-5)
+
+def test_resolve_latest_checkpoint_skips_incomplete_ones(tmp_path):
+    pytest.importorskip("datasets")
+    pytest.importorskip("wandb")
+    from train import TRAINER_STATE_NAME, list_checkpoints, resolve_checkpoint
+
+    assert resolve_checkpoint(str(tmp_path), "latest") is None
+    for step in (5, 20, 100):
+        (tmp_path / f"checkpoint-{step}").mkdir()
+        (tmp_path / f"checkpoint-{step}" / TRAINER_STATE_NAME).write_text("{}")
+    # Interrupted while saving: no trainer state yet
+    (tmp_path / "checkpoint-200").mkdir()
+    (tmp_path / "best").mkdir()
+
+    assert list_checkpoints(str(tmp_path)) == ["checkpoint-5", "checkpoint-20", "checkpoint-100"]
+    assert resolve_checkpoint(str(tmp_path), "latest") == str(tmp_path / "checkpoint-100")
+    assert resolve_checkpoint(str(tmp_path), "other/checkpoint-5") == "other/checkpoint-5"
+
+def test_response_cache_expires_and_evicts(monkeypatch):
+    import response_cache
+    from response_cache import ResponseCache, cache_key
+
+    assert cache_key("m", {"prompt": "x", "top_k": 50}) == cache_key("m", {"top_k": 50, "prompt": "x"})
+    assert cache_key("m", {"prompt": "x", "top_k": 50}) != cache_key("m", {"prompt": "x", "top_k": 40})
+    assert cache_key("m", {"prompt": "x"}) != cache_key("other model", {"prompt": "x"})
+
+    now = [1000.0]
+    monkeypatch.setattr(response_cache.time, "time", lambda: now[0])
+    cache = ResponseCache(max_entries=2, ttl=60)
+    cache.put("a", "1")
+    cache.put("b", "2")
+    assert cache.get("a") == "1"
+    cache.put("c", "3")
+    assert cache.get("b") is None
+
+    now[0] += 61
+    assert cache.get("a") is None
+    assert cache.stats() == {
+        "entries": 1, "hits": 1, "misses": 2, "hit_rate": 1 / 3, "expirations": 1, "evictions": 1
+    }
+
+def test_response_cache_persists_to_sqlite(tmp_path):
+    from response_cache import ResponseCache
+
+    db_path = str(tmp_path / "responses.db")
+    cache = ResponseCache(max_entries=2, db_path=db_path)
+    for key in ("a", "b", "c"):
+        cache.put(key, key.upper())
+    cache.close()
+
+    # A fresh process only has the disk copy, bounded to the most recent entries
+    cache = ResponseCache(max_entries=2, db_path=db_path)
+    assert cache.get("a") is None
+    assert cache.get("c") == "C"
+    assert cache.stats()["hits"] == 1
+    cache.close()
+
+def test_response_cache_reconnects_after_fork(tmp_path, monkeypatch):
+    import response_cache
+    from response_cache import ResponseCache
+
+    cache = ResponseCache(max_entries=2, db_path=str(tmp_path / "responses.db"))
+    cache.put("a", "A")
+    parent_connection = cache._connection()
+
+    # A forked worker must open its own connection instead of reusing the parent's
+    monkeypatch.setattr(response_cache.os, "getpid", lambda: -1)
+    cache._entries.clear()
+    assert cache.get("a") == "A"
+    assert cache._connection() is not parent_connection
+    cache.close()
+    parent_connection.close()
+
+def test_only_deterministic_responses_are_cached(tmp_path, monkeypatch, model):
+    import asyncio
+    from types import SimpleNamespace
+
+    import serve
+
+    for ttl, expected in (("0", None), ("", None), ("60", 60.0)):
+        monkeypatch.setenv("RESPONSE_CACHE_TTL", ttl)
+        assert serve._response_cache_ttl() == expected
+    monkeypatch.setenv("RESPONSE_CACHE_SIZE", "8")
+    assert serve._response_cache_size() == 8
+    monkeypatch.setenv("RESPONSE_CACHE_ENABLED", "false")
+    assert serve._response_cache_size() == 0
+
+    class DecodingCharTokenizer(CharTokenizer):
+        def decode(self, token_ids, skip_special_tokens=False):
+            return "".join(chr(i) for i in token_ids)
+
+    model.save_pretrained(tmp_path)
+    monkeypatch.setattr(serve, "PreTrainedTokenizerBase", SimpleNamespace(from_pretrained=lambda path: DecodingCharTokenizer()))
+    server = serve.ModelServer(str(tmp_path), device="cpu")
+    server.scheduler.start()
+
+    async def run():
+        for do_sample in (True, True, False, False):
+            await server.agenerate(serve.GenerationConfig(prompt="x = 1", max_length=16, do_sample=do_sample))
+        snippet = serve.CodeAnalysisConfig(code="y = 2", max_length=24)
+        first = await server.aanalyze_code(snippet)
+        batch = await server.aanalyze_batch([snippet, serve.CodeAnalysisConfig(code="z = 3", max_length=24)])
+        return first, batch
+
+    try:
+        first, batch = asyncio.run(run())
+    finally:
+        server.scheduler.stop()
+
+    # Sampled generations are never stored; the greedy one and the analyses are replayed
+    stats = server.response_cache.stats()
+    assert stats["hits"] == 2
+    assert stats["entries"] == 3
+    assert batch[0] == first
+
+def test_worker_core_slices_cover_every_core_once():
+    pytest.importorskip("uvicorn")
+    pytest.importorskip("fastapi")
+    from serve_workers import core_slices
+
+    assert core_slices(3, list(range(8))) == [[0, 1, 2], [3, 4, 5], [6, 7]]
+    assert core_slices(1, [4, 2]) == [[2, 4]]
+    # More workers than cores: workers share cores round robin
+    assert core_slices(3, [0, 1]) == [[0], [1], [0]]
+
+def test_worker_restarts_back_off_and_give_up(monkeypatch):
+    pytest.importorskip("uvicorn")
+    pytest.importorskip("fastapi")
+    import signal
+    import time
+
+    import serve
+    import serve_workers
+
+    spawned = []
+
+    def spawn(sock, cores, log_level):
+        # A worker that crashes on startup
+        spawned.append(time.monotonic())
+        pid = os.fork()
+        if pid == 0:
+            os._exit(1)
+        return pid
+
+    monkeypatch.setattr(serve_workers, "_spawn", spawn)
+    monkeypatch.setattr(serve, "model_server", None)
+    monkeypatch.setattr(serve, "create_model_server", lambda: None)
+    monkeypatch.setattr(signal, "signal", lambda signum, handler: None)
+    num_threads = torch.get_num_threads()
+    try:
+        with pytest.raises(RuntimeError):
+            serve_workers.run(port=0, workers=1, max_restarts=3, restart_backoff=0.05, max_backoff=10.0)
+    finally:
+        torch.set_num_threads(num_threads)
+
+    assert len(spawned) == 4
+    waits = [later - earlier for earlier, later in zip(spawned, spawned[1:])]
+    assert all(wait >= delay for wait, delay in zip(waits, (0.05, 0.1, 0.2)))
+    assert serve_workers.restart_delay(10, 0.05, 10.0) == 10.0
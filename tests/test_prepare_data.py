@@ -0,0 +1,109 @@
+import gzip
+import json
+import os
+import random
+import sys
+
+import pytest
+
+pytest.importorskip("requests")
+pytest.importorskip("xxhash")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "ai_model"))
+
+from dedup import MinHashDeduplicator
+from prepare_data import DataPreparation, decompress, iter_jsonl_shard, merge_reservoirs, reservoir_sample
+
+def write_jsonl_gz(path, records):
+    with gzip.open(path, "wt") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+def test_reservoir_sample_is_bounded():
+    examples = ({"text": str(i)} for i in range(1000))
+    reservoirs, count = reservoir_sample(examples, {"a": 10, "b": 20}, random.Random(0))
+
+    assert count == 1000
+    assert len(reservoirs["a"]) == 10
+    assert len(reservoirs["b"]) == 20
+
+def test_merge_reservoirs_draws_without_replacement():
+    shards = [
+        ([{"text": f"a{i}"} for i in range(5)], 5),
+        ([{"text": f"b{i}"} for i in range(8)], 500),
+    ]
+    sample = merge_reservoirs(shards, 8, random.Random(0))
+
+    texts = [example["text"] for example in sample]
+    assert len(texts) == 8
+    assert len(set(texts)) == 8
+
+def test_jsonl_shards_split_byte_ranges_of_the_decompressed_file(tmp_path):
+    records = [{"code": "x" * (i % 7) * 10, "i": i} for i in range(101)]
+    gz_path = tmp_path / "code.jsonl.gz"
+    write_jsonl_gz(gz_path, records)
+
+    path = decompress(gz_path)
+    assert path == tmp_path / "code.jsonl"
+    assert decompress(gz_path) == path
+
+    with pytest.raises(ValueError):
+        next(iter_jsonl_shard(gz_path, 0, 2))
+    assert list(iter_jsonl_shard(gz_path)) == records
+    for num_shards in (1, 2, 3, 8):
+        shards = [list(iter_jsonl_shard(path, shard, num_shards)) for shard in range(num_shards)]
+        assert [record for shard in shards for record in shard] == records
+        assert all(shards)
+
+def test_sample_datasets_across_worker_shards(tmp_path):
+    data_prep = DataPreparation(output_dir=str(tmp_path), num_workers=2, samples_per_task=3)
+    code_path = tmp_path / "raw" / "python-code.jsonl.gz"
+    records = [{"code": "\n".join(f"v{i}_{j} = {i * j}" for j in range(6))} for i in range(20)]
+    write_jsonl_gz(code_path, records + [{"code": "short"}])
+
+    samples = data_prep.sample_datasets(
+        sources={"code": ("process_python_code", code_path)},
+        sizes={"code": {"explanation": 3, "improvement": 3}},
+    )
+
+    assert len(samples["explanation"]) == 3
+    assert len(samples["improvement"]) == 3
+    assert all(example["type"] == "code" for example in samples["explanation"])
+
+def test_minhash_flags_exact_and_near_duplicates():
+    deduplicator = MinHashDeduplicator()
+    code = "\n".join(f"def handler_{i}(request):\n    return process(request, {i})" for i in range(30))
+
+    assert not deduplicator.is_duplicate(code)
+    assert deduplicator.is_duplicate("  " + code.replace("\n", "\n  "))
+    assert deduplicator.is_duplicate(code.replace("process(request, 7)", "process(request, 70)"))
+    assert not deduplicator.is_duplicate("class Config:\n    debug = False\n    port = 8000\n    host = 'localhost'")
+
+    stats = deduplicator.stats.to_dict()
+    assert stats == {"seen": 4, "exact_duplicates": 1, "near_duplicates": 1, "kept": 2}
+
+def test_sample_datasets_removes_duplicates_across_shards(tmp_path):
+    data_prep = DataPreparation(output_dir=str(tmp_path), num_workers=2, samples_per_task=50)
+    code_path = tmp_path / "raw" / "python-code.jsonl.gz"
+    code = "\n".join(f"value_{i} = compute({i})" for i in range(10))
+    # Ten distinct files, each copied four times across both shards
+    records = [{"code": f"{code}\nresult = finish('{i}')"} for i in range(10)] * 4
+    write_jsonl_gz(code_path, records)
+
+    samples = data_prep.sample_datasets(
+        sources={"code": ("process_python_code", code_path)},
+        sizes={"code": {"explanation": 50}},
+    )
+
+    texts = [example["text"] for example in samples["explanation"]]
+    assert len(texts) == len(set(texts))
+    assert data_prep.dedup_stats["code"]["shards"]["seen"] == 40
+
+def test_minhash_memory_is_fixed_by_capacity():
+    deduplicator = MinHashDeduplicator(capacity=200, error_rate=1e-3)
+    nbytes = deduplicator._exact.nbytes + deduplicator._bands.nbytes
+
+    kept = sum(not deduplicator.is_duplicate(f"row_{i} = fetch({i} * {i + 7}) + offset_{i % 13}") for i in range(200))
+    assert kept >= 198
+    assert deduplicator._exact.nbytes + deduplicator._bands.nbytes == nbytes
+    assert deduplicator.is_duplicate("row_5 = fetch(5 * 12) + offset_5")